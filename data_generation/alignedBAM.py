@@ -1,4 +1,437 @@
+import os
+import threading
+import warnings
+from bisect import bisect_left
+from collections import OrderedDict
 import bamnostic
+from bamnostic import bai
+from stageTimer import stage_timer
+
+try:
+    import pysam
+except ImportError:
+    pysam = None
+
+
+def query_length(read):
+    """
+    Length of a read by bamnostic's convention. bamnostic gives reads stored without a sequence the sequence "*" and
+    thus length 1, where pySAM reports length 0, so these reads would otherwise be fetched differently by the backends.
+
+    :param read: Aligned read of either backend
+    :return: int
+    """
+    return read.query_length or 1
+
+
+class pysamReader:
+    """
+    Reader backend based on pySAM, which is much faster than bamnostic but requires its C extensions to be installed.
+
+    bamnostic's fetch returns every read starting before stop whose start plus sequence length reaches start, which
+    is not quite the same as pySAM's overlap of aligned reference spans. fetch therefore asks pySAM for a region
+    extended by fetch_margin to the left and filters by bamnostic's criterion, so that both backends hand out the same
+    reads in the same order, as long as no read is longer than fetch_margin.
+    """
+    fetch_margin = 1000
+
+    def __init__(self, bam_path, bai_path):
+        self.alignment_file = pysam.AlignmentFile(bam_path, mode="rb", index_filename=bai_path)
+
+    def fetch(self, chromosome, start, stop):
+        if start == stop:
+            return
+        for read in self.alignment_file.fetch(chromosome, max(0, start - self.fetch_margin), stop):
+            if read.reference_start < stop and read.reference_start + query_length(read) >= start:
+                yield read
+
+
+class blockCache:
+    """
+    Process-wide LRU cache of decompressed BGZF blocks, keyed by the path of the BAM and the file offset at which the
+    block starts, i.e. the compressed part of a virtual offset. Neighbouring loci mostly start reading in the same
+    blocks, which are then inflated only once, however many AlignmentFiles of the BAM are opened in the meantime. The
+    cache is bounded by the total size of the decompressed blocks.
+    """
+
+    def __init__(self, max_bytes: int = 256 * 1024 ** 2):
+        self.max_bytes = max_bytes
+        self.n_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._blocks = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: Tuple of BAM path and block offset
+        :return: Tuple of decompressed block and its compressed length, or None if not cached
+        """
+        with self._lock:
+            block = self._blocks.get(key)
+            if block is None:
+                self.misses += 1
+                return None
+            self._blocks.move_to_end(key)
+            self.hits += 1
+            return block
+
+    def put(self, key, block):
+        with self._lock:
+            if key in self._blocks:
+                self._blocks.move_to_end(key)
+                return
+            self._blocks[key] = block
+            self.n_bytes += len(block[0])
+            while self.n_bytes > self.max_bytes and self._blocks:
+                _, (data, _) = self._blocks.popitem(last=False)
+                self.n_bytes -= len(data)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+            self.n_bytes = 0
+
+    def stats(self):
+        """
+        :return: Dictionary of hit/miss/eviction counters and the current number and size of cached blocks
+        """
+        with self._lock:
+            n_requests = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "n_blocks": len(self._blocks), "n_bytes": self.n_bytes,
+                    "hit_rate": self.hits / n_requests if n_requests > 0 else 0.}
+
+
+class preloadedIndex:
+    """
+    A bamnostic BAI index whose references are all parsed up front, so that it can be shared by every AlignmentFile
+    of the BAM in the process. bamnostic's own index only keeps the reference queried last and reparses the BAI
+    whenever the chromosome changes. Queries go through a lock, as the wrapped index keeps its current reference
+    as state.
+    """
+
+    def __init__(self, bai_path):
+        self.index = bai.Bai(bai_path)
+        self.refs = {ref_id: self.index.get_ref(ref_id) for ref_id in range(self.index.n_refs)}
+        self.index._io.close()
+
+        self.n_no_coor = self.index.n_no_coor
+        self.unmapped = self.index.unmapped
+        self._lock = threading.Lock()
+
+    def query(self, ref_id, start, stop=-1):
+        if ref_id not in self.refs:
+            raise KeyError("Reference is not found in header")
+        with self._lock:
+            self.index.current_ref = self.refs[ref_id]
+            return self.index.query(ref_id, start, stop)
+
+
+class indexCache:
+    """
+    Process-wide store of preloaded BAI indices, so that each index is parsed once per process.
+    """
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+
+        self._indices = {}
+        self._lock = threading.Lock()
+
+    def get(self, bai_path):
+        """
+        :param bai_path: Path to a BAI index
+        :return: preloadedIndex of the BAI, parsed on first request
+        """
+        key = os.path.abspath(bai_path)
+        with self._lock:
+            if key in self._indices:
+                self.hits += 1
+                return self._indices[key]
+            self.misses += 1
+
+        index = preloadedIndex(bai_path)
+        with self._lock:
+            return self._indices.setdefault(key, index)
+
+    def clear(self):
+        with self._lock:
+            self._indices.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, "n_indices": len(self._indices)}
+
+
+# Shared by all bamnostic AlignmentFiles of the process
+block_cache = blockCache()
+index_cache = indexCache()
+
+# bamnosticReader overrides private methods and attributes of bamnostic, which were only checked against these releases.
+# Any other release is opened as a plain bamnostic AlignmentFile, without the caches.
+bamnostic_tested_versions = ("1.3",)
+bamnostic_caching = getattr(bamnostic, "__version__", None) in bamnostic_tested_versions
+if not bamnostic_caching:
+    warnings.warn(f"bamnostic {getattr(bamnostic, '__version__', None)} is not among the tested releases "
+                  f"{bamnostic_tested_versions}, BAI indices and BGZF blocks will not be cached.")
+
+
+class bamnosticReader(bamnostic.AlignmentFile):
+    """
+    bamnostic AlignmentFile taking its BAI index from index_cache and its decompressed BGZF blocks from
+    block_cache, instead of parsing and inflating them anew for every file object. Its own per-file block buffer is
+    reduced to the current block. pySAM keeps index and blocks in htslib, which are not shared between files, so there
+    the alignmentFilePool is what saves their reparsing.
+
+    As this hooks into private internals of bamnostic, it is only used for the releases in bamnostic_tested_versions.
+    """
+
+    def __init__(self, bam_path, bai_path):
+        # Needed by _load_block, which is already called by the constructor of the parent class
+        self._bam_path = os.path.abspath(bam_path)
+        super().__init__(bam_path, index_filename=bai_path, mode="rb", max_cache=1)
+
+    def _init_index(self):
+        if not (self._check_idx and self._index_ext == "bai"):
+            return super()._init_index()
+
+        self._index = index_cache.get(self._index_path)
+
+        # Read statistics as computed by bamnostic, which keeps them in name-mangled attributes
+        n_no_coor = self._index.n_no_coor if self._index.n_no_coor is not None else 0
+        self._BamReader__nocoordinate = self._index.n_no_coor
+        self._BamReader__mapped = sum(u.n_mapped for u in self._index.unmapped.values()) + n_no_coor
+        self._BamReader__unmapped = sum(u.n_unmapped for u in self._index.unmapped.values()) + n_no_coor
+
+    def _load_block(self, start_offset=None):
+        if start_offset is None:
+            start_offset = self._block_start_offset + self._block_raw_length
+        if start_offset == self._block_start_offset:
+            self._within_block_offset = 0
+            return
+
+        block = block_cache.get((self._bam_path, start_offset))
+        if block is not None:
+            # bamnostic inspects the file position itself at the header and at EOF, so it is moved to where
+            # reading the block would have left it
+            self._buffer, self._block_raw_length = block
+            self._handle.seek(start_offset + self._block_raw_length)
+            self._block_start_offset = start_offset
+            self._within_block_offset = 0
+            return
+
+        super()._load_block(start_offset)
+        block_cache.put((self._bam_path, self._block_start_offset), (self._buffer, self._block_raw_length))
+
+
+def open_reader(backend: str, bam_path, bai_path):
+    """
+    :param backend: Either "pysam" or "bamnostic"
+    :param bam_path: Path to the bam file
+    :param bai_path: Path to its index
+    :return: Object with a fetch(chromosome, start, stop) method, yielding reads
+    """
+    if backend == "pysam":
+        return pysamReader(bam_path, bai_path)
+    elif backend == "bamnostic":
+        if bamnostic_caching:
+            return bamnosticReader(bam_path, bai_path)
+        return bamnostic.AlignmentFile(bam_path, index_filename=bai_path, mode="rb")
+    else:
+        raise ValueError(f"Unknown alignment file backend {backend}!")
+
+
+# pySAM is used wherever it is installed, with bamnostic as the platform-independent fallback
+default_backend = "pysam" if pysam is not None else "bamnostic"
+
+
+class alignmentFilePool:
+    """
+    Process-wide pool of opened AlignmentFiles, so that a BAM (and its BAI index) is not rebuilt for every position
+    it is invoked for. At most max_open files are kept, and the least recently used one is forgotten once the pool is
+    full, which keeps the RAM-saving intent of opening files only on demand.
+
+    Handles are keyed by bam_ID, backend and the thread requesting them, since an AlignmentFile keeps a single file pointer
+    and cannot be iterated from two threads at once. All bookkeeping is guarded by a lock, so the pool can be shared
+    by a thread pool.
+    """
+
+    def __init__(self, max_open: int = 32):
+        self.max_open = max_open
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._files = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, abam):
+        """
+        Returns the opened alignment file of an alignedBAM, building it only if it is not already in the pool.
+
+        :param abam: Instance of alignedBAM
+        :return: Reader of the backend of abam, see open_reader
+        """
+        key = (abam.ID, abam.backend, threading.get_ident())
+        with self._lock:
+            if key in self._files:
+                self._files.move_to_end(key)
+                self.hits += 1
+                return self._files[key]
+            self.misses += 1
+
+        # Building the alignment file parses the index, so this is done outside of the lock
+        with stage_timer.section("open_file"):
+            alignment_file = open_reader(abam.backend, abam.bam_path, abam.bai_path)
+
+        with self._lock:
+            self._files[key] = alignment_file
+            self._files.move_to_end(key)
+            self._shrink_to(self.max_open)
+        return alignment_file
+
+    def evict(self, bam_ID):
+        """
+        Forgets all opened AlignmentFiles of a bam_ID, in all threads.
+
+        :param bam_ID: ID of the alignedBAM
+        :return: None
+        """
+        with self._lock:
+            for key in [key for key in self._files if key[0] == bam_ID]:
+                del self._files[key]
+                self.evictions += 1
+
+    def resize(self, max_open: int):
+        """
+        Changes the maximal number of open files, evicting the least recently used ones if necessary.
+
+        :param max_open: New maximal number of open files
+        :return: None
+        """
+        with self._lock:
+            self.max_open = max_open
+            self._shrink_to(max_open)
+
+    def clear(self):
+        with self._lock:
+            self._files.clear()
+
+    def stats(self):
+        """
+        :return: Dictionary of hit/miss/eviction counters and the current number of open files
+        """
+        with self._lock:
+            n_requests = self.hits + self.misses
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "n_open": len(self._files), "hit_rate": self.hits / n_requests if n_requests > 0 else 0.}
+
+    def _shrink_to(self, n):
+        # The forgotten files are not closed explicitly, a read iterator still running on them keeps them alive
+        # until it is exhausted, after which the garbage collector takes care of them.
+        while len(self._files) > n:
+            self._files.popitem(last=False)
+            self.evictions += 1
+
+
+# This is the pool shared by all alignedBAM objects of the process. Worker processes each get their own.
+alignment_file_pool = alignmentFilePool()
+
+
+class fetchedRegion:
+    """
+    The reads of a whole region, fetched in one go, so that several nearby positions can be served without
+    going back to the file. fetch returns exactly the reads which bamnostic would return when fetching the
+    position itself, in file order.
+
+    The reads are only fetched once the first position is requested, so a region none of whose positions is needed
+    (e.g. because their tensors are cached) costs nothing.
+    """
+
+    def __init__(self, chromosome: str, start: int, stop: int, fetch_reads):
+        """
+        :param chromosome: Chromosome of the region
+        :param start: Start of the region
+        :param stop: Stop of the region
+        :param fetch_reads: Callable without arguments returning the reads of the whole region
+        """
+        self.chromosome = chromosome
+        self.start = start
+        self.stop = stop
+        self.reads = None
+        self._fetch_reads = fetch_reads
+
+    def load(self):
+        """
+        Fetches the reads of the region now, instead of when the first position is requested.
+        """
+        if self.reads is None:
+            self._load()
+
+    def _load(self):
+        self.reads = list(self._fetch_reads())
+
+        # Reads come sorted by position, which allows bisecting for the ones starting left of a stop position. Reads
+        # starting more than max_read_len left of a position cannot overlap it.
+        self.read_starts = [read.reference_start for read in self.reads]
+        self.read_ends = [read.reference_start + query_length(read) for read in self.reads]
+        self.max_read_len = max([end - begin for begin, end in zip(self.read_starts, self.read_ends)], default=0)
+
+    def covers(self, position):
+        chromosome, start, stop = position
+        return chromosome == self.chromosome and self.start <= start and stop <= self.stop
+
+    def fetch(self, position):
+        """
+        :param position: Tuple of chromosome, start, stop, which must be covered by the region
+        :return: List of reads overlapping position, by the same criterion as bamnostic's fetch
+        """
+        if self.reads is None:
+            self._load()
+
+        chromosome, start, stop = position
+        lo = bisect_left(self.read_starts, start - self.max_read_len)
+        hi = bisect_left(self.read_starts, stop)
+
+        return [self.reads[i] for i in range(lo, hi) if self.read_ends[i] >= start]
+
+
+class readBuffer:
+    """
+    The reads at a single position, pulled from one fetch only as far as they are consumed and kept for later
+    consumers. This way, checking whether there are reads at a position and encoding them afterwards decompresses the
+    reads only once, and a check which stops after a few reads does not decompress the rest.
+    """
+
+    def __init__(self, position, reads):
+        self.position = position
+        self.reads = []
+        self._source = iter(reads)
+
+    def _pull(self):
+        try:
+            self.reads.append(next(self._source))
+            return True
+        except StopIteration:
+            self._source = iter(())
+            return False
+
+    def has_at_least(self, n: int):
+        while len(self.reads) < n:
+            if not self._pull():
+                return False
+        return True
+
+    def __iter__(self):
+        i = 0
+        while i < len(self.reads) or self._pull():
+            yield self.reads[i]
+            i += 1
 
 
 class alignedBAM:
@@ -6,18 +439,27 @@ class alignedBAM:
     This class stores the metadata associated with a bam file and its physical path, as well as
     providing access to additional metadata.
 
-    If speed is an issue, bamnostic (which is written entirely in Python and thus platform-independent)
-    can be replaced by pySAM, however the latter may be more difficult to install, requiring certain C plugins.
+    The reads are accessed either through bamnostic, which is written entirely in Python and thus platform-independent,
+    or through the much faster pySAM, which may however be more difficult to install, requiring certain C plugins.
+    pySAM is used by default if it is installed, see pysamReader for how both give the same reads.
 
-    The methods open_file and close_file are implemented in case RAM is an issue. Since a single bam file might
-    be invoked for many positions, it is much slower to build and destroy the AlignmentFile for every position,
-    but it does mean that the dataset does not have to be held in memory.
+    The methods open_file and close_file check the AlignmentFile in and out of the process-wide alignment_file_pool.
+    Since a single bam file might be invoked for many positions, it is much slower to build and destroy the
+    AlignmentFile for every position, so the pool keeps a bounded number of them open. If RAM is an issue, shrink
+    the pool with alignment_file_pool.resize.
     """
 
-    def __init__(self, ID, bam_path, bai_path, open_immediately=False, **kwargs):
+    def __init__(self, ID, bam_path, bai_path, open_immediately=False, backend=None, **kwargs):
         self.bam_path = bam_path
         self.bai_path = bai_path
         self.ID = ID
+
+        if backend is None:
+            backend = default_backend
+        elif backend == "pysam" and pysam is None:
+            warnings.warn("pySAM is not installed, falling back to bamnostic.")
+            backend = "bamnostic"
+        self.backend = backend
         # Setting the ID and paths to None is a valid option to simulate a BAM that doesn't exist.
 
 
@@ -25,42 +467,122 @@ class alignedBAM:
         self.metadict = kwargs  # The kwargs can, in particular, contain the keys flowcell_ID, library_ID, ...
 
         self.is_opened = False
-        self.alignment_file = None
+        self.fetched_region = None  # Set by fetch_region, to serve nearby positions from memory
+        self.read_buffer = None  # Reads at the last position requested through reads_at
 
         if open_immediately:
             self.open_file()
 
+    def identity(self):
+        """
+        :return: Tuple of ID and paths, e.g. for checkpointedBuild.build_fingerprint. The backend is left out, as both
+                 give the same reads
+        """
+        return self.ID, self.bam_path, self.bai_path
+
+    @property
+    def alignment_file(self):
+        """
+        The AlignmentFile of this bam, taken from the pool (and built if it is not pooled yet).
+        """
+        if self.ID is None:
+            return None
+        return alignment_file_pool.get(self)
+
     def open_file(self):
         """
-        This prompts the sequencing Alignment File to be built in memory
+        This prompts the sequencing Alignment File to be built in memory, or fetched from the pool if it already is.
 
         :return: None
         """
         if self.ID is None:
             raise ValueError("Trying to open a None-abam!")
 
+        alignment_file_pool.get(self)
+        self.is_opened = True
+
+    def close_file(self, evict: bool = False):
+        """
+        This releases the file back to the pool. It is only forgotten once the pool needs room for other files,
+        unless evict is set, in which case it is forgotten immediately to free up RAM.
+
+        :param evict: Whether to remove the file from the pool right away
+        :return: None
+        """
+        if evict:
+            alignment_file_pool.evict(self.ID)
+        self.is_opened = False
+
+    def fetch_region(self, position):
+        """
+        Fetches all reads of a region at once (when the first position inside it is requested) and keeps them, so that
+        fetch can serve any position inside the region without accessing the file again. Call forget_region once the
+        region is no longer needed.
+
+        :param position: Tuple of chromosome, start, stop of the whole region
+        :return: None
+        """
+        self.fetched_region = self.make_region(position)
 
-        if not self.is_opened:
-            self.alignment_file = bamnostic.AlignmentFile(self.bam_path, index_filename=self.bai_path, mode="rb")
-            self.is_opened = True
-        else:
-            pass
+    def make_region(self, position):
+        """
+        Builds a fetchedRegion of this bam without installing it, e.g. so that it can be loaded in a background thread
+        and installed with use_region later.
 
+        :param position: Tuple of chromosome, start, stop of the whole region
+        :return: Instance of fetchedRegion
+        """
+        chromosome, start, stop = position
+        return fetchedRegion(chromosome, start, stop, lambda: self.alignment_file.fetch(*position))
 
-    def close_file(self):
+    def use_region(self, fetched_region):
         """
-        This forgets the file in memory again, and should trigger the garbage collector to free up RAM.
+        Installs a region built by make_region, as if it had been fetched with fetch_region.
 
+        :param fetched_region: Instance of fetchedRegion
         :return: None
         """
-        if self.is_opened:
-            self.alignment_file = None
-            self.is_opened = False
+        self.fetched_region = fetched_region
+        self.read_buffer = None
+
+    def forget_region(self):
+        self.fetched_region = None
+        self.read_buffer = None
+
+    def fetch(self, position):
+        """
+        Returns the reads at a position, taking them from the fetched region if it covers the position. Reads streamed
+        from the file are timed while they are iterated over, as that is when they are decoded.
+
+        :param position: Tuple of chromosome, start, stop
+        :return: Iterable of reads
+        """
+        if self.fetched_region is not None and self.fetched_region.covers(position):
+            with stage_timer.section("fetch"):
+                return self.fetched_region.fetch(position)
+        return stage_timer.timed_iter("fetch", lambda: self.alignment_file.fetch(*position))
+
+    def reads_at(self, position):
+        """
+        Returns the reads at a position as a readBuffer, which is kept until reads at another position are requested.
+        Repeated requests for the same position, e.g. by has_reads and then by singleTensorizer.transform, are thus
+        served by a single fetch.
+
+        As a buffer may hold a fetch that is not exhausted yet, it relies on the alignment file not being used for
+        other positions in between, which is why it is dropped as soon as another position is requested.
+
+        :param position: Tuple of chromosome, start, stop
+        :return: Instance of readBuffer
+        """
+        if self.read_buffer is None or self.read_buffer.position != position:
+            self.read_buffer = readBuffer(position, self.fetch(position))
+        return self.read_buffer
 
+    @stage_timer.timed("has_reads")
     def has_reads(self, position):
         """
-        This function checks whether the alignment file has any reads for a given position.
-        It is very ugly, but has the advantage that it's lazy, and so doesn't need to build everything in memory.
+        This function checks whether the alignment file has any reads for a given position (in fact, more than two).
+        It is lazy, so only the first few reads are decompressed, and they are kept for a subsequent transform.
 
         :param position: Tuple of chromosome, start, stop
         :return: bool
@@ -68,13 +590,4 @@ class alignedBAM:
         if self.ID is None:
             return False
 
-        self.open_file()
-        i = 0
-        for j, read in enumerate(self.alignment_file.fetch(*position)):
-            i += 1
-            if i > 2:
-                self.close_file()
-                return True
-
-        self.close_file()
-        return False
+        return self.reads_at(position).has_at_least(3)
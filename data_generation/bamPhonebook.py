@@ -1,3 +1,4 @@
+import numpy as np
 import pandas as pd
 
 class bamPhonebook:
@@ -13,9 +14,47 @@ class bamPhonebook:
         # TODO: Potentially improve this, instead adding a column in the bambook csv
         self.bam_metadf["type"] = self.bam_metadf["bam_ID"].apply(lambda ID: "CL" if ID[0] == "C" else "GL")
 
+        # Row numbers of all bams of each combination of line, library and type, built once so that the admissible
+        # comparison tracks of a tumour can be found without going through the whole dataframe
+        self.group_index = {key: np.sort(rows) for key, rows in
+                            self.bam_metadf.groupby(["line_ID", "library_ID", "type"], sort=False, dropna=False)
+                            .indices.items()}
+        self._comparison_cache = {}
+
+    def identity(self):
+        """
+        :return: The metadata of all bams, which determines the choice of comparison tracks, e.g. for
+                 checkpointedBuild.build_fingerprint
+        """
+        return self.bam_metadf
+
     def find_path(self, bam_ID):
         return self.bam_metadf.loc[bam_ID, "path"]
 
+    def get_comparison_IDs(self, CL_ID, sameline: bool):
+        """
+        Finds the admissible comparison tracks of a tumour, i.e. the other tumour tracks sequenced with the same
+        library preparation, from either the same or a different transplantation line. The result is cached per
+        tumour.
+
+        :param CL_ID: ID of tumour track
+        :param sameline: Whether to return comparisons from the same line, or from different lines
+        :return: np.array of bam IDs in the order of bam_metadf
+        """
+        key = (CL_ID, sameline)
+        if key not in self._comparison_cache:
+            cl_line = self.bam_metadf.loc[CL_ID, "line_ID"]
+            cl_library = self.bam_metadf.loc[CL_ID, "library_ID"]
+
+            rows = [group_rows for (line, library, bam_type), group_rows in self.group_index.items()
+                    if bam_type == "CL" and library == cl_library and (line == cl_line) == sameline]
+            rows = np.sort(np.concatenate(rows)) if rows else np.zeros(0, dtype=int)
+
+            IDs = self.bam_metadf["bam_ID"].to_numpy(dtype=object)[rows]
+            self._comparison_cache[key] = IDs[IDs != CL_ID]
+
+        return self._comparison_cache[key]
+
 
 def build_bambook_from_csv(path, sep=";", index_col=0, **kwargs):
     return bamPhonebook(pd.read_csv(path, sep=sep, index_col=index_col, **kwargs,
@@ -27,3 +27,13 @@ class bamStruct:
             self.window_len,                      # Width of "read window" considered
             max_reads * (2 + n_comparison_bams),  # 2 for GL and CL, plus all comparisons, each with max_reads reads
             7)                                    # 4 for base-onehot, then base quality, alignment quality, is_reverse
+
+    def tensor_shape(self, stack_axis: int = 2):
+        """
+        :param stack_axis: Axis along which the sequencing tracks are concatenated; 1 stacks along the reads as in
+        single_tensor_shape, 2 along the channels as done for the depth tensors of the manuscript
+        :return: Shape of a composite tensor of this bamStruct
+        """
+        shape = [self.window_len, self.max_reads, 7]
+        shape[stack_axis] *= self.n_bams_total
+        return tuple(shape)
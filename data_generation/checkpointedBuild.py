@@ -0,0 +1,304 @@
+import os
+import json
+import types
+import shutil
+import hashlib
+import functools
+import numpy as np
+import pandas as pd
+from locusScheduler import cluster_loci, pair_bam_IDs
+from parallelTensorizer import iter_shards
+from tensorWriter import tensorWriter
+from raggedTensor import raggedWriter
+
+"""
+This file contains a resumable way of building a dataset. The loci are tensorised in shards of about shard_size loci,
+each written to its own .npy file, and every finished shard is recorded in a manifest together with the outputs and
+failures of its loci. If the build is interrupted, e.g. by an exception or by preemption of the node, running it again
+skips the shards in the manifest. Once all shards are done, they are copied one by one into the usual single .npy
+file, with the same layout as written by tensorWriter.finalize. The final file only has rows for the loci which did not
+fail, so the rows can go straight to their place, and each shard file is removed as soon as it has been copied. Copied
+shards are recorded in the manifest as well, so that an interrupted copy resumes with the next shard.
+
+The manifest is a file of JSON lines, each appended and synced in one go, so that a build interrupted while writing it
+loses at most the line of the last shard. Its first line fingerprints the loci and the settings of the build, including
+the tensorisation function with everything bound to it (see describe_setting), and a manifest not matching the current
+build is discarded.
+
+The file of a shard is only created once the shard is started. Together, the shard files and the final file thus
+never take up much more disk than the finished dataset.
+
+The dataset is stored either densely as by tensorWriter, or as a ragged dataset of only the reads actually present, as
+by raggedTensor.raggedWriter, in which case the shards are ragged datasets as well.
+"""
+
+# Writer classes of the storage formats
+writer_classes = {"dense": tensorWriter, "ragged": raggedWriter}
+
+
+def shard_clusters(clusters: list, shard_size: int):
+    """
+    :param clusters: List of lists of indices into ploci, as returned by cluster_loci
+    :param shard_size: Minimal number of loci per shard, clusters are not split
+    :return: List of shards, each a list of clusters
+    """
+
+    shards = []
+    current = []
+    n_loci = 0
+    for cluster in clusters:
+        current.append(cluster)
+        n_loci += len(cluster)
+        if n_loci >= shard_size:
+            shards.append(current)
+            current = []
+            n_loci = 0
+
+    if current:
+        shards.append(current)
+
+    return shards
+
+
+class shardManifest:
+    """
+    Record of the finished shards of a build, see the description of this file.
+    """
+
+    def __init__(self, path, fingerprint: str):
+        """
+        Constructor, reading the records of an existing manifest at path if it belongs to the same build
+
+        :param path: Path of the manifest file
+        :param fingerprint: Fingerprint of the build, see build_fingerprint
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+        self.shards = {}
+        self.joined = set()
+        self.finalized = False
+
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                lines = f.read().split("\n")
+            records = []
+            for line in lines:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break  # Empty, or the partial last line of an interrupted build
+
+            if records and records[0].get("fingerprint") == fingerprint:
+                for record in records[1:]:
+                    if "finalized" in record:
+                        self.finalized = True
+                    elif "joined" in record:
+                        self.joined.add(record["joined"])
+                    else:
+                        self.shards[record["shard"]] = record
+                return
+
+            print(f"Manifest {path} belongs to a different build, starting over.")
+
+        self.reset()
+
+    def reset(self):
+        self.shards = {}
+        self.joined = set()
+        self.finalized = False
+        self._write({"fingerprint": self.fingerprint}, mode="w")
+
+    def _write(self, record: dict, mode="a"):
+        with open(self.path, mode) as f:
+            f.write(json.dumps(record) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def add_shard(self, s: int, output: list):
+        """
+        :param s: Index of the shard
+        :param output: Output of tensorize_clusters for the shard
+        :return: None
+        """
+        record = {"shard": s,
+                  "results": [[k, result] for k, result, error in output if error is None],
+                  "failures": [[k, error] for k, result, error in output if error is not None]}
+        self._write(record)
+        self.shards[s] = record
+
+    def mark_joined(self, s: int):
+        """
+        :param s: Index of a shard which has been copied into the final file
+        :return: None
+        """
+        self._write({"joined": s})
+        self.joined.add(s)
+
+    def mark_finalized(self):
+        self._write({"finalized": True})
+        self.finalized = True
+
+    def outputs(self, n_rows: int):
+        """
+        :param n_rows: Number of loci of the build
+        :return: results and failures as returned by parallelTensorizer.tensorize_loci
+        """
+        results = [None] * n_rows
+        failures = []
+        for record in self.shards.values():
+            for k, result in record["results"]:
+                results[k] = result
+            failures += [(k, error) for k, error in record["failures"]]
+
+        failures.sort()
+        return results, failures
+
+
+def describe_setting(value):
+    """
+    Stable description of a setting of a build, e.g. the tensorisation function, for build_fingerprint. Unlike repr, it
+    does not depend on memory addresses. Functions are described by their qualified name, functools.partial objects by
+    their function and the arguments bound to it, arrays and tables by a digest of their contents, and objects with an
+    identity method (e.g. singleTensorizer, bamPhonebook, coverageMatrix, alignedBAM) by what it returns. Other objects
+    are described by their public attributes.
+
+    :param value: Any setting
+    :return: Nested structure of strings, lists and tuples, whose repr identifies the setting
+    """
+    if isinstance(value, functools.partial):
+        return "partial", describe_setting(value.func), describe_setting(value.args), describe_setting(value.keywords)
+    if isinstance(value, types.MethodType):
+        return "method", describe_setting(value.__func__), describe_setting(value.__self__)
+    if isinstance(value, (types.FunctionType, types.BuiltinFunctionType, type)):
+        return f"{value.__module__}.{value.__qualname__}"
+    if hasattr(value, "identity"):
+        return type(value).__name__, describe_setting(value.identity())
+    if isinstance(value, dict):
+        return sorted((repr(key), describe_setting(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [describe_setting(item) for item in value]
+    if isinstance(value, np.ndarray):
+        if value.dtype == object:
+            return describe_setting(value.tolist())
+        return value.dtype.str, value.shape, hashlib.sha1(np.ascontiguousarray(value).tobytes()).hexdigest()
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return hashlib.sha1(value.to_csv().encode()).hexdigest()
+    if hasattr(value, "__dict__"):
+        return type(value).__name__, describe_setting({name: item for name, item in vars(value).items()
+                                                       if not name.startswith("_")})
+    return repr(value)
+
+
+def build_fingerprint(ploci: list, *settings):
+    """
+    :param ploci: List of pairLocus objects
+    :param settings: Further settings which must not change while resuming, e.g. shape and dtype of the tensors
+    :return: Hex digest identifying the loci and settings
+    """
+    h = hashlib.sha1()
+    for pl in ploci:
+        h.update(repr(pl.idtuple).encode())
+    h.update(repr(settings).encode())
+    return h.hexdigest()
+
+
+def remove_dataset(path):
+    if os.path.isdir(path):
+        shutil.rmtree(path)
+    else:
+        os.remove(path)
+
+
+def build_checkpointed(ploci: list, tensorize_fn, abam_dict: dict, path, row_shape: tuple, dtype=np.float64,
+                       labels=None, labels_path=None, loci_path=None, shard_folder=None, shard_size: int = 1000,
+                       n_workers: int = 1, bam_IDs_fn=pair_bam_IDs, base_seed: int = 42, prefetch_depth: int = 0,
+                       is_cached=None, keep_shards: bool = False, storage: str = "dense", **cluster_kwargs):
+    """
+    Top-level function to build a dataset in resumable shards, see the description of this file. Gives the same
+    files as tensorising with parallelTensorizer.tensorize_loci into a tensorWriter and finalizing it.
+
+    :param ploci: List of pairLocus objects
+    :param tensorize_fn: Callable taking a pairLocus, e.g. a functools.partial of nocontext_depth_tensorize_plocus
+    :param abam_dict: Dictionary linking BAM IDs to alignedBAM objects
+    :param path: Path of the final .npy file, or of the folder of a ragged dataset
+    :param row_shape: Shape of a single tensor, e.g. from bamStruct.tensor_shape
+    :param dtype: dtype of the stored tensors
+    :param labels: Labels of all loci, see tensorWriter.finalize
+    :param labels_path: Optional path of a .npy file of labels of the kept loci
+    :param loci_path: Optional path of a csv file with the IDs of the kept loci
+    :param shard_folder: Folder of the shard files and the manifest, by default next to path
+    :param shard_size: Minimal number of loci per shard
+    :param n_workers: Number of worker processes
+    :param bam_IDs_fn: Callable taking a pairLocus and returning the IDs of the BAMs worth fetching for it
+    :param base_seed: Seed from which the per-locus seeds are derived
+    :param prefetch_depth: See parallelTensorizer.tensorize_clusters
+    :param is_cached: See parallelTensorizer.tensorize_clusters
+    :param keep_shards: Whether to keep the shard files once they are copied into the final file
+    :param storage: "dense" to write a .npy file with tensorWriter, "ragged" to write a ragged dataset with raggedWriter
+    :param cluster_kwargs: Passed on to cluster_loci, i.e. max_gap and max_span
+    :return: The finished dataset, opened read-only as np.memmap or raggedTensor; results and failures as from
+             tensorize_loci
+    """
+
+    if shard_folder is None:
+        shard_folder = os.path.splitext(path)[0] + "_shards"
+    os.makedirs(shard_folder, exist_ok=True)
+
+    writer_cls = writer_classes[storage]
+    row_shape = tuple(row_shape)
+    dtype = np.dtype(dtype)
+    fingerprint = build_fingerprint(ploci, describe_setting(tensorize_fn), row_shape, dtype.str, shard_size, base_seed,
+                                    sorted(cluster_kwargs.items()), storage)
+    manifest = shardManifest(os.path.join(shard_folder, "manifest.jsonl"), fingerprint)
+
+    if manifest.finalized and os.path.exists(path):
+        print(f"{path} was already built, skipping.")
+        results, failures = manifest.outputs(len(ploci))
+        return writer_cls.open(path), results, failures
+
+    if manifest.joined and not os.path.exists(path):
+        print(f"{path} is missing, but shards were already copied into it, starting over.")
+        manifest.reset()
+
+    shards = shard_clusters(cluster_loci(ploci, **cluster_kwargs), shard_size)
+    shard_indices = [sorted(k for cluster in shard for k in cluster) for shard in shards]
+    shard_paths = [os.path.join(shard_folder, f"shard_{s:05d}{writer_cls.suffix}") for s in range(len(shards))]
+
+    pending = [s for s in range(len(shards)) if s not in manifest.shards]
+    if len(pending) < len(shards):
+        print(f"Resuming: {len(shards) - len(pending)} of {len(shards)} shards are already done.")
+
+    # The shard files are only created when their shard is started, by the process tensorising it
+    shard_writers = [functools.partial(writer_cls, shard_paths[s], n_rows=len(shard_indices[s]), row_shape=row_shape,
+                                       dtype=dtype, indices=shard_indices[s]) for s in pending]
+    for p, output in iter_shards([shards[s] for s in pending], ploci, tensorize_fn, abam_dict, n_workers=n_workers,
+                                 bam_IDs_fn=bam_IDs_fn, base_seed=base_seed, shard_writers=shard_writers,
+                                 prefetch_depth=prefetch_depth, is_cached=is_cached):
+        manifest.add_shard(pending[p], output)
+        print(f"Shard {pending[p] + 1} of {len(shards)} done.")
+
+    # Copy the shards one by one into the final file, which has rows for the kept loci only, and which is then
+    # finalized as usual. Every shard is removed as soon as it has been copied and the final file is flushed, so
+    # that the build never needs disk for much more than the finished dataset. If this is interrupted, the final file is
+    # reopened, and the copying goes on with the first shard not recorded as copied in the manifest.
+    results, failures = manifest.outputs(len(ploci))
+    failed = {k for k, error in failures}
+    kept = [k for k in range(len(ploci)) if k not in failed]
+
+    writer = writer_cls(path, n_rows=len(kept), row_shape=row_shape, dtype=dtype, labels_path=labels_path,
+                        loci_path=loci_path, indices=kept, resume=len(manifest.joined) > 0)
+    for s in range(len(shards)):
+        if s in manifest.joined:
+            continue
+        shard = writer_cls.open(shard_paths[s])
+        writer.write_shard(shard, shard_indices[s], skip=failed)
+        del shard
+        writer.flush()
+        manifest.mark_joined(s)
+        if not keep_shards:
+            remove_dataset(shard_paths[s])
+
+    tensor = writer.finalize(kept, labels=labels, ploci=ploci)
+    manifest.mark_finalized()
+
+    return tensor, results, failures
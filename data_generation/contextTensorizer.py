@@ -1,8 +1,9 @@
 import numpy as np
-import pandas as pd
 from pairLocus import pairLocus
 from singleTensorizer import singleTensorizer
 from bamPhonebook import bamPhonebook
+from coverageMatrix import coverageMatrix
+from stageTimer import stage_timer
 
 np.random.seed(42)
 
@@ -48,51 +49,36 @@ def tensorize_list(stensorizer: singleTensorizer, position: tuple, abam_list: li
                           axis=stack_axis)
 
 
-def get_diffline_comparison_mask(metadf: pd.DataFrame, cl_line: str, cl_library: str, own_cl_ID: str):
+def choose_comparison_IDs(admissible_IDs, position: tuple, abam_dict: dict, k: int, coverage: coverageMatrix = None):
     """
-    Utility function to obtain masks of admissible comparison tracks of a different transplantation line from tumour,
-    but sequenced with the same library preparation.
-
-    :param metadf: Metadata stored in a pandas dataframe; columns including 'bam_ID', 'line_ID', 'library_ID', 'type'
-    :param cl_line: ID of transplantation line of tumour
-    :param cl_library: ID of library preparation of tumour
-    :param own_cl_ID: ID of tumour track
-    :return: Boolean mask of same length as the index of metadf, indicating tracks which are from
-    """
-
-
-    diffline_mask = metadf["line_ID"] != cl_line
-    samelib_mask = metadf["library_ID"] == cl_library
-    type_mask = metadf["type"] == "CL"
-    not_self_mask = metadf["bam_ID"] != own_cl_ID
+    Utility function to randomly choose k comparison tracks among the admissible ones which have reads at the given
+    position, padding with None if there are not enough. Whether a track has reads is looked up in the coverage
+    matrix if one is given, and only checked on the BAM itself if the matrix does not know.
 
-    return np.logical_and.reduce([diffline_mask, samelib_mask, type_mask, not_self_mask])
-
-
-def get_sameline_comparison_mask(metadf, cl_line, cl_library, own_cl_ID):
-    """
-    Utility function to obtain masks of admissible comparison tracks of a same transplantation line as tumour,
-    and sequenced with the same library preparation.
-
-    :param metadf: Metadata stored in a pandas dataframe; columns including 'bam_ID', 'line_ID', 'library_ID', 'type'
-    :param cl_line: ID of transplantation line of tumour
-    :param cl_library: ID of library preparation of tumour
-    :param own_cl_ID: ID of tumour track
-    :return: Boolean mask of same length as the index of metadf, indicating tracks which are from
+    :param admissible_IDs: np.array of IDs of admissible comparison tracks, as from bamPhonebook.get_comparison_IDs
+    :param position: Tuple of chromosome, start, stop
+    :param abam_dict: Dictionary linking BAM IDs to alignedBAM objects
+    :param k: Number of comparison tracks to choose
+    :param coverage: Optional coverageMatrix for the position and the admissible tracks
+    :return: List of k IDs, possibly containing None
     """
 
+    def has_reads(ID):
+        covered = coverage.has_reads(ID, position) if coverage is not None else None
+        return covered if covered is not None else abam_dict[ID].has_reads(position)
 
-    sameline_mask = metadf["line_ID"] == cl_line
-    samelib_mask = metadf["library_ID"] == cl_library
-    type_mask = metadf["type"] == "CL"
-    not_self_mask = metadf["bam_ID"] != own_cl_ID
+    possible_IDs = np.array([ID for ID in admissible_IDs if has_reads(ID)], dtype=object)
 
-    return np.logical_and.reduce([sameline_mask, samelib_mask, type_mask, not_self_mask])
+    if len(possible_IDs) >= k:
+        return list(np.random.choice(possible_IDs, size=k, replace=False))
+    else:
+        return list(possible_IDs) + [None] * (k - len(possible_IDs))
 
 
 def random_context_tensorize_once(stensorizer: singleTensorizer, plocus: pairLocus, label,
                                   bambook: bamPhonebook, abam_dict: dict,
-                                  k_diffline_samelib: int, k_sameline_samelib: int, stack_axis=2):
+                                  k_diffline_samelib: int, k_sameline_samelib: int, stack_axis=2,
+                                  coverage: coverageMatrix = None):
     """
     Top-level function to context-tensorize a candidate variant with a random choice of context tracks among the ones
     which are admissible.
@@ -104,10 +90,11 @@ def random_context_tensorize_once(stensorizer: singleTensorizer, plocus: pairLoc
     :param label: Class label of pairLocus, taken only for compatibility and unused
     :param bambook: Instance of bamPhonebook, storing physical locations of sequencing data for tensorisation
     :param abam_dict: abam_dict: Dictionary linking BAM IDs to alignedBAM objects
-    :param k_diffline_samelib:
-    :param k_sameline_samelib:
+    :param k_diffline_samelib: Number of comparison tracks from a different line, with the same library preparation
+    :param k_sameline_samelib: Number of comparison tracks from the same line, with the same library preparation
     :param stack_axis: Axis along which tracks are concatenated, should be 2 for depth concatenation as outlined in the
     manuscript.
+    :param coverage: Optional coverageMatrix, consulted instead of the BAMs to find comparison tracks with reads
     :return: Tensorised np.ndarray with germline, tumour and comparison tracks concatenated along stack_axis
     """
 
@@ -125,41 +112,20 @@ def random_context_tensorize_once(stensorizer: singleTensorizer, plocus: pairLoc
     # For each of the comparison blocks, we first obtain all admissible comparisons, then randomly choose the required
     # number, then store the IDs for tensorisation.
 
-    # Comparison bams from different line:
-    if k_diffline_samelib > 0:
-        diffline_comparison_mask = get_diffline_comparison_mask(metadf=bambook.bam_metadf, cl_line=cl_line,
-                                                                cl_library=cl_library, own_cl_ID=CL_ID)
-        possible_diffline_comparison_df = bambook.bam_metadf.loc[diffline_comparison_mask, :]
-        for ID in possible_diffline_comparison_df.index:
-            if not abam_dict[ID].has_reads(plocus.position):
-                possible_diffline_comparison_df.drop(ID, axis=0, inplace=True)
-
-        if len(possible_diffline_comparison_df) >= k_diffline_samelib:
-            diffline_comp_IDs = list(
-                np.random.choice(possible_diffline_comparison_df.index, size=k_diffline_samelib, replace=False))
+    with stage_timer.section("context_selection"):
+        # Comparison bams from different line:
+        if k_diffline_samelib > 0:
+            diffline_comp_IDs = choose_comparison_IDs(bambook.get_comparison_IDs(CL_ID, sameline=False),
+                                                      plocus.position, abam_dict, k_diffline_samelib, coverage)
         else:
-            n_missing_diffline = k_diffline_samelib - len(possible_diffline_comparison_df)
-            diffline_comp_IDs = list(possible_diffline_comparison_df.index) + [None] * n_missing_diffline
-    else:
-        diffline_comp_IDs = []
-
-    # Comparison bams from same line:
-    if k_sameline_samelib > 0:
-        sameline_comparison_mask = get_sameline_comparison_mask(metadf=bambook.bam_metadf, cl_line=cl_line,
-                                                                cl_library=cl_library, own_cl_ID=CL_ID)
-        possible_sameline_comparison_df = bambook.bam_metadf.loc[sameline_comparison_mask, :]
-        for ID in possible_sameline_comparison_df.index:
-            if not abam_dict[ID].has_reads(plocus.position):
-                possible_sameline_comparison_df.drop(ID, axis=0, inplace=True)
-
-        if len(possible_sameline_comparison_df) >= k_sameline_samelib:
-            sameline_comp_IDs = list(
-                np.random.choice(possible_sameline_comparison_df.index, size=k_sameline_samelib, replace=False))
+            diffline_comp_IDs = []
+
+        # Comparison bams from same line:
+        if k_sameline_samelib > 0:
+            sameline_comp_IDs = choose_comparison_IDs(bambook.get_comparison_IDs(CL_ID, sameline=True),
+                                                      plocus.position, abam_dict, k_sameline_samelib, coverage)
         else:
-            n_missing_sameline = k_sameline_samelib - len(possible_sameline_comparison_df)
-            sameline_comp_IDs = list(possible_sameline_comparison_df.index) + [None] * n_missing_sameline
-    else:
-        sameline_comp_IDs = []
+            sameline_comp_IDs = []
 
 
     # Finally, tensorize and return
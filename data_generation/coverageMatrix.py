@@ -0,0 +1,203 @@
+import os
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from alignedBAM import alignedBAM, alignment_file_pool
+
+"""
+This file contains utilities to precompute which BAMs have reads at which candidate positions. Context selection in
+random_context_tensorize_once needs to know this for every admissible comparison track of every locus, and asking
+alignedBAM.has_reads for each pair costs a fetch per (locus, BAM). Instead, each BAM is swept once over the sorted
+candidate positions, fetching one region per run of nearby positions, and the answers are stored as a boolean
+loci x BAMs matrix which can be saved next to the ploci.
+"""
+
+# Set right before the worker processes are forked, as in parallelTensorizer
+_shared = None
+
+
+def position_runs(positions: list, max_gap: int = 1000, max_span: int = 100000):
+    """
+    Groups sorted positions into runs which can share one region fetch, in the same way as cluster_loci.
+
+    :param positions: List of (chromosome, start, stop) tuples, sorted by chromosome and start
+    :param max_gap: Maximal distance between consecutive positions of a run
+    :param max_span: Maximal distance between the first and last position of a run
+    :return: List of lists of indices into positions
+    """
+
+    runs = []
+    current = []
+    for k, (chromosome, start, stop) in enumerate(positions):
+        if current:
+            first, last = positions[current[0]], positions[current[-1]]
+            if chromosome == last[0] and start - last[2] <= max_gap and stop - first[1] <= max_span:
+                current.append(k)
+                continue
+            runs.append(current)
+        current = [k]
+
+    if current:
+        runs.append(current)
+
+    return runs
+
+
+def sweep_bam(abam: alignedBAM, positions: list, runs: list):
+    """
+    Checks for all positions whether abam has reads there, by the same criterion as alignedBAM.has_reads.
+
+    :param abam: alignedBAM object
+    :param positions: List of (chromosome, start, stop) tuples, sorted by chromosome and start
+    :param runs: Runs of positions, as returned by position_runs
+    :return: covered, bool np.ndarray of whether there are reads at each position; and known, bool np.ndarray of
+             whether the position could be checked at all, which fails e.g. for chromosomes missing from the BAM
+    """
+
+    covered = np.zeros(len(positions), dtype=bool)
+    known = np.zeros(len(positions), dtype=bool)
+
+    for run in runs:
+        chromosome = positions[run[0]][0]
+        region = (chromosome, positions[run[0]][1], max(positions[k][2] for k in run))
+        try:
+            abam.fetch_region(region)
+            for k in run:
+                covered[k] = abam.has_reads(positions[k])
+                known[k] = True
+        except (KeyError, ValueError, OSError):
+            pass  # Left unknown, so that has_reads runs into the problem again at tensorisation time
+        finally:
+            abam.forget_region()
+
+    return covered, known
+
+
+def _init_worker():
+    alignment_file_pool.clear()
+
+
+def _sweep_column(bam_ID):
+    abam_dict, positions, runs = _shared
+    return sweep_bam(abam_dict[bam_ID], positions, runs)
+
+
+class coverageMatrix:
+    """
+    Boolean matrix of whether BAMs have reads at candidate positions, with one row per distinct position and one
+    column per BAM.
+    """
+
+    def __init__(self, positions: list, bam_IDs: list, covered: np.ndarray, known: np.ndarray):
+        """
+        Constructor
+
+        :param positions: List of (chromosome, start, stop) tuples, one per row
+        :param bam_IDs: List of BAM IDs, one per column
+        :param covered: bool np.ndarray of shape (len(positions), len(bam_IDs))
+        :param known: bool np.ndarray of the same shape, False where the coverage could not be determined
+        """
+        self.positions = [(str(chromosome), int(start), int(stop)) for chromosome, start, stop in positions]
+        self.bam_IDs = [str(bam_ID) for bam_ID in bam_IDs]
+        self.covered = covered
+        self.known = known
+
+        self.row_of = {position: k for k, position in enumerate(self.positions)}
+        self.column_of = {bam_ID: j for j, bam_ID in enumerate(self.bam_IDs)}
+
+    def has_reads(self, bam_ID, position):
+        """
+        :param bam_ID: ID of a BAM
+        :param position: Tuple of chromosome, start, stop
+        :return: Whether the BAM has reads at the position, or None if this is not stored in the matrix
+        """
+        k = self.row_of.get(position)
+        j = self.column_of.get(bam_ID)
+        if k is None or j is None or not self.known[k, j]:
+            return None
+
+        return bool(self.covered[k, j])
+
+    def matches(self, positions: list, bam_IDs: list):
+        return self.positions == sorted(set(positions)) and self.bam_IDs == list(bam_IDs)
+
+    def arrays(self):
+        """
+        :return: Dictionary of the arrays making up the matrix, as stored by save
+        """
+        chromosomes, starts, stops = zip(*self.positions) if self.positions else ((), (), ())
+        return {"chromosomes": np.array(chromosomes, dtype=str), "starts": np.array(starts, dtype=np.int64),
+                "stops": np.array(stops, dtype=np.int64), "bam_IDs": np.array(self.bam_IDs, dtype=str),
+                "covered": self.covered, "known": self.known}
+
+    def identity(self):
+        """
+        :return: The arrays of the matrix, e.g. for checkpointedBuild.build_fingerprint
+        """
+        return self.arrays()
+
+    def save(self, path):
+        np.savez(path, **self.arrays())
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            positions = list(zip(f["chromosomes"].tolist(), f["starts"].tolist(), f["stops"].tolist()))
+            return cls(positions, f["bam_IDs"].tolist(), f["covered"], f["known"])
+
+
+def build_coverage_matrix(ploci: list, abam_dict: dict, bam_IDs: list, n_workers: int = 1,
+                          max_gap: int = 1000, max_span: int = 100000):
+    """
+    Sweeps each of the given BAMs once over the sorted distinct positions of ploci.
+
+    :param ploci: List of pairLocus objects
+    :param abam_dict: Dictionary linking BAM IDs to alignedBAM objects
+    :param bam_IDs: IDs of the BAMs to be swept, e.g. all tumour tracks which can serve as comparisons
+    :param n_workers: Number of worker processes, each sweeping whole BAMs
+    :param max_gap: See position_runs
+    :param max_span: See position_runs
+    :return: coverageMatrix
+    """
+    global _shared
+
+    positions = sorted({pl.position for pl in ploci})
+    runs = position_runs(positions, max_gap=max_gap, max_span=max_span)
+
+    if n_workers <= 1:
+        columns = [sweep_bam(abam_dict[bam_ID], positions, runs) for bam_ID in bam_IDs]
+    else:
+        _shared = (abam_dict, positions, runs)
+        try:
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("fork"),
+                                     initializer=_init_worker) as executor:
+                columns = list(executor.map(_sweep_column, bam_IDs))
+        finally:
+            _shared = None
+
+    covered = np.zeros((len(positions), len(bam_IDs)), dtype=bool)
+    known = np.zeros((len(positions), len(bam_IDs)), dtype=bool)
+    for j, (column_covered, column_known) in enumerate(columns):
+        covered[:, j] = column_covered
+        known[:, j] = column_known
+
+    return coverageMatrix(positions, bam_IDs, covered, known)
+
+
+def load_or_build_coverage_matrix(path, ploci: list, abam_dict: dict, bam_IDs: list, **kwargs):
+    """
+    Loads the coverage matrix stored at path if it belongs to the same positions and BAMs, and otherwise builds it
+    with build_coverage_matrix and stores it there.
+
+    :param path: Path of the .npz file of the matrix
+    :return: coverageMatrix
+    """
+
+    if os.path.exists(path):
+        coverage = coverageMatrix.load(path)
+        if coverage.matches([pl.position for pl in ploci], bam_IDs):
+            return coverage
+
+    coverage = build_coverage_matrix(ploci, abam_dict, bam_IDs, **kwargs)
+    coverage.save(path)
+    return coverage
@@ -0,0 +1,115 @@
+import numpy as np
+import pandas as pd
+from locusTable import locusTable
+
+"""
+This file contains the exclusion of candidate variants lying in blacklisted regions, e.g. transduced DNA, repeat masks
+or segmental duplications. A locus is excluded if it lies entirely within one of the regions, i.e. if the region
+starts at or before the start of the locus and stops at or after its stop.
+
+Regions are given in the coordinates of pairLocus, i.e. (chromosome, start, stop) with 1-based start and stop one
+past the last base, or read from BED files, whose 0-based half-open intervals are shifted by one accordingly.
+Per chromosome, the regions are sorted by start, together with the running maximum of their stops. The regions
+starting at or before a locus are then a prefix found by binary search, and the locus lies in one of them if the
+running maximum at the end of that prefix reaches its stop, so that whole tables of loci are filtered with one
+searchsorted per chromosome.
+"""
+
+
+def load_bed(path):
+    """
+    :param path: Path to a BED file, of which the first three columns are used. Header lines (track, browser, #) are
+                 skipped
+    :return: List of (chromosome, start, stop) regions in the coordinates of pairLocus
+    """
+    bed = pd.read_csv(path, sep="\t", header=None, usecols=[0, 1, 2], names=["chrom", "start", "end"],
+                      dtype=str, comment="#")
+    starts = pd.to_numeric(bed["start"], errors="coerce")
+    ends = pd.to_numeric(bed["end"], errors="coerce")
+    valid = (starts.notna() & ends.notna()).to_numpy()
+    return list(zip(bed["chrom"][valid].tolist(), (starts[valid].astype(np.int64) + 1).tolist(),
+                    (ends[valid].astype(np.int64) + 1).tolist()))
+
+
+class exclusionRegions:
+    """
+    Per-chromosome interval index of blacklisted regions, see the description of this file.
+    """
+
+    def __init__(self, regions: list):
+        """
+        Constructor
+
+        :param regions: List of (chromosome, start, stop) regions in the coordinates of pairLocus
+        """
+        self.n_regions = len(regions)
+        by_chromosome = {}
+        for chromosome, start, stop in regions:
+            by_chromosome.setdefault(chromosome, []).append((start, stop))
+
+        self.starts = {}
+        self.max_stops = {}
+        for chromosome, intervals in by_chromosome.items():
+            intervals = np.array(sorted(intervals), dtype=np.int64)
+            self.starts[chromosome] = intervals[:, 0]
+            self.max_stops[chromosome] = np.maximum.accumulate(intervals[:, 1])
+
+    @classmethod
+    def from_bed(cls, paths: list, regions: list = ()):
+        """
+        :param paths: List of paths to BED files
+        :param regions: Further regions in the coordinates of pairLocus
+        :return: exclusionRegions of all regions
+        """
+        all_regions = list(regions)
+        for path in paths:
+            all_regions += load_bed(path)
+        return cls(all_regions)
+
+    def _contained(self, chromosome, starts: np.ndarray, stops: np.ndarray):
+        if chromosome not in self.starts:
+            return np.zeros(len(starts), dtype=bool)
+        last = np.searchsorted(self.starts[chromosome], starts, side="right") - 1
+        return (last >= 0) & (self.max_stops[chromosome][np.maximum(last, 0)] >= stops)
+
+    def mask(self, chromosomes, starts, stops):
+        """
+        :param chromosomes: Array of the chromosomes of the loci
+        :param starts: Array of the starts of the loci
+        :param stops: Array of the stops of the loci
+        :return: Boolean array, True for the loci lying in a region
+        """
+        chromosomes = np.asarray(chromosomes, dtype=object)
+        starts = np.asarray(starts, dtype=np.int64)
+        stops = np.asarray(stops, dtype=np.int64)
+
+        excluded = np.zeros(len(starts), dtype=bool)
+        for chromosome in self.starts:
+            rows = np.flatnonzero(chromosomes == chromosome)
+            excluded[rows] = self._contained(chromosome, starts[rows], stops[rows])
+        return excluded
+
+    def mask_table(self, table: locusTable):
+        """
+        :param table: locusTable of loci
+        :return: Boolean array, True for the loci lying in a region
+        """
+        excluded = np.zeros(len(table), dtype=bool)
+        for chromosome, rows in table.groups("chromosome").items():
+            if chromosome in self.starts:
+                excluded[rows] = self._contained(chromosome, table.starts[rows], table.stops[rows])
+        return excluded
+
+    def mask_ploci(self, ploci: list):
+        """
+        :param ploci: List of pairLocus objects
+        :return: Boolean array, True for the loci lying in a region
+        """
+        return self.mask([pl.chromosome for pl in ploci], [pl.start for pl in ploci], [pl.stop for pl in ploci])
+
+    def filter_ploci(self, ploci: list):
+        """
+        :param ploci: List of pairLocus objects
+        :return: List of the loci not lying in any region, in their original order
+        """
+        return [pl for pl, excluded in zip(ploci, self.mask_ploci(ploci)) if not excluded]
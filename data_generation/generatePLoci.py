@@ -1,13 +1,29 @@
+import csv
+import multiprocessing
 import pandas as pd
 import warnings
+from concurrent.futures import ProcessPoolExecutor
 from pairLocus import pairLocus
+from lazyPloci import lazyPloci
 from validatedSNPlist import build_validatedSNPlist
 
 """
 This file contains utilities for parsing ANNOVAR output files (which are comma-separated) into lists of pairLocus.
 We utilise the pandas CSV engine for convenience (to minimise dependencies, this could of course be replaced).
+
+Files are read column-wise in one pass into a pd.DataFrame of calls, with columns named as the arguments of the
+pairLocus constructor. Filtering by category and removal of indels are masks over these columns, and labels are a
+join against the index of confirmed calls. The pairLocus objects themselves are built at the end, or only on access
+with lazy=True, see lazyPloci.
 """
 
+# Columns of ANNOVAR csv files and of .multianno files, and the arguments of pairLocus they are passed as
+annovar_columns = {"Chr": "chromosome", "Start": "start", "End": "stop", "Ref": "ref", "Alt": "alt",
+                   "Func.RefGene": "funcrefgene"}
+multianno_columns = {"Chr": "chromosome", "Start": "start", "End": "stop", "Ref": "ref", "Alt": "alt",
+                     "Func.refGene": "funcrefgene", "Gene.refGene": "gene", "GeneDetail.refGene": "gene_detail",
+                     "ExonicFunc.refGene": "exonic_func"}
+
 def pairLocus_from_call(GL_ID: str, CL_ID: str, call: pd.Series):
     """
     Constructs a pairLocus object from a single line of a pd.DataFrame representing a candidate variant.
@@ -21,6 +37,37 @@ def pairLocus_from_call(GL_ID: str, CL_ID: str, call: pd.Series):
                      chromosome=call["Chr"], start=call["Start"], stop=call["End"] + 1,
                      funcrefgene=call["Func.RefGene"])
 
+def read_annovar_calls(annovar_path, GL_ID: str, CL_ID: str):
+    """
+    Reads an ANNOVAR output file into a pd.DataFrame of calls, see the description of this file.
+
+    :param annovar_path: Path to ANNOVAR output file of annotated candidate variants
+    :param GL_ID: ID of germline sample
+    :param CL_ID: ID of tumour sample
+    :return: pd.DataFrame of calls, one per row
+    """
+    dtype_dict = {"Chr": str, "Start": int, "End": int}
+    calls = pd.read_csv(annovar_path, sep=",", dtype=dtype_dict, usecols=list(annovar_columns))
+    calls = calls[list(annovar_columns)].rename(columns=annovar_columns)
+    calls["stop"] += 1  # As in pairLocus_from_call
+    calls.insert(0, "GL_ID", GL_ID)
+    calls.insert(1, "CL_ID", CL_ID)
+    return calls
+
+
+def filter_calls(calls: pd.DataFrame, cats_used: list, kick_indels: bool = False):
+    """
+    :param calls: pd.DataFrame of calls, as from read_annovar_calls
+    :param cats_used: List of admissible entries for the 'Func.RefGene' column of ANNOVAR output.
+    :param kick_indels: Whether to remove calls with a '-' as reference or alternative
+    :return: The calls passing the filters, in their original order
+    """
+    mask = calls["funcrefgene"].isin(cats_used)
+    if kick_indels:
+        mask &= (calls["ref"] != "-") & (calls["alt"] != "-")
+    return calls[mask.to_numpy()].reset_index(drop=True)
+
+
 def processAnnovar(GL_ID: str, CL_ID: str, annovar_path, snplist_path, cats_used: list, **kwargs):
     """
 
@@ -30,26 +77,22 @@ def processAnnovar(GL_ID: str, CL_ID: str, annovar_path, snplist_path, cats_used
     :param snplist_path: Path to .xlsx file of manually confirmed variants, formatted as in the documentation
                          of validatedSNPlist.build_validatedSNPlist
     :param cats_used: List of admissible entries for the 'Func.RefGene' column of ANNOVAR output.
-    :param kwargs:
+    :param kwargs: kick_indels removes indels, and lazy returns a lazyPloci instead of a list
     :return: filt_ploci, a list of pairLocus objects representing candidate variants;
              and labels, a list of bools where 1 is a genuine mutation, and 0 is a sequencing artefact
     """
 
-    # First, get all calls from the annovar file
-    dtype_dict = {"Chr": str, "Start": int, "End": int}
-    all_calls = pd.read_csv(annovar_path, sep=",", dtype=dtype_dict)
+    # First, get all calls from the annovar file, then filter for categories used
+    calls = read_annovar_calls(annovar_path, GL_ID=GL_ID, CL_ID=CL_ID)
+    calls = filter_calls(calls, cats_used, kick_indels=kwargs.get("kick_indels", False))
 
-    # Construct pairLocus objects from each call, then filter for categories used
-    ploci = [pairLocus_from_call(GL_ID=GL_ID, CL_ID=CL_ID, call=row) for k, row in all_calls.iterrows()]
-    filt_ploci = list(filter(lambda pl: pl.funcrefgene in cats_used, ploci))
-
-    if kwargs.get("kick_indels", False):
-        filt_ploci = list(filter(lambda pl: "-" not in [pl.ref, pl.alt], filt_ploci))  # Kick indels
-
-    # Construct list of validated mutations, get labels by associated is_present method
+    # Construct list of validated mutations, get labels by a join against its index
     vsnpl = build_validatedSNPlist(GL_ID=GL_ID, CL_ID=CL_ID, snplist_xlsx_path=snplist_path)
-    labels = list(map(vsnpl.is_present, filt_ploci))
-    labels = list(map(int, labels))
+    labels = vsnpl.index.isin_table(calls).astype(int).tolist()
+
+    filt_ploci = lazyPloci(calls)
+    if not kwargs.get("lazy", False):
+        filt_ploci = filt_ploci.materialize()
 
     return filt_ploci, labels
 
@@ -60,7 +103,19 @@ cats_used_global = ["exonic", "ncRNA_exonic", "splicing", "UTR3", "UTR5",
 # into a modular argument.
 
 
-def get_ploci_from_annovarlist(annovarlist_path, pandas_csv_kwargs=None, **kwargs):
+def _process_annovar_pair(pair: tuple, kwargs: dict):
+    # Runs in a worker process of get_ploci_from_annovarlist. The loci come back as a lazyPloci, whose DataFrame
+    # pickles much faster than a list of pairLocus objects, and skippable errors are returned to be warned about in
+    # order.
+    GL_ID, CL_ID, annovar_path, snplist_path = pair
+    try:
+        return processAnnovar(GL_ID=GL_ID, CL_ID=CL_ID, annovar_path=annovar_path, snplist_path=snplist_path,
+                              cats_used=cats_used_global, **{**kwargs, "lazy": True}), None
+    except (ValueError, FileNotFoundError) as e:
+        return None, e
+
+
+def get_ploci_from_annovarlist(annovarlist_path, pandas_csv_kwargs=None, n_workers: int = 1, **kwargs):
     """
     Top-level function which takes a csv-format list of ANNOVAR output files and their corresponding spreadsheets of
     confirmed calls, and returns tensorization-ready data.
@@ -72,8 +127,10 @@ def get_ploci_from_annovarlist(annovarlist_path, pandas_csv_kwargs=None, **kwarg
             annovar_path: path to ANNOVAR output file
             snplist_path: path to .xlsx file, formatted as in the documentation of validatedSNPlist.build_validatedSNPlist
     :param pandas_csv_kwargs: kwargs to be passed to pd.read_csv in parsing the annovarlist
-    :param kwargs: Keyword arguments, passed to processAnnovar, currently only kick_indels will have an impact.
-    :return: ploci, list of variant calls represented as pairLocus objects,
+    :param n_workers: Number of worker processes parsing pairs of files concurrently, 1 parses them in this process.
+                      The output is the same either way.
+    :param kwargs: Keyword arguments, passed to processAnnovar, i.e. kick_indels and lazy.
+    :return: ploci, list of variant calls represented as pairLocus objects (a lazyPloci with lazy=True),
              labels, list of 0-1-labels where 1 is a genuine mutation, and 0 is a sequencing artefact
     """
     if pandas_csv_kwargs is None:
@@ -82,67 +139,95 @@ def get_ploci_from_annovarlist(annovarlist_path, pandas_csv_kwargs=None, **kwarg
     all_annovars_df = pd.read_csv(annovarlist_path, **pandas_csv_kwargs)
     # We utilise the pandas CSV engine for convenience
 
+    pairs = list(zip(all_annovars_df["GL_bam_ID"], all_annovars_df["CL_bam_ID"],
+                     all_annovars_df["annovar_path"], all_annovars_df["snplist_path"]))
+
+    if n_workers > 1 and len(pairs) > 1:
+        # The results are collected in the order of the annovarlist, however fast the single pairs are done
+        with ProcessPoolExecutor(max_workers=min(n_workers, len(pairs)),
+                                 mp_context=multiprocessing.get_context("fork")) as executor:
+            outputs = list(executor.map(_process_annovar_pair, pairs, [kwargs] * len(pairs)))
+    else:
+        outputs = None
+
     ploci = []
     data_labels = []
 
     # We simply loop over all provided ANNOVAR files, and convert each into lists of pairLocus objects and labels.
-    for GL_ID, CL_ID, annovar_path, snplist_path in zip(all_annovars_df["GL_bam_ID"], all_annovars_df["CL_bam_ID"],
-                                                        all_annovars_df["annovar_path"], all_annovars_df["snplist_path"]):
+    for p, (GL_ID, CL_ID, annovar_path, snplist_path) in enumerate(pairs):
         try:
-
-            new_ploci, new_labels = processAnnovar(
-                GL_ID=GL_ID,
-                CL_ID=CL_ID,
-                annovar_path=annovar_path,
-                snplist_path=snplist_path,
-                cats_used=cats_used_global, **kwargs)
+            if outputs is not None:
+                output, error = outputs[p]
+                if error is not None:
+                    raise error
+                new_ploci, new_labels = output
+                if not kwargs.get("lazy", False):
+                    new_ploci = new_ploci.materialize()
+            else:
+                new_ploci, new_labels = processAnnovar(
+                    GL_ID=GL_ID,
+                    CL_ID=CL_ID,
+                    annovar_path=annovar_path,
+                    snplist_path=snplist_path,
+                    cats_used=cats_used_global, **kwargs)
 
             assert isinstance(new_labels, list)
-            assert isinstance(new_ploci, list)
+            assert isinstance(new_ploci, (list, lazyPloci))
 
             data_labels += new_labels
-            ploci += new_ploci
+            if kwargs.get("lazy", False):
+                ploci.append(new_ploci)
+            else:
+                ploci += new_ploci
         except (ValueError, FileNotFoundError) as e:
             warnings.warn(f"Skipping the {GL_ID} vs. {CL_ID} annovar due to the following error: {e}. "
                           f"Script continues to next annovar.")
             pass
 
+    if kwargs.get("lazy", False):
+        ploci = lazyPloci.concat(ploci)
+
     return ploci, data_labels
 
 
-def get_ploci_from_multianno(multianno_path, GL_ID: str, CL_ID: str, **kwargs):
+def read_multianno_calls(multianno_path):
     """
-    Utility function to convert content of multianno file into variant calls represented by pairLocus instances.
+    Reads a tab-separated .multianno file into a pd.DataFrame of calls, see the description of this file. Like the
+    file itself, all columns but start and stop are strings.
 
     :param multianno_path: Path to .multianno file
-    :param GL_ID: ID of germline sample
-    :param CL_ID: ID of tumour sample
-    :param kwargs: kwargs passed to constructor of pairLocus objects
-    :return: List of pairLocus objects representing variant calls
+    :return: pd.DataFrame of calls, one per row
     """
-
-
     with open(multianno_path, "r") as f:
-        pathlines = f.read().splitlines()
-    data_dict = {"Chr": [], "Start": [], "End": [], "Ref": [], "Alt": [], "Func.refGene": [], "Gene.refGene": [],
-                 "GeneDetail.refGene": [], "ExonicFunc.refGene": []}
+        key_order = f.readline().rstrip("\r\n").split("\t")
 
-    key_order = pathlines[0].split("\t")
+    # Rows may have more fields than the header, e.g. several Otherinfo columns, so columns are picked by position
+    positions = {key_order.index(key): key for key in multianno_columns}
+    calls = pd.read_csv(multianno_path, sep="\t", header=None, skiprows=1, usecols=list(positions), dtype=str,
+                        keep_default_na=False, quoting=csv.QUOTE_NONE)
+    calls = calls.rename(columns=positions).rename(columns=multianno_columns)[list(multianno_columns.values())]
+    calls["start"] = calls["start"].astype(int)
+    calls["stop"] = calls["stop"].astype(int) + 1
+    return calls
 
-    for line in pathlines[1:]:
-        line_parts = line.split("\t")
-
-        for j, key in enumerate(key_order):
-            if key in data_dict.keys():
-                data_dict[key].append(line_parts[j])
-
-    data_df = pd.DataFrame(data_dict)
 
+def get_ploci_from_multianno(multianno_path, GL_ID: str, CL_ID: str, lazy: bool = False, **kwargs):
+    """
+    Utility function to convert content of multianno file into variant calls represented by pairLocus instances.
 
-    return [pairLocus(GL_ID=GL_ID, CL_ID=CL_ID,
-                      chromosome=row["Chr"], start=int(row["Start"]), stop=int(row["End"]) + 1,
-                      ref=row["Ref"], alt=row["Alt"], funcrefgene=row["Func.refGene"], gene=row["Gene.refGene"],
-                      gene_detail=row["GeneDetail.refGene"], exonic_func=row["ExonicFunc.refGene"], **kwargs)
-            for k, row in data_df.iterrows()]
+    :param multianno_path: Path to .multianno file
+    :param GL_ID: ID of germline sample
+    :param CL_ID: ID of tumour sample
+    :param lazy: Whether to return a lazyPloci instead of a list
+    :param kwargs: kwargs passed to constructor of pairLocus objects
+    :return: List of pairLocus objects representing variant calls
+    """
 
+    calls = read_multianno_calls(multianno_path)
+    calls.insert(0, "GL_ID", GL_ID)
+    calls.insert(1, "CL_ID", CL_ID)
+    for key, value in kwargs.items():
+        calls[key] = value
 
+    ploci = lazyPloci(calls)
+    return ploci if lazy else ploci.materialize()
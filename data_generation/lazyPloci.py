@@ -0,0 +1,57 @@
+import pandas as pd
+from pairLocus import pairLocus
+
+
+class lazyPloci:
+    """
+    Read-only sequence of pairLocus objects backed by a pd.DataFrame of calls, with one column per argument of the
+    pairLocus constructor (GL_ID, CL_ID, ref, alt, chromosome, start, stop, funcrefgene and optionally gene,
+    gene_detail). Further columns, e.g. exonic_func, are passed on as keyword arguments and end up in kwdict.
+
+    The pairLocus objects are only constructed when accessed, so that filtering and labeling can work on the columns
+    of calls, and a list of objects is only built by callers which need one.
+    """
+
+    def __init__(self, calls: pd.DataFrame):
+        self.calls = calls.reset_index(drop=True)
+        self._column_lists = None
+
+    def _columns(self):
+        if self._column_lists is None:
+            # tolist gives Python ints, as asserted by pairLocus
+            self._column_lists = {name: self.calls[name].tolist() for name in self.calls.columns}
+        return self._column_lists
+
+    def __len__(self):
+        return len(self.calls)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return lazyPloci(self.calls.iloc[k])
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError(f"Index {k} out of range for {len(self)} loci.")
+        return pairLocus(**{name: values[k] for name, values in self._columns().items()})
+
+    def __iter__(self):
+        columns = self._columns()
+        names = list(columns)
+        for values in zip(*columns.values()):
+            yield pairLocus(**dict(zip(names, values)))
+
+    def materialize(self):
+        """
+        :return: List of all pairLocus objects
+        """
+        return list(self)
+
+    @staticmethod
+    def concat(parts: list):
+        """
+        :param parts: List of lazyPloci
+        :return: lazyPloci of the calls of all parts, in order
+        """
+        if not parts:
+            return lazyPloci(pd.DataFrame())
+        return lazyPloci(pd.concat([part.calls for part in parts], ignore_index=True))
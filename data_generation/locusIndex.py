@@ -0,0 +1,150 @@
+import warnings
+import numpy as np
+import pandas as pd
+from pairLocus import pairLocus
+
+"""
+This file contains a hash index of loci, for labeling candidate variants by whether they are among the confirmed ones.
+Loci are keyed on a tuple of their attributes, by default the IDs of the compared samples and the position, so that
+membership of a candidate is a single dictionary lookup instead of a scan over all confirmed loci. A whole table of
+candidates can also be labeled at once with isin_table.
+
+The same keys are used to find repeated calls of a locus across files (dedup_ploci, merge_ploci), and to match two
+lists of loci (join_ploci), in time linear in the number of loci.
+"""
+
+default_key_fields = ("GL_ID", "CL_ID", "chromosome", "start", "stop")
+
+
+class locusIndex:
+    """
+    Set of loci with O(1) membership, keyed on the attributes named in fields. Like pairLocus.__eq__, this ignores the
+    annotated category as well as the alleles. Each key maps to the first locus added with it.
+    """
+
+    def __init__(self, ploci=(), fields: tuple = default_key_fields):
+        """
+        Constructor
+
+        :param ploci: Iterable of pairLocus objects
+        :param fields: Names of the pairLocus attributes making up the key, e.g. leave out GL_ID to match tumours
+                       regardless of their germline sample
+        """
+        self.fields = tuple(fields)
+        self.loci = {}
+        for pl in ploci:
+            self.add(pl)
+
+    def key(self, plocus: pairLocus):
+        return tuple(getattr(plocus, field) for field in self.fields)
+
+    def add(self, plocus: pairLocus):
+        self.loci.setdefault(self.key(plocus), plocus)
+
+    def get(self, plocus: pairLocus, default=None):
+        """
+        :return: The indexed locus with the same key as plocus, or default
+        """
+        return self.loci.get(self.key(plocus), default)
+
+    def __contains__(self, plocus: pairLocus):
+        return self.key(plocus) in self.loci
+
+    def __len__(self):
+        return len(self.loci)
+
+    def __iter__(self):
+        return iter(self.loci.values())
+
+    def labels(self, ploci: list):
+        """
+        :param ploci: List of pairLocus objects
+        :return: List of 0-1-labels, 1 where the locus is in the index
+        """
+        return [int(self.key(pl) in self.loci) for pl in ploci]
+
+    def isin_table(self, table: pd.DataFrame, columns: tuple = None):
+        """
+        Vectorised membership test of all rows of a table of candidates, as a join on the key columns.
+
+        :param table: pd.DataFrame with one candidate per row
+        :param columns: Names of the columns of table holding the fields of the key, in the same order. Defaults to
+                        the names of the fields
+        :return: np.ndarray of bools, True for the rows whose key is in the index
+        """
+        columns = self.fields if columns is None else tuple(columns)
+        if len(columns) != len(self.fields):
+            raise ValueError(f"Expected {len(self.fields)} key columns, got {len(columns)}.")
+        if len(self.loci) == 0 or len(table) == 0:
+            return np.zeros(len(table), dtype=bool)
+
+        table_keys = pd.MultiIndex.from_arrays([table[column] for column in columns])
+        return np.asarray(table_keys.isin(list(self.loci)))
+
+
+def dedup_ploci(ploci: list, labels: list = None, fields: tuple = default_key_fields):
+    """
+    Finds repeated calls of the same locus, e.g. from overlapping ANNOVAR files, in one pass over the loci. The first
+    call of every key is kept.
+
+    :param ploci: List of pairLocus objects
+    :param labels: Optional labels of the loci. Duplicates whose label differs from the kept call are warned about
+    :param fields: Names of the pairLocus attributes making up the key, by default samples and position
+    :return: kept, the sorted list of the indices of the loci to keep; and duplicates, a list of (index of the
+             duplicate, index of the kept call) tuples
+    """
+    first_of = {}
+    kept = []
+    duplicates = []
+    for k, pl in enumerate(ploci):
+        key = tuple(getattr(pl, field) for field in fields)
+        first = first_of.setdefault(key, k)
+        if first == k:
+            kept.append(k)
+        else:
+            duplicates.append((k, first))
+
+    if labels is not None:
+        conflicts = [(k, first) for k, first in duplicates if labels[k] != labels[first]]
+        if conflicts:
+            warnings.warn(f"{len(conflicts)} duplicate calls have labels differing from the kept call, e.g. "
+                          f"{ploci[conflicts[0][0]].to_string()}. The labels of the kept calls are used.")
+
+    return kept, duplicates
+
+
+def merge_ploci(ploci_lists: list, labels_lists: list = None, fields: tuple = default_key_fields):
+    """
+    Concatenates the candidate lists of several files and removes repeated calls, see dedup_ploci.
+
+    :param ploci_lists: List of lists of pairLocus objects
+    :param labels_lists: Optional list of the lists of labels of these
+    :param fields: Names of the pairLocus attributes making up the key
+    :return: ploci, the merged list; labels, their labels or None; and duplicates as returned by dedup_ploci, with
+             indices into the concatenation of ploci_lists
+    """
+    all_ploci = [pl for ploci in ploci_lists for pl in ploci]
+    all_labels = [label for labels in labels_lists for label in labels] if labels_lists is not None else None
+
+    kept, duplicates = dedup_ploci(all_ploci, all_labels, fields=fields)
+    ploci = [all_ploci[k] for k in kept]
+    labels = [all_labels[k] for k in kept] if all_labels is not None else None
+    return ploci, labels, duplicates
+
+
+def join_ploci(left: list, right: list, fields: tuple = default_key_fields):
+    """
+    Inner join of two lists of loci on their keys, in time linear in their lengths.
+
+    :param left: List of pairLocus objects
+    :param right: List of pairLocus objects
+    :param fields: Names of the pairLocus attributes making up the key
+    :return: List of (index into left, index into right) tuples of loci with equal keys, in the order of left. Every
+             locus of left is matched to the first one of right with its key
+    """
+    right_index = {}
+    for j, pl in enumerate(right):
+        right_index.setdefault(tuple(getattr(pl, field) for field in fields), j)
+
+    return [(i, right_index[key]) for i, key in enumerate(tuple(getattr(pl, field) for field in fields) for pl in left)
+            if key in right_index]
@@ -0,0 +1,111 @@
+from contextlib import contextmanager
+from pairLocus import pairLocus
+
+"""
+This file contains utilities for tensorizing candidate variants in genome order instead of in the order of the ANNOVAR
+files. Loci of the same pair of germline and tumour which lie close together on a chromosome are grouped, and every
+BAM involved is fetched only once for the whole group, instead of once per locus. Results are handed back in the
+original order.
+"""
+
+
+def pair_bam_IDs(plocus: pairLocus):
+    """
+    Default choice of BAMs to fetch per locus: only the germline and tumour tracks.
+    """
+    return [plocus.GL_ID, plocus.CL_ID]
+
+
+def genome_order(ploci: list):
+    """
+    :param ploci: List of pairLocus objects
+    :return: List of indices into ploci, sorted by germline ID, tumour ID, chromosome and start
+    """
+    return sorted(range(len(ploci)),
+                  key=lambda k: (str(ploci[k].GL_ID), str(ploci[k].CL_ID), ploci[k].chromosome, ploci[k].start))
+
+
+def cluster_loci(ploci: list, max_gap: int = 1000, max_span: int = 100000):
+    """
+    Groups loci which can share region fetches. Within a group, all loci belong to the same pair of germline and
+    tumour and lie on the same chromosome, consecutive loci are at most max_gap bases apart, and the whole group
+    spans at most max_span bases.
+
+    :param ploci: List of pairLocus objects
+    :param max_gap: Maximal distance between consecutive loci of a group
+    :param max_span: Maximal distance between the first and last locus of a group
+    :return: List of lists of indices into ploci, in genome order
+    """
+
+    clusters = []
+    current = []
+    for k in genome_order(ploci):
+        pl = ploci[k]
+        if current:
+            first, last = ploci[current[0]], ploci[current[-1]]
+            if (pl.GL_ID, pl.CL_ID, pl.chromosome) == (last.GL_ID, last.CL_ID, last.chromosome) \
+                    and pl.start - last.stop <= max_gap and pl.stop - first.start <= max_span:
+                current.append(k)
+                continue
+            clusters.append(current)
+        current = [k]
+
+    if current:
+        clusters.append(current)
+
+    return clusters
+
+
+def cluster_regions(ploci: list, cluster: list, abam_dict: dict, bam_IDs_fn=pair_bam_IDs):
+    """
+    :param ploci: List of pairLocus objects
+    :param cluster: List of indices into ploci, as returned by cluster_loci
+    :param abam_dict: Dictionary linking BAM IDs to alignedBAM objects
+    :param bam_IDs_fn: Callable taking a pairLocus and returning the IDs of the BAMs worth fetching for it
+    :return: Dictionary linking the IDs of the BAMs to the (chromosome, start, stop) span needed from them
+    """
+
+    regions = {}
+    for k in cluster:
+        pl = ploci[k]
+        for bam_ID in bam_IDs_fn(pl):
+            if abam_dict.get(bam_ID) is None:
+                continue
+            chromosome, start, stop = regions.get(bam_ID, pl.position)
+            regions[bam_ID] = (chromosome, min(start, pl.start), max(stop, pl.stop))
+
+    return regions
+
+
+@contextmanager
+def fetched_regions(ploci: list, cluster: list, abam_dict: dict, bam_IDs_fn=pair_bam_IDs, prefetched: dict = None):
+    """
+    Context manager in which every BAM named by bam_IDs_fn for the loci of a cluster has fetched the region spanned
+    by those loci, so that the fetches of the individual loci are served from memory. The regions are forgotten again
+    on exit.
+
+    :param ploci: List of pairLocus objects
+    :param cluster: List of indices into ploci, as returned by cluster_loci
+    :param abam_dict: Dictionary linking BAM IDs to alignedBAM objects
+    :param bam_IDs_fn: Callable taking a pairLocus and returning the IDs of the BAMs worth fetching for it
+    :param prefetched: Optional dictionary linking BAM IDs to fetchedRegions of the cluster, as built by
+    regionPrefetcher, which are used instead of fetching. BAMs missing from it fetch position by position.
+    """
+
+    regions = cluster_regions(ploci, cluster, abam_dict, bam_IDs_fn=bam_IDs_fn)
+
+    try:
+        for bam_ID, region in regions.items():
+            if prefetched is not None:
+                if prefetched.get(bam_ID) is not None:
+                    abam_dict[bam_ID].use_region(prefetched[bam_ID])
+                continue
+            try:
+                abam_dict[bam_ID].fetch_region(region)
+            except (KeyError, ValueError, OSError):
+                pass  # The loci then fetch on their own, and run into the problem individually
+        yield
+    finally:
+        for bam_ID in regions:
+            abam_dict[bam_ID].forget_region()
+
@@ -0,0 +1,275 @@
+import numpy as np
+import pandas as pd
+from pairLocus import pairLocus
+from lazyPloci import lazyPloci
+
+"""
+This file contains a columnar store of candidate variants, as a compact replacement of lists of pairLocus objects.
+Start and stop are int64 arrays, and every other attribute is dictionary-encoded, i.e. stored as an int32 array of
+codes into a small array of distinct values, with -1 for None. Entries of kwdict which a locus does not have at all
+are coded as -2, so that they are told apart from entries which are None. Millions of loci thus take tens of megabytes,
+and are saved to and loaded from a single uncompressed .npz file without any per-locus parsing.
+
+The distinct values are kept as strings together with their kind, one of str, int, float or bool, so that every value
+comes back with the type it went in with, e.g. integer chromosomes or sample IDs stay ints and a NaN gene stays NaN.
+Values of any other type (numpy scalars are taken as their Python counterparts) are rejected with a TypeError.
+
+Slicing a table gives a view sharing the arrays of the original, whereas indexing with an array of indices or a mask
+gives a copy of the selected rows. Single rows are returned as pairLocus objects, built on access.
+"""
+
+# Attributes passed to the pairLocus constructor; any other column, e.g. exonic_func, goes into its kwdict
+constructor_columns = ("GL_ID", "CL_ID", "chromosome", "start", "stop", "ref", "alt", "funcrefgene", "gene",
+                       "gene_detail")
+int_columns = ("start", "stop")
+none_code = -1
+absent_code = -2  # Entry missing from the kwdict of the locus
+
+
+# One-letter kinds of the values of string-encoded columns, and how to turn their text back into values
+value_kinds = ((bool, "b"), (str, "s"), (int, "i"), (float, "f"),
+               (np.bool_, "b"), (np.str_, "s"), (np.integer, "i"), (np.floating, "f"))
+# NaN is decoded as the np.nan singleton, which dictionaries (and thus pairLocus.__eq__) compare by identity
+decoders = {"s": str, "i": int, "f": lambda text: np.nan if text == "nan" else float(text),
+            "b": lambda text: text == "True"}
+
+
+def value_kind(value):
+    for value_type, kind in value_kinds:
+        if isinstance(value, value_type):
+            return kind
+    raise TypeError(f"Cannot store {value!r} of type {type(value).__name__} in a locusTable, only str, int, float, "
+                    f"bool and None are supported.")
+
+
+def value_text(kind, value):
+    if kind == "f":
+        return repr(float(value))  # Round trips exactly through float, including nan and inf
+    if kind == "i":
+        return str(int(value))
+    return str(value)
+
+
+def value_key(value):
+    if value is None:
+        return None
+    kind = value_kind(value)
+    return kind + value_text(kind, value)
+
+
+def encode_column(values):
+    """
+    :param values: Sequence of str, int, float or bool values, with None for missing values
+    :return: int32 array of codes, -1 where None; array of the distinct values as strings, in order of appearance; and
+             array of their kinds, see value_kinds
+    """
+    values = pd.Series(values, dtype=object)
+    if pd.api.types.infer_dtype(values, skipna=False) == "string":
+        codes, categories = pd.factorize(values)
+        return codes.astype(np.int32), np.array(categories, dtype=str), np.full(len(categories), "s")
+
+    # Values are told apart by kind as well, so that e.g. 1, "1" and True stay distinct
+    codes, categories = pd.factorize(pd.Series([value_key(value) for value in values], dtype=object),
+                                     use_na_sentinel=True)
+    return (codes.astype(np.int32), np.array([key[1:] for key in categories], dtype=str),
+            np.array([key[0] for key in categories], dtype="<U1"))
+
+
+def decode_categories(categories: np.ndarray, kinds: np.ndarray):
+    """
+    :param categories: Array of distinct values as strings, as returned by encode_column
+    :param kinds: Array of their kinds
+    :return: List of the values
+    """
+    return [decoders[kind](text) for kind, text in zip(kinds.tolist(), categories.tolist())]
+
+
+def decode_column(codes: np.ndarray, categories: np.ndarray, kinds: np.ndarray):
+    """
+    Inverse of encode_column.
+
+    :return: Object array of the values, None where the code is negative
+    """
+    return np.array(decode_categories(categories, kinds) + [None, None], dtype=object)[codes]  # Codes -1, -2 pick None
+
+
+class locusTable:
+    """
+    Columnar table of candidate variants, see the description of this file.
+    """
+
+    def __init__(self, starts: np.ndarray, stops: np.ndarray, codes: dict, categories: dict, kinds: dict = None):
+        """
+        Constructor, usually called through from_ploci, from_calls or load
+
+        :param starts: int64 array of the start of every locus
+        :param stops: int64 array of the stop of every locus
+        :param codes: Dictionary linking the names of the encoded columns to their int32 arrays of codes
+        :param categories: Dictionary linking the names of the encoded columns to their arrays of distinct values, as
+                           strings
+        :param kinds: Dictionary linking the names of the encoded columns to the kinds of their distinct values, see
+                      value_kinds. Columns missing from it hold strings only
+        """
+        self.starts = starts
+        self.stops = stops
+        self.codes = codes
+        self.categories = categories
+        self.kinds = {name: (kinds[name] if kinds is not None and name in kinds else np.full(len(values), "s"))
+                      for name, values in categories.items()}
+        self._category_lists = None
+
+    @classmethod
+    def from_calls(cls, calls: pd.DataFrame):
+        """
+        :param calls: pd.DataFrame of calls, as used by lazyPloci
+        :return: locusTable of the calls
+        """
+        codes = {}
+        categories = {}
+        kinds = {}
+        for name in calls.columns:
+            if name not in int_columns:
+                codes[name], categories[name], kinds[name] = encode_column(calls[name].to_numpy(dtype=object))
+        return cls(calls["start"].to_numpy(dtype=np.int64), calls["stop"].to_numpy(dtype=np.int64), codes, categories,
+                   kinds)
+
+    @classmethod
+    def from_ploci(cls, ploci):
+        """
+        :param ploci: List of pairLocus objects, or a lazyPloci
+        :return: locusTable of the loci. Entries of kwdict become columns as well, coded as absent_code for loci
+                 without them
+        """
+        if isinstance(ploci, lazyPloci):
+            return cls.from_calls(ploci.calls)
+
+        kw_names = []
+        for pl in ploci:
+            kw_names += [name for name in pl.kwdict if name not in kw_names]
+
+        calls = {name: [getattr(pl, name) for pl in ploci] for name in constructor_columns}
+        absent = {}
+        for name in kw_names:
+            calls[name] = [pl.kwdict.get(name) for pl in ploci]
+            absent[name] = np.array([name not in pl.kwdict for pl in ploci], dtype=bool)
+
+        table = cls.from_calls(pd.DataFrame(calls, dtype=object))
+        for name, mask in absent.items():
+            table.codes[name][mask] = absent_code
+        return table
+
+    def __len__(self):
+        return len(self.starts)
+
+    @property
+    def columns(self):
+        return list(self.codes) + list(int_columns)
+
+    def _lists(self):
+        if self._category_lists is None:
+            self._category_lists = {name: decode_categories(categories, self.kinds[name])
+                                    for name, categories in self.categories.items()}
+        return self._category_lists
+
+    def value(self, name: str, k: int):
+        if name == "start":
+            return int(self.starts[k])
+        if name == "stop":
+            return int(self.stops[k])
+        code = self.codes[name][k]
+        return self._lists()[name][code] if code >= 0 else None
+
+    def row(self, k: int):
+        """
+        :param k: Index of the locus
+        :return: pairLocus of the locus. kwdict entries the locus did not have are left out, so that a round trip
+                 through from_ploci gives equal objects
+        """
+        kwargs = {name: self.value(name, k) for name in constructor_columns if name in self.codes or name in int_columns}
+        for name in self.codes:
+            if name not in constructor_columns and self.codes[name][k] != absent_code:
+                kwargs[name] = self.value(name, k)
+        return pairLocus(**kwargs)
+
+    def take(self, indices):
+        """
+        :param indices: Array of indices or boolean mask
+        :return: locusTable of a copy of the selected rows
+        """
+        return locusTable(self.starts[indices], self.stops[indices],
+                          {name: codes[indices] for name, codes in self.codes.items()}, self.categories, self.kinds)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return locusTable(self.starts[k], self.stops[k], {name: codes[k] for name, codes in self.codes.items()},
+                              self.categories, self.kinds)
+        if isinstance(k, (list, np.ndarray)):
+            return self.take(np.asarray(k))
+        if k < 0:
+            k += len(self)
+        if not 0 <= k < len(self):
+            raise IndexError(f"Index {k} out of range for {len(self)} loci.")
+        return self.row(k)
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.row(k)
+
+    def column(self, name: str):
+        """
+        :param name: Name of a column
+        :return: int64 array for start and stop, otherwise an object array of the values, None where missing or absent
+        """
+        if name == "start":
+            return self.starts
+        if name == "stop":
+            return self.stops
+        values = np.array(self._lists()[name] + [None, None], dtype=object)
+        return values[self.codes[name]]  # Codes -1 and -2 pick a trailing None
+
+    def isin(self, name: str, values: list):
+        """
+        :param name: Name of an encoded column
+        :param values: List of admissible values
+        :return: Boolean mask of the loci whose value of the column is among values
+        """
+        values = set(values)
+        admissible = [code for code, value in enumerate(self._lists()[name]) if value in values]
+        return np.isin(self.codes[name], admissible)
+
+    def groups(self, name: str):
+        """
+        :param name: Name of an encoded column
+        :return: Dictionary linking every value present in the column to the sorted array of indices of its loci, with
+                 absent entries counted as None
+        """
+        codes = np.maximum(self.codes[name], none_code)
+        order = np.argsort(codes, kind="stable")
+        present, bounds = np.unique(codes[order], return_index=True)
+        splits = np.split(order, bounds[1:])
+        return {(self._lists()[name][code] if code >= 0 else None): indices for code, indices in zip(present, splits)}
+
+    def to_calls(self):
+        """
+        :return: pd.DataFrame of calls, as used by lazyPloci
+        """
+        return pd.DataFrame({name: self.column(name) for name in self.columns})
+
+    def to_ploci(self):
+        return list(self)
+
+    def save(self, path):
+        arrays = {"starts": self.starts, "stops": self.stops, "names": np.array(list(self.codes), dtype=str)}
+        for name in self.codes:
+            arrays[f"codes_{name}"] = self.codes[name]
+            arrays[f"categories_{name}"] = self.categories[name]
+            arrays[f"kinds_{name}"] = self.kinds[name]
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as f:
+            names = f["names"].tolist()
+            return cls(f["starts"], f["stops"], {name: f[f"codes_{name}"] for name in names},
+                       {name: f[f"categories_{name}"] for name in names},
+                       {name: f[f"kinds_{name}"] for name in names if f"kinds_{name}" in f.files})
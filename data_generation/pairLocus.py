@@ -1,3 +1,6 @@
+_missing = object()  # Marks attributes missing in the other locus in pairLocus.__eq__
+
+
 class pairLocus:
     """
     This class holds the information on a locus as called by the variant caller (in our case, VarScan2).
@@ -38,18 +41,32 @@ class pairLocus:
         """
         Notably, this skips checking for whether the annotated category is equal!
         This allows for comparison with manually constructed ploci.
+
+        Equivalent to comparing the __dict__s without their 'category' entry, but without copying them. Loci with
+        different idtuples are told apart right away.
         """
 
         if isinstance(other, self.__class__):
-            self_catless_dict = self.__dict__.copy()
-            self_catless_dict.pop("category", None)
-
-            other_catless_dict = other.__dict__.copy()
-            other_catless_dict.pop("category", None)
-            return self_catless_dict == other_catless_dict
+            if self.idtuple != other.idtuple:
+                return False
+
+            other_dict = other.__dict__
+            n_compared = 0
+            for name, value in self.__dict__.items():
+                if name == "category":
+                    continue
+                n_compared += 1
+                other_value = other_dict.get(name, _missing)
+                if other_value is not value and other_value != value:
+                    return False
+            return n_compared == len(other_dict) - ("category" in other_dict)
         else:
             return False
 
+    def __hash__(self):
+        # Equal loci have equal idtuples, so loci can be used in sets and as keys of dicts
+        return hash(self.idtuple)
+
     def __ne__(self, other):
         return not self.__eq__(other)
 
@@ -0,0 +1,197 @@
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from alignedBAM import alignment_file_pool
+from locusScheduler import cluster_loci, fetched_regions, pair_bam_IDs
+from regionPrefetcher import regionPrefetcher
+from stageTimer import stage_timer
+
+"""
+This file contains utilities to tensorize a list of candidate variants with a pool of worker processes. Loci are
+clustered in genome order as in locusScheduler, and the clusters are sharded across the workers, each of which opens
+its own alignment files. Given a tensorWriter, the workers write their tensors straight to disk.
+
+Before each locus is tensorized, numpy's global random state is seeded from the base seed and the index of the locus.
+The random choice of context tracks in random_context_tensorize_once therefore only depends on the locus itself,
+and a run with n_workers=1 produces exactly the same tensors as one with any other number of workers.
+"""
+
+# Set right before the worker processes are forked, so that the loci and alignedBAMs need not be pickled for them
+_shared = None
+
+
+def seed_locus(base_seed: int, index: int):
+    np.random.seed([base_seed, index])
+
+
+def tensorize_clusters(clusters: list, ploci: list, tensorize_fn, abam_dict: dict, bam_IDs_fn=pair_bam_IDs,
+                       base_seed: int = 42, writer=None, prefetch_depth: int = 0, is_cached=None):
+    """
+    Tensorizes the loci of the given clusters in this process. A locus whose tensorisation fails is reported
+    instead of aborting the whole run.
+
+    With a positive prefetch_depth, the regions of the next clusters are read by a regionPrefetcher in background
+    threads while the current cluster is encoded, and the occupancy of its queue is recorded in stage_timer.
+
+    If a tensorWriter is passed, tensors are written to disk right away instead of being returned. If tensorize_fn
+    returns a tuple, its first entry is the tensor to be written and the remaining entries are returned in its place.
+
+    :param clusters: List of lists of indices into ploci, as returned by cluster_loci
+    :param ploci: List of pairLocus objects
+    :param tensorize_fn: Callable taking a pairLocus
+    :param abam_dict: Dictionary linking BAM IDs to alignedBAM objects
+    :param bam_IDs_fn: Callable taking a pairLocus and returning the IDs of the BAMs worth fetching for it
+    :param base_seed: Seed from which the per-locus seeds are derived
+    :param writer: Optional instance of tensorWriter
+    :param prefetch_depth: Number of clusters read ahead of the one being encoded, 0 to read them on demand
+    :param is_cached: Optional callable telling the regionPrefetcher which tracks need not be read, e.g.
+                      singleTensorizer.is_cached
+    :return: List of (index into ploci, output of tensorize_fn or None, error message or None) tuples
+    """
+
+    if prefetch_depth > 0:
+        cluster_iter = iter(regionPrefetcher(ploci, clusters, abam_dict, bam_IDs_fn=bam_IDs_fn, depth=prefetch_depth,
+                                             is_cached=is_cached))
+    else:
+        cluster_iter = ((cluster, None) for cluster in clusters)
+
+    out = []
+    for cluster, prefetched in cluster_iter:
+        with fetched_regions(ploci, cluster, abam_dict, bam_IDs_fn=bam_IDs_fn, prefetched=prefetched):
+            for k in cluster:
+                seed_locus(base_seed, k)
+                try:
+                    result = tensorize_fn(ploci[k])
+                    if writer is not None:
+                        if isinstance(result, tuple):
+                            writer.write(k, result[0])
+                            result = result[1:]
+                        else:
+                            writer.write(k, result)
+                            result = None
+                    out.append((k, result, None))
+                except Exception as e:
+                    out.append((k, None, f"{type(e).__name__}: {e}"))
+                stage_timer.count("loci")
+                stage_timer.progress()
+
+    return out
+
+
+def _init_worker():
+    # Forked workers inherit the parent's open files, whose file pointers would be shared between processes
+    alignment_file_pool.clear()
+    stage_timer.reset()  # Timings and counters inherited from the parent are neither sent back nor shown in progress
+
+
+def _tensorize_shard(clusters, make_writer=None):
+    ploci, tensorize_fn, abam_dict, bam_IDs_fn, base_seed, shared_writer, prefetch_depth, is_cached = _shared
+    if make_writer is None:
+        return tensorize_clusters(clusters, ploci, tensorize_fn, abam_dict, bam_IDs_fn, base_seed, shared_writer,
+                                  prefetch_depth, is_cached)
+
+    writer = make_writer()
+    output = tensorize_clusters(clusters, ploci, tensorize_fn, abam_dict, bam_IDs_fn, base_seed, writer,
+                                prefetch_depth, is_cached)
+    writer.flush()  # The rows must be on disk before the shard is handed back
+    return output
+
+
+def _tensorize_shard_in_worker(clusters, make_writer=None):
+    # The timings of the shard are sent back with its output, to be merged into those of the parent process
+    output = _tensorize_shard(clusters, make_writer)
+    return output, stage_timer.drain()
+
+
+def iter_shards(shards: list, ploci: list, tensorize_fn, abam_dict: dict, n_workers: int = 1, bam_IDs_fn=pair_bam_IDs,
+                base_seed: int = 42, writer=None, shard_writers: list = None, prefetch_depth: int = 0, is_cached=None):
+    """
+    Tensorizes shards of clusters, optionally in parallel, and hands back the output of each shard as soon as it is
+    done, so that the caller can e.g. checkpoint it.
+
+    :param shards: List of lists of clusters, as returned by cluster_loci
+    :param ploci: List of pairLocus objects
+    :param tensorize_fn: Callable taking a pairLocus
+    :param abam_dict: Dictionary linking BAM IDs to alignedBAM objects
+    :param n_workers: Number of worker processes. With 1, everything runs in the calling process.
+    :param bam_IDs_fn: Callable taking a pairLocus and returning the IDs of the BAMs worth fetching for it
+    :param base_seed: Seed from which the per-locus seeds are derived
+    :param writer: Optional instance of tensorWriter shared by all shards, or of raggedWriter if n_workers is 1
+    :param shard_writers: Optional list of one callable per shard, used instead of writer. It is called without
+                          arguments when the shard is started, in the process tensorising it, and returns the
+                          tensorWriter or raggedWriter of the shard, which is flushed once the shard is done
+    :param prefetch_depth: See tensorize_clusters
+    :param is_cached: See tensorize_clusters
+    :return: Generator of (index into shards, output of tensorize_clusters) tuples, in order of completion
+    """
+    global _shared
+
+    if shard_writers is None:
+        shard_writers = [None] * len(shards)
+    if writer is not None and n_workers > 1 and not writer.shareable:
+        raise ValueError(f"A {type(writer).__name__} cannot be shared by worker processes, pass shard_writers instead.")
+
+    _shared = (ploci, tensorize_fn, abam_dict, bam_IDs_fn, base_seed, writer, prefetch_depth, is_cached)
+    try:
+        if n_workers <= 1:
+            for s, shard in enumerate(shards):
+                yield s, _tensorize_shard(shard, shard_writers[s])
+        else:
+            with ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("fork"),
+                                     initializer=_init_worker) as executor:
+                futures = {executor.submit(_tensorize_shard_in_worker, shard, shard_writers[s]): s
+                           for s, shard in enumerate(shards)}
+                for future in as_completed(futures):
+                    output, snapshot = future.result()
+                    stage_timer.merge(snapshot)
+                    yield futures[future], output
+    finally:
+        _shared = None
+
+
+def tensorize_loci(ploci: list, tensorize_fn, abam_dict: dict, n_workers: int = 1, bam_IDs_fn=pair_bam_IDs,
+                   base_seed: int = 42, shards_per_worker: int = 4, writer=None, prefetch_depth: int = 0,
+                   is_cached=None, **cluster_kwargs):
+    """
+    Top-level function to tensorize a list of candidate variants, optionally in parallel.
+
+    :param ploci: List of pairLocus objects
+    :param tensorize_fn: Callable taking a pairLocus, e.g. a functools.partial of nocontext_depth_tensorize_plocus
+    :param abam_dict: Dictionary linking BAM IDs to alignedBAM objects
+    :param n_workers: Number of worker processes. With 1, everything runs in the calling process.
+    :param bam_IDs_fn: Callable taking a pairLocus and returning the IDs of the BAMs worth fetching for it
+    :param base_seed: Seed from which the per-locus seeds are derived
+    :param shards_per_worker: Number of shards of clusters per worker, more shards balance the load better
+    :param writer: Optional instance of tensorWriter, into which the workers write the tensors directly, or of
+                   raggedWriter if n_workers is 1
+    :param prefetch_depth: Number of clusters each worker reads ahead in background threads, see tensorize_clusters
+    :param is_cached: See tensorize_clusters
+    :param cluster_kwargs: Passed on to cluster_loci, i.e. max_gap and max_span
+    :return: results, list of outputs of tensorize_fn in the order of ploci, with None for failed loci;
+             and failures, list of (index into ploci, error message) tuples
+    """
+    clusters = cluster_loci(ploci, **cluster_kwargs)
+    results = [None] * len(ploci)
+    failures = []
+
+    if n_workers <= 1:
+        shards = [clusters]
+    else:
+        # Shards are contiguous runs of clusters, so that workers keep moving along the genome
+        n_shards = max(1, min(len(clusters), n_workers * shards_per_worker))
+        shards = [[clusters[c] for c in shard]
+                  for shard in np.array_split(np.arange(len(clusters)), n_shards) if len(shard) > 0]
+
+    outputs = [output for s, output in iter_shards(shards, ploci, tensorize_fn, abam_dict, n_workers=n_workers,
+                                                    bam_IDs_fn=bam_IDs_fn, base_seed=base_seed, writer=writer,
+                                                    prefetch_depth=prefetch_depth, is_cached=is_cached)]
+
+    for output in outputs:
+        for k, result, error in output:
+            if error is None:
+                results[k] = result
+            else:
+                failures.append((k, error))
+
+    failures.sort()
+    return results, failures
@@ -0,0 +1,278 @@
+import os
+import json
+import shutil
+import numpy as np
+from stageTimer import stage_timer
+from tensorWriter import shrink_npy, write_side_files
+
+"""
+This file contains a ragged storage format for tensorised candidate variants. Most loci are covered by far fewer reads
+than bamStruct.max_reads, and comparison tracks are often all-zero placeholders, so the dense tensors are mostly
+padding. In the ragged format, only the non-empty read rows of every track are stored, together with their row in the
+dense track, and the padding is only added again when a batch is densified for training.
+
+A ragged dataset is a folder containing
+    reads.bin: all stored reads, raw array of shape (n_reads, window_len, 7)
+    read_rows.bin: row of every read in its dense track, raw int32 array of shape (n_reads,)
+    offsets.npy, counts.npy: index of the first read and number of reads, per locus and track, of shape
+                             (n_loci, n_tracks)
+    depths.npy: number of rows up to the last non-empty one, per locus
+    meta.json: window_len, max_reads, n_tracks, dtype and n_reads
+
+raggedWriter writes such a folder with the same interface as tensorWriter, straight from the tensors of the loci, and
+raggedTensor reads it.
+"""
+
+
+class raggedWriter:
+    """
+    This class writes tensors of candidate variants into a ragged dataset, see the description of this file. It takes
+    the same arguments as tensorWriter, and the dense tensor of a locus is only held in memory while its reads are
+    picked out of it.
+
+    The reads are appended to the end of the files in the order in which they are written, so unlike a tensorWriter,
+    a raggedWriter can only be written by one process. Parallel builds give every shard its own raggedWriter, see
+    checkpointedBuild.build_checkpointed, and join them with write_shard.
+    """
+
+    suffix = ""  # Of the path of a dataset, which is a folder
+    shareable = False
+
+    def __init__(self, path, n_rows: int, row_shape: tuple, dtype=np.float64, labels_path=None, loci_path=None,
+                 indices: list = None, resume: bool = False):
+        """
+        Constructor
+
+        :param path: Path of the folder to be written
+        :param n_rows: Number of loci to be tensorised
+        :param row_shape: Shape of a single dense tensor, stacked along the channels as from bamStruct.tensor_shape
+        :param dtype: dtype of the stored tensors
+        :param labels_path: Optional path of a .npy file of labels of the kept loci
+        :param loci_path: Optional path of a csv file with the IDs of the kept loci
+        :param indices: Optional list of the indices of the loci this dataset holds rows for, in order, if these are
+        not simply 0 to n_rows - 1, e.g. for a shard of a larger dataset
+        :param resume: Whether to reopen the folder at path as left by an interrupted run, instead of creating it anew.
+        Reads appended after the last flush are dropped.
+        """
+        self.path = path
+        self.n_rows = n_rows
+        self.row_shape = tuple(row_shape)
+        self.window_len, self.max_reads, n_channels = self.row_shape
+        assert n_channels % 7 == 0
+        self.n_tracks = n_channels // 7
+        self.dtype = np.dtype(dtype)
+        self.labels_path = labels_path
+        self.loci_path = loci_path
+
+        self.row_of = {k: row for row, k in enumerate(indices)} if indices is not None else None
+
+        os.makedirs(path, exist_ok=True)
+        reads_path, rows_path = os.path.join(path, "reads.bin"), os.path.join(path, "read_rows.bin")
+        index_shapes = {"offsets": ((n_rows, self.n_tracks), np.int64), "counts": ((n_rows, self.n_tracks), np.int32),
+                        "depths": ((n_rows,), np.int32)}
+
+        if resume:
+            with open(os.path.join(path, "meta.json"), "r") as f:
+                self.n_reads = json.load(f)["n_reads"]
+            for name, (shape, index_dtype) in index_shapes.items():
+                index = np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r+")
+                assert index.shape == shape and index.dtype == index_dtype
+                setattr(self, name, index)
+            os.truncate(reads_path, self.n_reads * self.window_len * 7 * self.dtype.itemsize)
+            os.truncate(rows_path, self.n_reads * np.dtype(np.int32).itemsize)
+        else:
+            self.n_reads = 0
+            for name, (shape, index_dtype) in index_shapes.items():
+                setattr(self, name, np.lib.format.open_memmap(os.path.join(path, f"{name}.npy"), mode="w+",
+                                                              dtype=index_dtype, shape=shape))
+            open(reads_path, "wb").close()
+            open(rows_path, "wb").close()
+            self._write_meta()
+
+        self.reads_file = open(reads_path, "ab")
+        self.rows_file = open(rows_path, "ab")
+
+    def _write_meta(self):
+        with open(os.path.join(self.path, "meta.json"), "w") as f:
+            json.dump({"window_len": self.window_len, "max_reads": self.max_reads, "n_tracks": self.n_tracks,
+                       "dtype": self.dtype.str, "n_reads": self.n_reads}, f)
+
+    @stage_timer.timed("writer")
+    def write(self, k: int, tensor: np.ndarray):
+        """
+        :param k: Index of the locus, i.e. row of the dataset unless indices were given
+        :param tensor: Dense tensor of shape row_shape
+        :return: None
+        """
+        row = k if self.row_of is None else self.row_of[k]
+
+        tracks = tensor.reshape(self.window_len, self.max_reads, self.n_tracks, 7)
+        tracks_of_reads, read_rows = np.nonzero(tracks.any(axis=(0, 3)).T)  # Ordered by track, then row
+        counts = np.bincount(tracks_of_reads, minlength=self.n_tracks)
+
+        self.offsets[row] = self.n_reads + np.cumsum(counts) - counts
+        self.counts[row] = counts
+        self.depths[row] = read_rows.max() + 1 if len(read_rows) > 0 else 0
+
+        reads = tracks[:, read_rows, tracks_of_reads, :].transpose(1, 0, 2)
+        self.reads_file.write(np.ascontiguousarray(reads, dtype=self.dtype).tobytes())
+        self.rows_file.write(read_rows.astype(np.int32).tobytes())
+        self.n_reads += len(read_rows)
+
+    def write_shard(self, shard, indices: list, skip=()):
+        """
+        Appends the reads of a dataset written by another raggedWriter, e.g. a shard of a checkpointed build, in one
+        go, and points the rows of its loci to them.
+
+        :param shard: The other dataset, as returned by open
+        :param indices: Indices of the loci of the rows of shard, in order
+        :param skip: Indices of loci which are not copied. Their reads are copied nonetheless, but not pointed to.
+        :return: None
+        """
+        assert shard.row_shape == self.row_shape and shard.dtype == self.dtype
+
+        for name, f in [("reads.bin", self.reads_file), ("read_rows.bin", self.rows_file)]:
+            with open(os.path.join(shard.path, name), "rb") as shard_file:
+                shutil.copyfileobj(shard_file, f)
+
+        for row, k in enumerate(indices):
+            if k not in skip:
+                own_row = k if self.row_of is None else self.row_of[k]
+                self.offsets[own_row] = self.n_reads + shard.offsets[row]
+                self.counts[own_row] = shard.counts[row]
+                self.depths[own_row] = shard.depths[row]
+        self.n_reads += shard.n_reads
+
+    def flush(self):
+        self.reads_file.flush()
+        self.rows_file.flush()
+        for index in [self.offsets, self.counts, self.depths]:
+            index.flush()
+        self._write_meta()  # Last, so that the dataset never claims reads which are not on disk yet
+
+    @staticmethod
+    def open(path):
+        """
+        :param path: Path of a finished dataset
+        :return: The dataset, opened read-only as raggedTensor
+        """
+        return raggedTensor(path)
+
+    def finalize(self, kept: list, labels=None, ploci=None, pattern="GL_ID;CL_ID;chromosome;start;stop;ref;alt"):
+        """
+        Moves the rows of the kept loci together, shrinks the index accordingly and writes the side files, in the same
+        way as tensorWriter.finalize. The reads of the other loci, if any, are left unreferenced in the files.
+
+        :param kept: Sorted list of the indices of successfully tensorised loci
+        :param labels: Labels of all loci, written for the kept ones to labels_path
+        :param ploci: pairLocus objects of all loci, written for the kept ones to loci_path
+        :param pattern: Attributes of the pairLocus objects to write, as in pairLocus.write_to
+        :return: The finished dataset, opened read-only as raggedTensor
+        """
+
+        self.flush()
+        self.reads_file.close()
+        self.rows_file.close()
+
+        rows = kept if self.row_of is None else [self.row_of[k] for k in kept]
+        for index in [self.offsets, self.counts, self.depths]:
+            index[:len(rows)] = index[rows]
+            index.flush()
+        self.offsets = self.counts = self.depths = None
+
+        if len(rows) < self.n_rows:
+            for name in ["offsets.npy", "counts.npy", "depths.npy"]:
+                shrink_npy(os.path.join(self.path, name), len(rows))
+
+        write_side_files(kept, self.labels_path, labels, self.loci_path, ploci, pattern)
+
+        return self.open(self.path)
+
+
+class raggedTensor:
+    """
+    This class gives access to a ragged dataset, densifying batches of loci on demand. The reads are memory-mapped,
+    so only the batches themselves are held in memory.
+    """
+
+    def __init__(self, path, mode: str = "r"):
+        """
+        Constructor
+
+        :param path: Path of the folder of the dataset
+        :param mode: Mode of the memory map of the reads, "r+" to change them in place
+        """
+        self.path = path
+        with open(os.path.join(path, "meta.json"), "r") as f:
+            meta = json.load(f)
+        self.window_len = meta["window_len"]
+        self.max_reads = meta["max_reads"]
+        self.n_tracks = meta["n_tracks"]
+        self.dtype = np.dtype(meta["dtype"])
+        self.n_reads = meta["n_reads"]
+        self.row_shape = (self.window_len, self.max_reads, 7 * self.n_tracks)
+
+        self.offsets = np.load(os.path.join(path, "offsets.npy"))
+        self.counts = np.load(os.path.join(path, "counts.npy"))
+        self.depths = np.load(os.path.join(path, "depths.npy"))
+        self.read_rows = np.fromfile(os.path.join(path, "read_rows.bin"), dtype=np.int32, count=self.n_reads)
+
+        reads_shape = (self.n_reads, self.window_len, 7)
+        if self.n_reads > 0:
+            self.reads = np.memmap(os.path.join(path, "reads.bin"), dtype=self.dtype, mode=mode, shape=reads_shape)
+        else:
+            self.reads = np.zeros(reads_shape, dtype=self.dtype)  # An empty file cannot be memory-mapped
+
+    def __len__(self):
+        return len(self.offsets)
+
+    @property
+    def shape(self):
+        # Shape of the dense tensor
+        return (len(self),) + self.row_shape
+
+    def __getitem__(self, k: int):
+        return self.densify([k])[0]
+
+    def track_reads(self, k: int, track: int):
+        """
+        :param k: Index of the locus
+        :param track: Index of the sequencing track
+        :return: Stored reads of the track at the locus, a view into the memory map of shape (n, window_len, 7)
+        """
+        return self.reads[self.offsets[k, track]:self.offsets[k, track] + self.counts[k, track]]
+
+    def densify(self, indices, depth=None):
+        """
+        Builds the dense tensors of a batch of loci, in the dtype they were stored in. The reads of the batch are
+        gathered in the order of the file.
+
+        :param indices: Indices of the loci in the batch
+        :param depth: Number of read rows per track of the batch. None pads to max_reads, which gives the dense
+        tensors and is what the models expect; "batch" pads only to the deepest locus of the batch, for models which
+        take any number of rows; an int pads to, or cuts down to, that many rows.
+        :return: np.ndarray of shape (len(indices), window_len, depth, 7 * n_tracks)
+        """
+
+        indices = np.asarray(indices, dtype=np.int64)
+        if depth is None:
+            depth = self.max_reads
+        elif depth == "batch":
+            depth = int(self.depths[indices].max(initial=0))
+
+        # Every stored read of the batch, with the locus of the batch and the track it belongs to
+        counts = self.counts[indices].ravel()
+        locus_track = np.repeat(np.arange(len(counts)), counts)
+        first_read = np.repeat(np.cumsum(counts) - counts, counts)
+        read_indices = self.offsets[indices].ravel()[locus_track] + np.arange(len(locus_track)) - first_read
+        read_rows = self.read_rows[read_indices]
+
+        keep = read_rows < depth
+        read_indices, locus_track, read_rows = read_indices[keep], locus_track[keep], read_rows[keep]
+        order = np.argsort(read_indices, kind="stable")
+        read_indices, locus_track, read_rows = read_indices[order], locus_track[order], read_rows[order]
+
+        out = np.zeros((len(indices), self.window_len, depth, self.n_tracks, 7), dtype=self.dtype)
+        out[locus_track // self.n_tracks, :, read_rows, locus_track % self.n_tracks, :] = self.reads[read_indices]
+
+        return out.reshape(len(indices), self.window_len, depth, 7 * self.n_tracks)
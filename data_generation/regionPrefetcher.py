@@ -0,0 +1,131 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from locusScheduler import cluster_regions, pair_bam_IDs
+from stageTimer import stage_timer
+
+"""
+This file contains a prefetching stage for tensorisation in genome order. While the loci of one cluster are encoded,
+a pool of background threads already reads the regions of the next clusters from the BAMs, so that disk (or network)
+and CPU are busy at the same time. Each thread reads through its own AlignmentFiles, which alignment_file_pool keeps
+per thread.
+
+Regions are handed out as fetchedRegions, which are only read by the background threads if some locus of the cluster
+needs them. If a locus of the BAM is found in the track cache, it does not, so rebuilding with a warm cache reads
+nothing from the BAMs. A region left unread is still read on demand, should one of its loci miss the cache after all.
+
+All regionPrefetchers of a process share one pool of threads, so that the threads, and with them their open
+AlignmentFiles, are kept from one shard of loci to the next.
+"""
+
+_executor = None
+_executor_key = None
+
+
+def prefetch_executor(n_threads: int):
+    """
+    :param n_threads: Number of background threads
+    :return: The ThreadPoolExecutor of this process, created anew only if n_threads changed or the process was forked,
+             since the threads of the parent do not exist in a forked child
+    """
+    global _executor, _executor_key
+
+    key = (os.getpid(), n_threads)
+    if _executor_key != key:
+        if _executor is not None and _executor_key[0] == os.getpid():
+            _executor.shutdown(wait=True)
+        _executor = ThreadPoolExecutor(max_workers=n_threads, thread_name_prefix="prefetch")
+        _executor_key = key
+
+    return _executor
+
+
+class regionPrefetcher:
+    """
+    Iterates over clusters of loci together with their loaded regions, keeping up to depth clusters in flight ahead
+    of the consumer. Occupancy of the queue is recorded whenever the consumer asks for the next cluster, in the
+    counters prefetch_clusters, prefetch_queued, prefetch_ready and prefetch_waits of stage_timer, with the time spent
+    waiting in the stage prefetch_wait: if the next cluster is mostly still loading, the queue is too shallow (or the
+    storage too slow), and if many clusters are mostly ready, depth can be reduced to save RAM.
+    """
+
+    def __init__(self, ploci: list, clusters: list, abam_dict: dict, bam_IDs_fn=pair_bam_IDs, depth: int = 4,
+                 n_threads: int = None, is_cached=None):
+        """
+        Constructor
+
+        :param ploci: List of pairLocus objects
+        :param clusters: List of lists of indices into ploci, as returned by cluster_loci
+        :param abam_dict: Dictionary linking BAM IDs to alignedBAM objects
+        :param bam_IDs_fn: Callable taking a pairLocus and returning the IDs of the BAMs worth fetching for it
+        :param depth: Maximal number of clusters read ahead of the one being encoded
+        :param n_threads: Number of background threads, defaults to depth
+        :param is_cached: Optional callable taking a BAM ID and a position and returning whether the track is cached,
+                          e.g. singleTensorizer.is_cached. Regions all of whose loci are cached are not read
+        """
+        self.ploci = ploci
+        self.clusters = clusters
+        self.abam_dict = abam_dict
+        self.bam_IDs_fn = bam_IDs_fn
+        self.depth = depth
+        self.n_threads = n_threads if n_threads is not None else depth
+        self.is_cached = is_cached
+
+    def _needs_reads(self, bam_ID, cluster):
+        if self.is_cached is None:
+            return True
+        return not all(self.is_cached(bam_ID, self.ploci[k].position) for k in cluster
+                       if bam_ID in self.bam_IDs_fn(self.ploci[k]))
+
+    @stage_timer.timed("prefetch")
+    def _load(self, cluster):
+        prefetched = {}
+        for bam_ID, region in cluster_regions(self.ploci, cluster, self.abam_dict, self.bam_IDs_fn).items():
+            fetched_region = self.abam_dict[bam_ID].make_region(region)
+            if not self._needs_reads(bam_ID, cluster):
+                stage_timer.count("prefetch_cached_regions")
+                prefetched[bam_ID] = fetched_region  # Left unread
+                continue
+            try:
+                fetched_region.load()
+            except (KeyError, ValueError, OSError):
+                continue  # The loci then fetch on their own, and run into the problem individually
+            prefetched[bam_ID] = fetched_region
+        return prefetched
+
+    def __iter__(self):
+        """
+        :return: Generator of (cluster, prefetched) tuples in the order of clusters, where prefetched is a dictionary
+                 linking BAM IDs to fetchedRegions, to be passed on to locusScheduler.fetched_regions
+        """
+        executor = prefetch_executor(self.n_threads)
+        queue = deque()
+        remaining = iter(self.clusters)
+        for cluster in remaining:
+            queue.append((cluster, executor.submit(self._load, cluster)))
+            if len(queue) >= self.depth:
+                break
+
+        try:
+            while queue:
+                n_ready = sum(future.done() for _, future in queue)
+                stage_timer.count("prefetch_clusters")
+                stage_timer.count("prefetch_queued", len(queue))
+                stage_timer.count("prefetch_ready", n_ready)
+
+                cluster, future = queue.popleft()
+                if not future.done():
+                    stage_timer.count("prefetch_waits")
+                    with stage_timer.section("prefetch_wait"):
+                        prefetched = future.result()
+                else:
+                    prefetched = future.result()
+
+                next_cluster = next(remaining, None)
+                if next_cluster is not None:
+                    queue.append((next_cluster, executor.submit(self._load, next_cluster)))
+
+                yield cluster, prefetched
+        finally:
+            for _, future in queue:
+                future.cancel()
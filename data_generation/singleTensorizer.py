@@ -2,6 +2,8 @@ import numpy as np
 import warnings
 from bamStruct import bamStruct
 from alignedBAM import alignedBAM
+from trackCache import trackCache
+from stageTimer import stage_timer
 
 class NoReadsError(Exception):
     """
@@ -36,22 +38,99 @@ def onehot_encode_base(base: str):
         return result
 
 
+# Lookup table from ASCII codes to onehot rows, used to encode whole read slices at once. Anything that is not in
+# base_enc maps to an all-zero row, i.e. a missing base, just as in onehot_encode_base.
+base_lut = np.zeros((256, 4))
+for _base, _index in base_enc.items():
+    base_lut[ord(_base), _index] = 1
+base_is_known = base_lut.any(axis=1)
+
+
 class singleTensorizer:
     """
     This is in the end the class which does the heavy lifting in the tensorisation process, accessing the reads in
     the bam files, etc. It is constructed using a bamStruct object to easily pass the shape settings for the tensor.
     """
 
+    # Part of the keys of cached tensors, must be increased whenever the encoding changes
+    encoder_version = 1
+
+    def __init__(self, bstruct: bamStruct, dtype=np.float64, cache: trackCache = None):
+        """
+        Constructor
 
-    def __init__(self, bstruct: bamStruct):
+        :param bstruct: Instance of bamStruct holding the shape settings
+        :param dtype: dtype of the produced tensors. With np.uint8, every channel fits into a byte and the tensors take
+        an eighth of the space; the reverse strand flag -1 is then stored as 255, which decode_tensor in
+        training/loading_utils.py turns back into -1.
+        :param cache: Optional trackCache, in which tensors are looked up before the bam file is accessed
+        """
         self.window_n = bstruct.window_n
         self.window_len = 2 * self.window_n + 1
         self.max_reads = bstruct.max_reads
+        self.dtype = np.dtype(dtype)
+        self.reverse_flag = np.array(-1).astype(self.dtype)
+        self.cache = cache
+
+    def encode_reads(self, reads, start: int):
+        """
+        Encodes an iterable of reads into the (window_len, max_reads, 7) read window around start. Instead of walking
+        through each read base by base, the part of the window covered by a read is computed up front and filled by
+        slice assignment, using base_lut for the onehot-encoding.
+
+        The output is identical to the original base-wise walk: reads which do not contain the requested position
+        leave their row empty, and the outermost window columns are never filled (the walk only went window_n - 1
+        bases outwards from the centre).
+
+        :param reads: Iterable of aligned reads, as returned by the fetch method of an AlignmentFile
+        :param start: Start position of the call, as in the position tuple
+        :return: Tensorised numpy.ndarray
+        """
+
+        out_data = np.zeros(shape=(self.window_len, self.max_reads, 7), dtype=self.dtype)
+        data_mid_index = self.window_n
+        n_encoded = 0
 
+        for j, read in enumerate(reads):
+            if j >= self.max_reads:
+                break
+
+            # Index shuffling, if the read somehow does not contain the requested position, it is skipped
+            read_seq = read.query_sequence
+            if read_seq is None or read_seq == "*":
+                continue  # Reads stored without a sequence, which pySAM gives as None and bamnostic as "*"
+            read_len = len(read_seq)
+            read_at_base_pos = start - read.reference_start - 1
+            if read_at_base_pos < 0 or read_at_base_pos > read_len:
+                continue
+
+            # Clip the window to the part lying inside the read; data_lo and data_hi are indices into the window
+            data_lo = max(1, data_mid_index - read_at_base_pos)
+            data_hi = min(self.window_len - 1, data_mid_index - read_at_base_pos + read_len)
+            if data_lo >= data_hi:
+                continue
+            read_lo = read_at_base_pos - data_mid_index + data_lo
+            read_hi = read_at_base_pos - data_mid_index + data_hi
+
+            base_codes = np.frombuffer(read_seq[read_lo:read_hi].encode("ascii"), dtype=np.uint8)
+            if not base_is_known[base_codes].all():
+                for code in np.unique(base_codes[~base_is_known[base_codes]]):
+                    warnings.warn(f"Interpreting {chr(code)} as missing base.")
+
+            out_data[data_lo:data_hi, j, :4] = base_lut[base_codes]
+            out_data[data_lo:data_hi, j, 4] = np.asarray(read.query_qualities[read_lo:read_hi])
+            out_data[data_lo:data_hi, j, 5] = read.mapping_quality
+            out_data[data_lo:data_hi, j, 6] = self.reverse_flag if read.is_reverse else 1
+            n_encoded += 1
+
+        stage_timer.count("reads_encoded", n_encoded)
+        return out_data
+
+    @stage_timer.timed("transform")
     def transform(self, abam: alignedBAM, position: tuple, close_file: bool = True):
         """
-        This is the core transform method. It iterates through the reads and bases of the passed alignedBAM
-        and onehot-encodes them before adding additional basewise information and storing everthing in a numpy array.
+        This is the core transform method. It fetches the reads of the passed alignedBAM at the given position
+        and hands them to encode_reads, which onehot-encodes them and adds additional basewise information.
 
         :param abam: Instance of alignedBAM class containing the sequencing file to be tensorised
         :param position: A tuple of chromosome, start, stop
@@ -59,66 +138,54 @@ class singleTensorizer:
         :return: Tensorised numpy.ndarray
         """
 
-        out_data = np.zeros(shape=(self.window_len, self.max_reads, 7))
-
         if abam is None or abam.ID is None:
             warnings.warn("Got a None-type abam! Returning all zeros.")
+            return np.zeros(shape=(self.window_len, self.max_reads, 7), dtype=self.dtype)
+        if self.cache is None:
+            return self._transform(abam, position, close_file)
+
+        key = self.cache_key(abam.ID, position)
+        out_data = self.cache.get(key)
+        if out_data is not None:
+            if out_data.size == 0:
+                raise NoReadsError("No reads at requested position!")
             return out_data
+
+        try:
+            out_data = self._transform(abam, position, close_file)
+        except NoReadsError:
+            self.cache.put(key, None)
+            raise
+        self.cache.put(key, out_data)
+
+        return out_data
+
+    def identity(self):
+        """
+        :return: Tuple of the settings determining the tensors, e.g. for checkpointedBuild.build_fingerprint
+        """
+        return self.window_n, self.max_reads, self.dtype.str, self.encoder_version
+
+    def cache_key(self, bam_ID, position: tuple):
+        return (bam_ID, *position, self.window_n, self.max_reads, self.dtype.str, self.encoder_version)
+
+    def is_cached(self, bam_ID, position: tuple):
+        """
+        :param bam_ID: ID of the alignedBAM
+        :param position: A tuple of chromosome, start, stop
+        :return: Whether transform finds the track in the cache, and thus does not need to read the bam file
+        """
+        return self.cache is not None and self.cache_key(bam_ID, position) in self.cache
+
+    def _transform(self, abam: alignedBAM, position: tuple, close_file: bool):
         if not abam.is_opened:
             abam.open_file()
         if not abam.has_reads(position):
             raise NoReadsError("No reads at requested position!")
 
 
-        data_mid_index = self.window_n  # This will be needed for some index juggling
         chr_name, start, stop = position
-
-        # We iterate through all reads in the outer loop.
-        for j, read in enumerate(abam.alignment_file.fetch(*position)):
-            if j >= self.max_reads:
-                break
-
-            if read.is_reverse:
-                read_reverse_flag = -1
-            else:
-                read_reverse_flag = 1
-
-            # Index shuffling, if the read somehow does not contain the requested position, it is skipped
-            read_len = len(read.seq)
-            read_at_base_pos = start - read.pos - 1
-            bases_to_left = start - read.pos - 1
-            bases_to_right = read_len - bases_to_left
-            if bases_to_left < 0 or bases_to_right < 0:
-                continue
-
-            # In the inner loop, we iterate over bases, moving outwards from the position of the substituted base.
-            for m in range(self.window_n):
-                r_in_data_position = data_mid_index + m
-                r_in_read_position = read_at_base_pos + m
-                l_in_data_position = data_mid_index - m
-                l_in_read_position = read_at_base_pos - m
-
-                # For each step, we make sure that we're still inside the read. The IndexError exceptions are to
-                # not accidentally wrap around using the python -1 indexing. If the requested position index
-                # exceeds the length of the read, an IndexError is also automatically raised.
-                try:
-                    if l_in_data_position < 0 or l_in_read_position < 0:
-                        raise IndexError
-                    out_data[l_in_data_position, j, :4] = onehot_encode_base(read.seq[l_in_read_position])
-                    out_data[l_in_data_position, j, 4] = read.query_qualities[l_in_read_position]
-                    out_data[l_in_data_position, j, 5] = read.mapping_quality
-                    out_data[l_in_data_position, j, 6] = read_reverse_flag
-                except IndexError:
-                    pass
-                try:
-                    if r_in_data_position < 0 or r_in_read_position < 0:
-                        raise IndexError
-                    out_data[r_in_data_position, j, :4] = onehot_encode_base(read.seq[r_in_read_position])
-                    out_data[r_in_data_position, j, 4] = read.query_qualities[r_in_read_position]
-                    out_data[r_in_data_position, j, 5] = read.mapping_quality
-                    out_data[r_in_data_position, j, 6] = read_reverse_flag
-                except IndexError:
-                    pass
+        out_data = self.encode_reads(abam.reads_at(position), start)
 
         if close_file:
             abam.close_file()
@@ -0,0 +1,221 @@
+import os
+import json
+import time
+import functools
+import threading
+
+"""
+This file contains the timing instrumentation of the data pipeline. Functions of the pipeline are decorated with
+stage_timer.timed, and blocks of code are wrapped in stage_timer.section, each naming the stage they belong to. While
+the timer is disabled, which is the default, these only check a flag. Once enabled, the time spent in every stage and
+the number of calls are summed up, together with counters such as the number of loci tensorised and reads encoded.
+
+The stages of the pipeline are open_file (alignmentFilePool, whenever it actually builds an AlignmentFile, from
+whichever thread), fetch, has_reads (alignedBAM), transform (singleTensorizer),
+context_selection (contextTensorizer), writer (tensorWriter), prefetch (regionPrefetcher, in background threads) and
+prefetch_wait (time the encoding waits for the regionPrefetcher).
+Stages nest, e.g. singleTensorizer.transform includes the has_reads check it makes, so the times of all stages do not
+add up to the total. Reads streamed straight from the file, outside of a fetched region, are decoded lazily as they are
+consumed; fetch includes that time (see timed_iter), which is thus also part of the stages consuming them. Worker
+processes of parallelTensorizer start from an empty timer and send their timings back with each shard.
+"""
+
+
+class _section:
+    __slots__ = ["timer", "stage", "start_time"]
+
+    def __init__(self, timer, stage):
+        self.timer = timer
+        self.stage = stage
+
+    def __enter__(self):
+        if self.timer.enabled:
+            self.start_time = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        if self.timer.enabled:
+            self.timer.add(self.stage, time.perf_counter() - self.start_time)
+        return False
+
+
+class stageTimer:
+    """
+    Sums up time spent and calls made per stage of the pipeline, and counts loci and reads. See the description of
+    this file.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.progress_interval = None
+        self._lock = threading.Lock()  # Stages and counters are also updated from the prefetch threads
+        self.reset()
+
+    def reset(self):
+        self.totals = {}
+        self.calls = {}
+        self.counters = {}
+        self.start_time = time.perf_counter()
+        self._last_progress = self.start_time
+        self._drained = self._snapshot()
+
+    def enable(self, progress_interval: float = None):
+        """
+        Starts timing, discarding anything recorded before.
+
+        :param progress_interval: If given, progress prints a line at most every progress_interval seconds
+        :return: None
+        """
+        self.enabled = True
+        self.progress_interval = progress_interval
+        self.reset()
+
+    def disable(self):
+        self.enabled = False
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.totals[stage] = self.totals.get(stage, 0.) + seconds
+            self.calls[stage] = self.calls.get(stage, 0) + 1
+
+    def count(self, name: str, n: int = 1):
+        if self.enabled:
+            with self._lock:
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def timed(self, stage: str):
+        """
+        Decorator adding the time spent in a function to a stage.
+
+        :param stage: Name of the stage
+        """
+        def decorator(fn):
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return fn(*args, **kwargs)
+                start_time = time.perf_counter()
+                try:
+                    return fn(*args, **kwargs)
+                finally:
+                    self.add(stage, time.perf_counter() - start_time)
+            return wrapper
+        return decorator
+
+    def section(self, stage: str):
+        """
+        :param stage: Name of the stage
+        :return: Context manager adding the time spent inside it to the stage
+        """
+        return _section(self, stage)
+
+    def timed_iter(self, stage: str, make_iterable):
+        """
+        Times an iterable which does its work lazily, e.g. reads streamed from a file, so that the time spent getting its
+        items is added to the stage, and not only the time spent creating it. The time is added as one call once the
+        iteration ends or is abandoned.
+
+        :param stage: Name of the stage
+        :param make_iterable: Callable returning the iterable, which is called right away
+        :return: Iterator over the items
+        """
+        if not self.enabled:
+            return make_iterable()
+        start_time = time.perf_counter()
+        iterator = iter(make_iterable())
+        return self._timed_iter(stage, iterator, time.perf_counter() - start_time)
+
+    def _timed_iter(self, stage, iterator, elapsed):
+        try:
+            while True:
+                start_time = time.perf_counter()
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    elapsed += time.perf_counter() - start_time
+                    return
+                elapsed += time.perf_counter() - start_time
+                yield item
+        finally:
+            self.add(stage, elapsed)
+
+    def _snapshot(self):
+        return {"totals": dict(self.totals), "calls": dict(self.calls), "counters": dict(self.counters)}
+
+    def snapshot(self):
+        """
+        :return: Dictionary of everything recorded so far, to be merged into the timer of another process
+        """
+        with self._lock:
+            return self._snapshot()
+
+    def drain(self):
+        """
+        :return: Snapshot of what was recorded since the last call of drain, e.g. to be sent to another process
+        """
+        with self._lock:
+            snapshot = self._snapshot()
+            delta = {key: {name: value - self._drained[key].get(name, 0) for name, value in snapshot[key].items()}
+                     for key in snapshot}
+            self._drained = snapshot
+        return delta
+
+    def merge(self, snapshot: dict):
+        with self._lock:
+            for stage, seconds in snapshot["totals"].items():
+                self.totals[stage] = self.totals.get(stage, 0.) + seconds
+            for stage, n in snapshot["calls"].items():
+                self.calls[stage] = self.calls.get(stage, 0) + n
+            for name, n in snapshot["counters"].items():
+                self.counters[name] = self.counters.get(name, 0) + n
+
+    def summary(self):
+        """
+        :return: Dictionary with wall time, counters and their rates per second of wall time, and per stage the number
+                 of calls, the total time and the mean time per call
+        """
+        wall_time = time.perf_counter() - self.start_time
+        snapshot = self.snapshot()
+        totals, calls, counters = snapshot["totals"], snapshot["calls"], snapshot["counters"]
+        return {"wall_s": wall_time,
+                "counters": counters,
+                "per_s": {name: n / wall_time for name, n in counters.items()} if wall_time > 0 else {},
+                "stages": {stage: {"calls": calls[stage], "total_s": totals[stage],
+                                   "mean_ms": 1000 * totals[stage] / calls[stage]}
+                           for stage in sorted(totals)}}
+
+    def write_summary(self, path):
+        """
+        Writes summary to a JSON file.
+
+        :param path: Path of the JSON file
+        :return: The summary
+        """
+        summary = self.summary()
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        return summary
+
+    def progress(self, n_total: int = None):
+        """
+        Prints a line with the number of loci done and the current throughput, if progress lines are enabled and the
+        last one is at least progress_interval seconds old.
+
+        :param n_total: Optional total number of loci
+        :return: None
+        """
+        if not self.enabled or self.progress_interval is None:
+            return
+        now = time.perf_counter()
+        if now - self._last_progress < self.progress_interval:
+            return
+        self._last_progress = now
+
+        n_loci = self.counters.get("loci", 0)
+        wall_time = now - self.start_time
+        of_total = f" of {n_total}" if n_total is not None else ""
+        print(f"[{os.getpid()}] {n_loci}{of_total} loci, {n_loci / wall_time:.1f} loci/s, "
+              f"{self.counters.get('reads_encoded', 0) / wall_time:.0f} reads/s")
+
+
+# The timer of the process, used by all instrumented functions
+stage_timer = stageTimer()
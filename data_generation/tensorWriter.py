@@ -0,0 +1,171 @@
+import os
+import numpy as np
+from stageTimer import stage_timer
+
+
+class tensorWriter:
+    """
+    This class writes tensors of candidate variants straight into a preallocated .npy file on disk, instead of
+    collecting them in a list and stacking them at the end, so that the size of a dataset is bounded by disk and
+    not by RAM.
+
+    The file is created with its final header up front and opened as np.memmap, and each tensor goes into the row of
+    its locus as soon as it is produced. Since the mapping is shared, worker processes forked after construction can
+    write their rows themselves. Loci whose tensorisation failed are removed when the writer is finalized, at which
+    point the labels and the locus IDs of the kept rows are written into side files.
+    """
+
+    suffix = ".npy"  # Of the path of a dataset
+    shareable = True  # Whether worker processes forked after construction can write into the same writer
+
+    def __init__(self, path, n_rows: int, row_shape: tuple, dtype=np.float64, labels_path=None, loci_path=None,
+                 indices: list = None, resume: bool = False):
+        """
+        Constructor
+
+        :param path: Path of the .npy file to be written
+        :param n_rows: Number of loci to be tensorised
+        :param row_shape: Shape of a single tensor, e.g. from bamStruct.tensor_shape
+        :param dtype: dtype of the stored tensors
+        :param labels_path: Optional path of a .npy file of labels of the kept loci
+        :param loci_path: Optional path of a csv file with the IDs of the kept loci
+        :param indices: Optional list of the indices of the loci this file holds rows for, in order, if these are not
+        simply 0 to n_rows - 1, e.g. for a shard of a larger dataset
+        :param resume: Whether to reopen the file at path as left by an interrupted run, instead of creating it anew
+        """
+        self.path = path
+        self.n_rows = n_rows
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.labels_path = labels_path
+        self.loci_path = loci_path
+
+        self.row_of = {k: row for row, k in enumerate(indices)} if indices is not None else None
+
+        if resume:
+            self.data = np.load(path, mmap_mode="r+")
+            assert self.data.shape == (n_rows,) + self.row_shape and self.data.dtype == self.dtype
+        else:
+            self.data = np.lib.format.open_memmap(path, mode="w+", dtype=self.dtype, shape=(n_rows,) + self.row_shape)
+
+    def __getstate__(self):
+        # A writer sent to another process reopens the file there instead of pickling its contents
+        state = self.__dict__.copy()
+        state["data"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.data = np.load(self.path, mmap_mode="r+")
+
+    @stage_timer.timed("writer")
+    def write(self, k: int, tensor: np.ndarray):
+        """
+        :param k: Index of the locus, i.e. row of the file unless indices were given
+        :param tensor: Tensor of shape row_shape
+        :return: None
+        """
+        self.data[k if self.row_of is None else self.row_of[k]] = tensor
+
+    def write_shard(self, shard, indices: list, skip=()):
+        """
+        Copies the rows of a dataset written by another tensorWriter, e.g. a shard of a checkpointed build.
+
+        :param shard: The other dataset, as returned by open
+        :param indices: Indices of the loci of the rows of shard, in order
+        :param skip: Indices of loci which are not copied
+        :return: None
+        """
+        for row, k in enumerate(indices):
+            if k not in skip:
+                self.write(k, shard[row])
+
+    def flush(self):
+        self.data.flush()
+
+    @staticmethod
+    def open(path):
+        """
+        :param path: Path of a finished dataset
+        :return: The dataset, opened read-only as np.memmap
+        """
+        return np.load(path, mmap_mode="r")
+
+    def finalize(self, kept: list, labels=None, ploci=None, pattern="GL_ID;CL_ID;chromosome;start;stop;ref;alt"):
+        """
+        Moves the rows of the kept loci together, shrinks the file accordingly and writes the side files.
+
+        :param kept: Sorted list of the indices of successfully tensorised loci
+        :param labels: Labels of all loci, written for the kept ones to labels_path
+        :param ploci: pairLocus objects of all loci, written for the kept ones to loci_path
+        :param pattern: Attributes of the pairLocus objects to write, as in pairLocus.write_to
+        :return: The finished dataset, opened read-only as np.memmap
+        """
+
+        # Rows only ever move towards the front, so this can be done in place, one row at a time
+        rows = kept if self.row_of is None else [self.row_of[k] for k in kept]
+        for new_row, row in enumerate(rows):
+            if new_row != row:
+                self.data[new_row] = self.data[row]
+        self.data.flush()
+        self.data = None
+
+        if len(rows) < self.n_rows:
+            shrink_npy(self.path, len(rows))
+
+        write_side_files(kept, self.labels_path, labels, self.loci_path, ploci, pattern)
+
+        return self.open(self.path)
+
+
+def write_side_files(kept: list, labels_path=None, labels=None, loci_path=None, ploci=None,
+                     pattern="GL_ID;CL_ID;chromosome;start;stop;ref;alt"):
+    """
+    Writes the labels and the locus IDs of the kept loci of a finished dataset, see tensorWriter.finalize.
+
+    :param kept: Sorted list of the indices of successfully tensorised loci
+    :param labels_path: Optional path of a .npy file of labels of the kept loci
+    :param labels: Labels of all loci
+    :param loci_path: Optional path of a csv file with the IDs of the kept loci
+    :param ploci: pairLocus objects of all loci
+    :param pattern: Attributes of the pairLocus objects to write, as in pairLocus.write_to
+    :return: None
+    """
+
+    if labels_path is not None and labels is not None:
+        with open(labels_path, "wb") as f:
+            np.save(f, np.array(labels)[kept].astype(int))
+
+    if loci_path is not None and ploci is not None:
+        with open(loci_path, "w") as f:
+            f.write(pattern + "\n")
+            for k in kept:
+                ploci[k].write_to(f, pattern=pattern)
+
+
+def shrink_npy(path, n_rows: int):
+    """
+    Cuts a .npy file down to its first n_rows rows, without reading it. The header is rewritten for the new shape and
+    padded to its old length, so that the data does not have to move.
+
+    :param path: Path of the .npy file
+    :param n_rows: New length of the first axis
+    :return: None
+    """
+
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        data_offset = f.tell()
+        assert not fortran_order and n_rows <= shape[0]
+
+        new_shape = (n_rows,) + tuple(shape[1:])
+        header = repr({"descr": np.lib.format.dtype_to_descr(dtype), "fortran_order": False, "shape": new_shape})
+        header_start = 8 + (2 if version == (1, 0) else 4)  # Magic string, version, length of header
+        f.seek(header_start)
+        f.write(header.ljust(data_offset - header_start - 1).encode("latin1") + b"\n")
+
+    os.truncate(path, data_offset + int(np.prod(new_shape)) * dtype.itemsize)
@@ -0,0 +1,115 @@
+import hashlib
+import os
+import threading
+import numpy as np
+
+
+class trackCache:
+    """
+    This class is an on-disk cache of single-track tensors, so that tracks which are tensorised in several dataset
+    builds (e.g. germline and tumour, which appear in the nocontext as well as in every contexted dataset) are only
+    computed once. Entries are keyed by bam_ID, position and the settings of the singleTensorizer, including its
+    encoder_version, and stored as one .npy file each, named by the hash of the key. Positions without reads are
+    cached as well, as empty arrays.
+
+    The total size of the cache is capped at roughly max_bytes; beyond that, the least recently used entries are
+    deleted. Several processes can share a cache folder, since every entry is written to a temporary file first and
+    then moved into place.
+    """
+
+    def __init__(self, cache_folder, max_bytes: int = 50 * 1024 ** 3):
+        """
+        Constructor
+
+        :param cache_folder: Folder in which the entries are stored
+        :param max_bytes: Maximal size of the cache on disk
+        """
+        self.cache_folder = cache_folder
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(cache_folder, exist_ok=True)
+
+        self._size = sum(entry_size for _, entry_size, _ in self._entries())
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode()).hexdigest()
+        return os.path.join(self.cache_folder, digest[:2], digest + ".npy")
+
+    def _entries(self):
+        for subfolder in os.scandir(self.cache_folder):
+            if not subfolder.is_dir():
+                continue
+            for entry in os.scandir(subfolder.path):
+                if entry.name.endswith(".npy"):
+                    stat = entry.stat()
+                    yield stat.st_mtime, stat.st_size, entry.path
+
+    def get(self, key):
+        """
+        :param key: Tuple identifying the track tensor
+        :return: The cached np.ndarray (empty if the position has no reads), or None if the key is not cached
+        """
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                tensor = np.load(f)
+        except (FileNotFoundError, ValueError, EOFError):
+            self.misses += 1
+            return None
+
+        try:
+            os.utime(path)  # Marks the entry as recently used
+        except FileNotFoundError:
+            pass
+        self.hits += 1
+        return tensor
+
+    def __contains__(self, key):
+        """
+        Checks for an entry without loading it or counting a hit or miss.
+        """
+        return os.path.exists(self._path(key))
+
+    def put(self, key, tensor):
+        """
+        :param key: Tuple identifying the track tensor
+        :param tensor: np.ndarray to store, or None to store that the position has no reads
+        :return: None
+        """
+        if tensor is None:
+            tensor = np.zeros(0, dtype=np.uint8)
+
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "wb") as f:
+            np.save(f, tensor)
+        os.replace(temp_path, path)
+
+        self._size += os.path.getsize(path)
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self, fraction: float = 0.9):
+        """
+        Deletes the least recently used entries until the cache is below the given fraction of max_bytes.
+
+        :param fraction: Fraction of max_bytes to shrink to
+        :return: None
+        """
+        entries = sorted(self._entries())
+        self._size = sum(entry_size for _, entry_size, _ in entries)
+        for _, entry_size, path in entries:
+            if self._size <= fraction * self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._size -= entry_size
+
+    def stats(self):
+        n_requests = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "bytes": self._size,
+                "hit_rate": self.hits / n_requests if n_requests > 0 else 0.}
@@ -1,38 +1,129 @@
+import os
+import zipfile
+import numpy as np
 from pairLocus import pairLocus
+from locusIndex import locusIndex
+from lazyPloci import lazyPloci
+from locusTable import encode_column, decode_column
 import pandas as pd
 
+"""
+Parsing spreadsheets is slow, so the confirmed calls of every sheet are cached in a .npz file next to it, named as
+the sheet with the suffix .confirmed.npz. The cache holds the columns used below, after the manually called variants
+are removed, and is keyed on the absolute path, modification time and size of the sheet. It is rebuilt whenever the
+sheet changes, and if it cannot be written, e.g. in a read-only folder, the sheet is simply parsed every time.
+
+The cache is read without unpickling anything. Numeric columns are stored as they are, with NaN for blank cells, and
+all other columns dictionary-encoded as in locusTable, which keeps the type of every value (e.g. a Chr column mixing
+ints and strings) and tells blank cells (NaN) apart from None. Together with the dtype of each column, the cached calls
+are thus the same as parsed from the sheet. Sheets with values of other types are not cached.
+"""
+
+confirmed_columns = ["Ref", "Alt", "Chr", "Start", "End", "Func.RefGene"]
+
 class validatedSNPlist:
     """
     This class is purely for convenience of storing validated candidate variants for a pair of germline and tumour.
     It is only a wrapper around an actual list of pairLocus objects (which store the compared samples and the position),
-    with a slightly more robust __contains__ to avoid some funky behaviour.
+    with a slightly more robust __contains__ to avoid some funky behaviour. Lookups go through a locusIndex keyed on
+    samples and position.
     """
 
     def __init__(self, GL_ID: str, CL_ID: str, loci_list: list):
         self.GL_ID = GL_ID
         self.CL_ID = CL_ID
         self.loci_list = loci_list  # List of pairLocus objects
+        self.index = locusIndex(loci_list)
 
     def is_present(self, plocus: pairLocus):
+        return plocus in self.index
 
-        test_output = False
-        for present_plocus in self.loci_list:
-            if all([plocus.GL_ID == present_plocus.GL_ID,
-                    plocus.CL_ID == present_plocus.CL_ID,
-                    plocus.chromosome == present_plocus.chromosome,
-                    plocus.start == present_plocus.start,
-                    plocus.stop == present_plocus.stop]):
+    def __contains__(self, item: pairLocus):
+        return self.is_present(item)
 
-                test_output = True
 
+def _sheet_key(snplist_xlsx_path):
+    # Raises FileNotFoundError for missing sheets and ValueError for paths which are not paths (e.g. a blank cell of
+    # the annovarlist, read as NaN), as pd.read_excel would
+    if not isinstance(snplist_xlsx_path, (str, os.PathLike)):
+        raise ValueError(f"Invalid path of a spreadsheet: {snplist_xlsx_path!r}")
+    stat = os.stat(snplist_xlsx_path)
+    return np.array([os.path.abspath(snplist_xlsx_path), str(stat.st_mtime_ns), str(stat.st_size)])
+
+
+def _load_cached_calls(cache_path, key: np.ndarray):
+    if not zipfile.is_zipfile(cache_path):  # Missing or broken, np.load would try to unpickle the latter
+        return None
+    try:
+        with np.load(cache_path, allow_pickle=False) as f:
+            if f["key"].tolist() != key.tolist():
+                return None
+            columns = {}
+            for name in confirmed_columns:
+                if f"column_{name}" in f.files:
+                    values = f[f"column_{name}"]
+                else:
+                    values = decode_column(f[f"codes_{name}"], f[f"categories_{name}"], f[f"kinds_{name}"])
+                columns[name] = pd.Series(values, dtype=f[f"dtype_{name}"].item())
+            return pd.DataFrame(columns)
+    except (OSError, ValueError, KeyError, zipfile.BadZipFile):
+        return None
+
+
+def _save_cached_calls(cache_path, key: np.ndarray, calls: pd.DataFrame):
+    arrays = {"key": key}
+    for name in confirmed_columns:
+        arrays[f"dtype_{name}"] = np.array(str(calls[name].dtype))
+        values = calls[name].to_numpy()
+        if values.dtype.kind in "biufmM":
+            arrays[f"column_{name}"] = values
+            continue
+        try:
+            arrays[f"codes_{name}"], arrays[f"categories_{name}"], arrays[f"kinds_{name}"] = encode_column(values)
+        except TypeError:
+            return  # A value which cannot be stored without pickling, so the sheet is parsed every time
+
+    temp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        with open(temp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(temp_path, cache_path)
+    except OSError:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+
+
+def read_confirmed_calls(snplist_xlsx_path, use_cache: bool = True):
+    """
+    Reads the computer-confirmed calls of a spreadsheet, through the cache described at the top of this file.
 
-        return test_output
+    :param snplist_xlsx_path: Path (absolute or relative) to excel file, see build_validatedSNPlist
+    :param use_cache: Whether to read from and write to the cache
+    :return: pd.DataFrame with the columns 'Ref', 'Alt', 'Chr', 'Start', 'End', 'Func.RefGene'
+    """
+    key = _sheet_key(snplist_xlsx_path)
+    cache_path = snplist_xlsx_path + ".confirmed.npz"
+    if use_cache:
+        cached_calls = _load_cached_calls(cache_path, key)
+        if cached_calls is not None:
+            return cached_calls
 
-    def __contains__(self, item: pairLocus):
-        return self.is_present(item)
+    all_confirmed_calls_xlsx = pd.read_excel(snplist_xlsx_path)
+
+    if "comment" in all_confirmed_calls_xlsx.columns:
+        computer_confirmed_xlsx_mask = all_confirmed_calls_xlsx["comment"] != "manually called"
+        confirmed_calls_xlsx = all_confirmed_calls_xlsx[computer_confirmed_xlsx_mask]
+    else:
+        confirmed_calls_xlsx = all_confirmed_calls_xlsx
 
+    confirmed_calls_xlsx = confirmed_calls_xlsx[confirmed_columns].reset_index(drop=True)
+    if use_cache:
+        _save_cached_calls(cache_path, key, confirmed_calls_xlsx)
 
-def build_validatedSNPlist(GL_ID: str, CL_ID: str, snplist_xlsx_path):
+    return confirmed_calls_xlsx
+
+
+def build_validatedSNPlist(GL_ID: str, CL_ID: str, snplist_xlsx_path, use_cache: bool = True):
     """
     This function constructs a validatedSNPlist from an Excel sheet of manually confirmed calls.
     It should have columns named 'Ref', 'Alt', 'Chr', 'Start', 'End', 'Func.RefGene', as per the column names
@@ -44,30 +135,18 @@ def build_validatedSNPlist(GL_ID: str, CL_ID: str, snplist_xlsx_path):
     :param GL_ID: ID of germline sample
     :param CL_ID: ID of tumour sample
     :param snplist_xlsx_path: Path (absolute or relative) to excel file containing
+    :param use_cache: Whether to go through the cache of parsed sheets, see the top of this file
     :return: An instance of validatedSNPlist
     """
 
-    all_confirmed_calls_xlsx = pd.read_excel(snplist_xlsx_path)
-
-    if "comment" in all_confirmed_calls_xlsx.columns:
-        computer_confirmed_xlsx_mask = all_confirmed_calls_xlsx["comment"].apply(lambda x: x != "manually called")
-        confirmed_calls_xlsx = all_confirmed_calls_xlsx[computer_confirmed_xlsx_mask]
-    else:
-        confirmed_calls_xlsx = all_confirmed_calls_xlsx
+    confirmed_calls_xlsx = read_confirmed_calls(snplist_xlsx_path, use_cache=use_cache)
 
-    loci_list = []
-    for k, row in confirmed_calls_xlsx.iterrows():
-        loci_list.append(pairLocus(GL_ID=GL_ID, ref=row["Ref"],
-                                   CL_ID=CL_ID, alt=row["Alt"],
-                                   chromosome=row["Chr"],
-                                   start=row["Start"],
-                                   stop=row["End"] + 1,  # The +1 here is ultimately because samtools is 1-indexed
-                                   funcrefgene=row["Func.RefGene"]))
+    calls = pd.DataFrame({"GL_ID": GL_ID, "CL_ID": CL_ID,
+                          "ref": confirmed_calls_xlsx["Ref"], "alt": confirmed_calls_xlsx["Alt"],
+                          "chromosome": confirmed_calls_xlsx["Chr"],
+                          "start": confirmed_calls_xlsx["Start"],
+                          "stop": confirmed_calls_xlsx["End"] + 1,  # The +1 here is ultimately because samtools is 1-indexed
+                          "funcrefgene": confirmed_calls_xlsx["Func.RefGene"]})
+    loci_list = lazyPloci(calls).materialize()
 
     return validatedSNPlist(GL_ID=GL_ID, CL_ID=CL_ID, loci_list=loci_list)
-
-
-
-
-
-
@@ -14,17 +14,44 @@ from data_generation.singleTensorizer import singleTensorizer
 from data_generation.contextTensorizer import random_context_tensorize_once, nocontext_depth_tensorize_plocus
 from data_generation.generatePLoci import get_ploci_from_annovarlist, get_ploci_from_multianno
 from data_generation.pairLocus import pairLocus
-import pickle
+from data_generation.locusIndex import locusIndex, dedup_ploci
+from data_generation.locusTable import locusTable
+from data_generation.exclusionRegions import exclusionRegions
+from data_generation.checkpointedBuild import build_checkpointed, writer_classes
+from data_generation.raggedTensor import raggedTensor
+from data_generation.trackCache import trackCache
+from data_generation.coverageMatrix import load_or_build_coverage_matrix
+from data_generation.stageTimer import stage_timer
+from functools import partial
 import os
+import shutil
 import random
 import glob
 
+n_workers = os.cpu_count()  # Number of worker processes for tensorisation, 1 runs everything in this process
+tensor_dtype = np.uint8  # Compact storage, decoded on load in training; np.float64 gives the original format
+# "dense" writes .npy files, "ragged" folders holding only the reads actually present (see raggedTensor.py), which the
+# memmapSequence of the training scripts reads in place of the .npy files, padding every batch as it is loaded
+tensor_storage = "dense"
+tensor_suffix = writer_classes[tensor_storage].suffix
+prefetch_depth = 4  # Number of clusters of loci each worker reads ahead while encoding, 0 disables prefetching
+shard_size = 2000  # Number of loci per checkpointed shard, an interrupted run resumes after the last finished shard
+timing = True  # Whether to time the stages of the pipeline, summarised in timings_path at the end
+progress_interval = 60  # Seconds between progress lines while timing, None for no progress lines
+timings_path = os.path.abspath("./data/timings.json")
+
+if timing:
+    stage_timer.enable(progress_interval=progress_interval)
+
 in_facility_path = os.path.abspath("./data/in_facility")
 os.makedirs(in_facility_path, exist_ok=True)
 
 bambook_path = os.path.join(in_facility_path, "if_bamlist.csv")
 annovarlist_path = os.path.join(in_facility_path, "if_annovarlist.csv")
 
+# Single-track tensors are cached on disk, so that tracks shared by several datasets are only tensorised once
+track_cache = trackCache(os.path.abspath("./data/track_cache"))
+
 # Import the list of available bams, build alignedBAM objects for them all for later use
 print("Importing list of bam files.")
 
@@ -42,17 +69,29 @@ all_abams[None] = None
 # Now that we have all bams ready, we can construct the candidate variants.
 print("Building ploci for SNPs...")
 
-ploci, labels = get_ploci_from_annovarlist(annovarlist_path, kick_indels=True)
+ploci, labels = get_ploci_from_annovarlist(annovarlist_path, kick_indels=True, n_workers=n_workers)
 assert len(ploci) == len(labels)
+
+# The same locus of the same pair may be called in several ANNOVAR files, it is only tensorised once
+kept, duplicates = dedup_ploci(ploci, labels)
+if duplicates:
+    print(f"Dropping {len(duplicates)} repeated calls.")
+    ploci = [ploci[k] for k in kept]
+    labels = [labels[k] for k in kept]
 print(f"Done. Length: {len(ploci)}")
-with open("./data/in_facility/ploci.pkl", "wb") as f:
-    pickle.dump(ploci, f)
+locusTable.from_ploci(ploci).save("./data/in_facility/ploci.npz")  # Load with locusTable.load
 
 
 random.seed(42)
 np.random.seed(42)
 
 
+def report_failures(failures, failed_ploci, part_name):
+    for k, error in failures:
+        print(f"Tensorization of {failed_ploci[k].to_string()} in {part_name} part failed due to the following error: "
+              f"{error}. Continuing.")
+
+
 """
 Next, we want to build the in-facility input data. We build one dataset of only GL and CL, and
 one with up to k = 2 comparisons of same library, different line.
@@ -63,15 +102,23 @@ nocontext_folder = os.path.join(in_facility_path, "nocontext")
 os.makedirs(os.path.abspath(nocontext_folder), exist_ok=True)
 
 nocontext_bamstruct = bamStruct(window_n=50, max_reads=200, n_comparison_bams=0)
-nocontext_stensorizer = singleTensorizer(bstruct=nocontext_bamstruct)
+nocontext_stensorizer = singleTensorizer(bstruct=nocontext_bamstruct, dtype=tensor_dtype, cache=track_cache)
+
+# Loci are tensorized in genome order, so that neighbouring loci share one region fetch per BAM, and every tensor is
+# written straight to disk, in checkpointed shards which are joined into the output file at the end. Failing loci are
+# reported and left out, together with their labels.
+big_nocontext_tensor, _, nocontext_failures = build_checkpointed(
+    ploci, partial(nocontext_depth_tensorize_plocus, nocontext_stensorizer, abam_dict=all_abams), all_abams,
+    os.path.join(nocontext_folder, "nocontext_depth_tensor" + tensor_suffix),
+    row_shape=nocontext_bamstruct.tensor_shape(stack_axis=2), dtype=tensor_dtype, storage=tensor_storage,
+    labels=labels,
+    labels_path=os.path.join(nocontext_folder, "nocontext_labels.npy"),
+    loci_path=os.path.join(nocontext_folder, "nocontext_loci.csv"),
+    shard_size=shard_size, n_workers=n_workers, prefetch_depth=prefetch_depth,
+    is_cached=nocontext_stensorizer.is_cached)
+report_failures(nocontext_failures, ploci, "nocontext")
 
-nocontext_depth_tensors = [nocontext_depth_tensorize_plocus(nocontext_stensorizer, pl, all_abams) for pl in ploci]
-big_nocontext_tensor = np.stack(nocontext_depth_tensors, axis=0)
-with open(os.path.join(nocontext_folder, "nocontext_depth_tensor.npy"), "wb") as f:
-    np.save(f, big_nocontext_tensor)
 print(f"Shape of big nocontext tensor is: {big_nocontext_tensor.shape}")
-with open(os.path.join("nocontext_labels.npy"), "wb") as f:
-    np.save(f, np.array(labels).astype(int))
 # These are of course identical to the contexted labels later, it's just nicer to keep the folders separate
 
 
@@ -81,29 +128,30 @@ contexted_folder = os.path.join(in_facility_path, "contexted")
 os.makedirs(os.path.abspath(contexted_folder), exist_ok=True)
 
 k2_bamstruct = bamStruct(window_n=50, max_reads=200, n_comparison_bams=2)
-k2_stensorizer = singleTensorizer(bstruct=k2_bamstruct)
-
-x1k2_tensors = []
-x1k2_comp_ids = []
-
-for pl, label in zip(ploci, labels):
-    try:
-        new_tensor, new_comps = random_context_tensorize_once(
-            stensorizer=k2_stensorizer, stack_axis=2, plocus=pl, bambook=bambook,
-            abam_dict=all_abams, k_diffline_samelib=2, k_sameline_samelib=0, label=label)
-        x1k2_tensors += new_tensor
-        x1k2_comp_ids += new_comps  # This is ultimately disregarded and is only tracked for debugging
-    except ValueError as e:
-        print(f"Tensorization in noindel part failed due to the following error: {e}. Continuing.")
-        continue
-
-big_x1k2_tensor = np.stack(x1k2_tensors, axis=0)
-
-with open(os.path.join(contexted_folder, "x1k2_tensor.npy"), "wb") as f:
-    np.save(f, big_x1k2_tensor)
+k2_stensorizer = singleTensorizer(bstruct=k2_bamstruct, dtype=tensor_dtype, cache=track_cache)
+
+# Which tumour tracks have reads at which loci is found out once per BAM, so that choosing the context tracks does not
+# need a fetch for every admissible comparison of every locus. The matrix is stored next to the ploci.
+print("Building coverage matrix of tumour tracks.")
+coverage = load_or_build_coverage_matrix(
+    os.path.join(in_facility_path, "coverage.npz"), ploci, all_abams,
+    bam_IDs=list(bambook.bam_metadf.index[bambook.bam_metadf["type"] == "CL"]), n_workers=n_workers)
+
+# The context tracks are drawn with a seed per locus, so the choice does not depend on the number of workers
+big_x1k2_tensor, x1k2_results, x1k2_failures = build_checkpointed(
+    ploci, partial(random_context_tensorize_once, k2_stensorizer, label=None, bambook=bambook, abam_dict=all_abams,
+                   k_diffline_samelib=2, k_sameline_samelib=0, stack_axis=2, coverage=coverage), all_abams,
+    os.path.join(contexted_folder, "x1k2_tensor" + tensor_suffix),
+    row_shape=k2_bamstruct.tensor_shape(stack_axis=2), dtype=tensor_dtype, storage=tensor_storage, labels=labels,
+    labels_path=os.path.join(contexted_folder, "x1k2_labels.npy"),
+    loci_path=os.path.join(contexted_folder, "x1k2_loci.csv"),
+    shard_size=shard_size, n_workers=n_workers, prefetch_depth=prefetch_depth, is_cached=k2_stensorizer.is_cached)
+report_failures(x1k2_failures, ploci, "x1k2")
+x1k2_kept = sorted(set(range(len(ploci))) - {k for k, error in x1k2_failures})
+
+x1k2_comp_ids = [x1k2_results[k][0] for k in x1k2_kept]  # This is ultimately disregarded and is only tracked for debugging
+
 print(f"Shape of big contexted tensor is: {big_x1k2_tensor.shape}")
-with open(os.path.join(contexted_folder, "x1k2_labels.npy"), "wb") as f:
-    np.save(f, np.array(labels).astype(int))
 
 
 """
@@ -114,6 +162,7 @@ Lastly, we also tensorise the external dataset. Due to differences in formatting
 
 kotani_folder = os.path.abspath("./data/kotani")
 os.makedirs(kotani_folder, exist_ok=True)
+kotani_exclusion_bed_paths = []  # BED files of further blacklisted regions, e.g. repeat masks
 
 
 kotani_bamlist_path = os.path.join(kotani_folder, "relative_bamlist_kotani.csv")
@@ -139,44 +188,45 @@ for filepath in glob.glob(os.path.join(kotani_folder, "06_annovar"
                                             GL_ID=current_GL_ID, CL_ID=current_CL_ID, mouse_ID=mouse_ID)
     kotani_ploci += called_ploci
 
+kotani_ploci = [kotani_ploci[k] for k in dedup_ploci(kotani_ploci)[0]]
+
 # We filter out synonymous, non-exonic, and transduced loci
 filtered_kotani_ploci = [pl for pl in kotani_ploci if pl.funcrefgene == "exonic"]
 
 transduced_regions = [("chr9", 44803354, 44881274),  # Removed for biological reasons,
                       ("chr4", 87769924, 87791965)]  # because this is transduced DNA for the MLL model
 
-filtered_kotani_ploci = [pl for pl in filtered_kotani_ploci if
-                         not any([pl.chromosome == chrom
-                                  and pl.start >= start
-                                  and pl.stop <= stop for chrom, start, stop in transduced_regions])]
+kotani_exclusion = exclusionRegions.from_bed(kotani_exclusion_bed_paths, regions=transduced_regions)
+filtered_kotani_ploci = kotani_exclusion.filter_ploci(filtered_kotani_ploci)
 
 validated_loci_df = pd.read_csv(os.path.join(kotani_folder, "kotani_all_snps.csv"), sep=";")
 validated_ploci_list = [pairLocus(GL_ID=row["GL_ID"], CL_ID=row["CL_ID"], ref=row["Ref"], alt=row["Alt"],
                                   chromosome=row["Chromosome"], start=row["Start"], stop=row["End"], funcrefgene="",
                                   gene=row["Gene"]) for k, row in validated_loci_df.iterrows()]
-kotani_labels = [any([vpl.isSamePosition(pl) and vpl.CL_ID == pl.CL_ID for vpl in validated_ploci_list])
-                 for pl in filtered_kotani_ploci]
-
-kotani_x1k2_tensors = []
-kotani_x1k2_compIDs = []
-for pl, label in zip(filtered_kotani_ploci, kotani_labels):
-    try:
-        new_tensor, new_comps = random_context_tensorize_once(
-            stensorizer=k2_stensorizer, stack_axis=2, plocus=pl, bambook=kotani_bambook,
-            abam_dict=kotani_abams, k_diffline_samelib=2, k_sameline_samelib=0, label=label)
-        kotani_x1k2_tensors += new_tensor
-        kotani_x1k2_compIDs += new_comps
-    except ValueError as e:
-        print(f"Tensorization in noindel part failed due to the following error: {e}. Continuing.")
-        continue
-
-big_kotani_x1k2_tensor = np.stack(x1k2_tensors, axis=0)
-
-with open(os.path.join(kotani_folder, "kotani_x1k2_tensor.npy"), "wb") as f:
-    np.save(f, big_kotani_x1k2_tensor)
+# Confirmed loci are matched on tumour and position only
+validated_index = locusIndex(validated_ploci_list, fields=("CL_ID", "chromosome", "start", "stop"))
+kotani_labels = [pl in validated_index for pl in filtered_kotani_ploci]
+
+kotani_coverage = load_or_build_coverage_matrix(
+    os.path.join(kotani_folder, "kotani_coverage.npz"), filtered_kotani_ploci, kotani_abams,
+    bam_IDs=list(kotani_bambook.bam_metadf.index[kotani_bambook.bam_metadf["type"] == "CL"]), n_workers=n_workers)
+
+big_kotani_x1k2_tensor, kotani_x1k2_results, kotani_x1k2_failures = build_checkpointed(
+    filtered_kotani_ploci, partial(random_context_tensorize_once, k2_stensorizer, label=None, bambook=kotani_bambook,
+                                   abam_dict=kotani_abams, k_diffline_samelib=2, k_sameline_samelib=0, stack_axis=2,
+                                   coverage=kotani_coverage), kotani_abams,
+    os.path.join(kotani_folder, "kotani_x1k2_tensor" + tensor_suffix),
+    row_shape=k2_bamstruct.tensor_shape(stack_axis=2), dtype=tensor_dtype, storage=tensor_storage,
+    labels=kotani_labels,
+    labels_path=os.path.join(kotani_folder, "kotani_x1k2_labels.npy"),
+    loci_path=os.path.join(kotani_folder, "kotani_x1k2_loci.csv"),
+    shard_size=shard_size, n_workers=n_workers, prefetch_depth=prefetch_depth, is_cached=k2_stensorizer.is_cached)
+report_failures(kotani_x1k2_failures, filtered_kotani_ploci, "kotani x1k2")
+kotani_kept = sorted(set(range(len(filtered_kotani_ploci))) - {k for k, error in kotani_x1k2_failures})
+
+kotani_x1k2_compIDs = [kotani_x1k2_results[k][0] for k in kotani_kept]
+
 print(f"Shape of big contexted tensor is: {big_kotani_x1k2_tensor.shape}")
-with open(os.path.join(kotani_folder, "kotani_x1k2_labels.npy"), "wb") as f:
-    np.save(f, np.array(kotani_labels).astype(int))
 
 
 
@@ -188,28 +238,46 @@ def swap_bases(tensor, permutation):
     tensor[:, :, :4] = tensor[:, :, permutation]
 
 
-for k in range(len(big_x1k2_tensor)):
-    p = random.choice(natural_permutations)
-    swap_bases(big_x1k2_tensor[k], p)
-
-with open(os.path.join(contexted_folder, "scrambled_x1k2_tensor.npy"), "wb") as f:
-    np.save(f, big_x1k2_tensor)
-
-
-for k in range(len(big_nocontext_tensor)):
-    p = random.choice(natural_permutations)
-    swap_bases(big_nocontext_tensor[k], p)
-
-with open(os.path.join(nocontext_folder, "scrambled_nocontext_tensor.npy"), "wb") as f:
-    np.save(f, big_nocontext_tensor)
-
-for k in range(len(big_kotani_x1k2_tensor)):
-    p = random.choice(natural_permutations)
-    swap_bases(big_kotani_x1k2_tensor[k], p)
-
-with open(os.path.join(kotani_folder, "scrambled_kotani_x1k2_tensor.npy"), "wb") as f:
-    np.save(f, big_kotani_x1k2_tensor)
-
+def scramble_copy(tensor_path, scrambled_path):
+    # The scrambled dataset is a copy of the file on disk, whose rows are permuted in place one by one
+    if tensor_storage == "ragged":
+        # swap_bases only permutes the first track, whose reads are stored together per locus
+        shutil.copytree(tensor_path, scrambled_path, dirs_exist_ok=True)
+        scrambled_tensor = raggedTensor(scrambled_path, mode="r+")
+        for k in range(len(scrambled_tensor)):
+            p = random.choice(natural_permutations)
+            swap_bases(scrambled_tensor.track_reads(k, 0), p)
+        scrambled_tensor.reads.flush()
+        return
+
+    shutil.copyfile(tensor_path, scrambled_path)
+    scrambled_tensor = np.load(scrambled_path, mmap_mode="r+")
+    for k in range(len(scrambled_tensor)):
+        p = random.choice(natural_permutations)
+        swap_bases(scrambled_tensor[k], p)
+    scrambled_tensor.flush()
+
+
+scramble_copy(os.path.join(contexted_folder, "x1k2_tensor" + tensor_suffix),
+              os.path.join(contexted_folder, "scrambled_x1k2_tensor" + tensor_suffix))
+scramble_copy(os.path.join(nocontext_folder, "nocontext_depth_tensor" + tensor_suffix),
+              os.path.join(nocontext_folder, "scrambled_nocontext_tensor" + tensor_suffix))
+scramble_copy(os.path.join(kotani_folder, "kotani_x1k2_tensor" + tensor_suffix),
+              os.path.join(kotani_folder, "scrambled_kotani_x1k2_tensor" + tensor_suffix))
+
+
+if timing:
+    timings = stage_timer.write_summary(timings_path)
+    print(f"Timings written to {timings_path}:")
+    for stage, stage_timings in timings["stages"].items():
+        print(f"    {stage}: {stage_timings['total_s']:.1f}s in {stage_timings['calls']} calls")
+    print(f"    {timings['counters'].get('loci', 0)} loci and {timings['counters'].get('reads_encoded', 0)} reads "
+          f"in {timings['wall_s']:.1f}s")
+    n_prefetched = timings["counters"].get("prefetch_clusters", 0)
+    if n_prefetched > 0:
+        print(f"    Prefetch queue: {timings['counters']['prefetch_ready'] / n_prefetched:.2f} of "
+              f"{timings['counters']['prefetch_queued'] / n_prefetched:.2f} queued clusters ready on average, waited "
+              f"for {timings['counters'].get('prefetch_waits', 0)} of {n_prefetched} clusters")
 
 print("Data building done. See \"stored_data\" folder for saved files in binary format.")
 
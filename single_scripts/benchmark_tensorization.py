@@ -0,0 +1,202 @@
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import subprocess
+import tempfile
+import warnings
+import numpy as np
+import pandas as pd
+from functools import partial
+sys.path.append(os.path.abspath("../data_generation/"))
+from alignedBAM import alignedBAM, alignment_file_pool, block_cache, pysam
+from bamPhonebook import build_bambook_from_csv
+from bamStruct import bamStruct
+from singleTensorizer import singleTensorizer, NoReadsError
+from contextTensorizer import random_context_tensorize_once, nocontext_depth_tensorize_plocus
+from generatePLoci import get_ploci_from_annovarlist, pairLocus_from_call, cats_used_global
+from parallelTensorizer import seed_locus
+from checkpointedBuild import build_checkpointed
+from stageTimer import stage_timer
+from synthetic_fixtures import make_fixture_set
+
+
+"""
+Offline benchmark suite of the data pipeline, run on a synthetic cohort from synthetic_fixtures.py, which is generated
+first if the fixture folder does not exist yet. The benchmarks are:
+
+    transform: singleTensorizer.transform of germline and tumour tracks, per reader backend given by --backends
+    context: random_context_tensorize_once with k = 2 comparisons
+    annovarlist: get_ploci_from_annovarlist, skipped if the spreadsheets of confirmed calls could not be written
+    build: a generateData-style build of the nocontext and x1k2 datasets, with the timings of its stages
+
+Every run appends one JSON line with the results, the current git commit and the fixture parameters to the results
+file, so that runs of different versions can be compared.
+
+Usage: python benchmark_tensorization.py [--fixtures ./benchmark_fixtures] [--results ./benchmark_results.jsonl]
+                                         [--repeats 3] [--workers 1] [--max-loci 500] [--backends pysam bamnostic]
+"""
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def clear_caches():
+    alignment_file_pool.clear()
+    block_cache.clear()
+
+
+def timed_repeats(fn, repeats: int):
+    """
+    :return: Dictionary of the minimal and median runtime of fn over repeats runs, each started with empty caches,
+             and the output of the last run
+    """
+    times = []
+    output = None
+    for _ in range(repeats):
+        clear_caches()
+        start_time = time.perf_counter()
+        output = fn()
+        times.append(time.perf_counter() - start_time)
+    return {"min_s": min(times), "median_s": float(np.median(times))}, output
+
+
+def load_candidates(annovarlist_path):
+    # The ANNOVAR csvs are read directly, so that this does not need the spreadsheets of confirmed calls
+    ploci = []
+    for _, row in pd.read_csv(annovarlist_path, sep=";").iterrows():
+        calls = pd.read_csv(row["annovar_path"], sep=",", dtype={"Chr": str, "Start": int, "End": int})
+        ploci += [pl for pl in (pairLocus_from_call(row["GL_bam_ID"], row["CL_bam_ID"], call)
+                                for _, call in calls.iterrows())
+                  if pl.funcrefgene in cats_used_global and "-" not in [pl.ref, pl.alt]]
+    return ploci
+
+
+def bench_transform(ploci, bambook, backend, repeats):
+    abams = {ID: alignedBAM(ID, row["bam_path"], row["bai_path"], backend=backend)
+             for ID, row in bambook.bam_metadf.iterrows()}
+    stensorizer = singleTensorizer(bamStruct(window_n=50, max_reads=200))
+
+    def run():
+        n_tensors = 0
+        for pl in ploci:
+            for ID in [pl.GL_ID, pl.CL_ID]:
+                try:
+                    stensorizer.transform(abams[ID], pl.position)
+                    n_tensors += 1
+                except NoReadsError:
+                    pass
+        return n_tensors
+
+    timing, n_tensors = timed_repeats(run, repeats)
+    return {**timing, "n_tensors": n_tensors, "tensors_per_s": n_tensors / timing["min_s"]}
+
+
+def bench_context(ploci, bambook, abams, repeats):
+    stensorizer = singleTensorizer(bamStruct(window_n=50, max_reads=200))
+
+    def run():
+        n_tensors = 0
+        for k, pl in enumerate(ploci):
+            seed_locus(42, k)
+            try:
+                random_context_tensorize_once(stensorizer, pl, None, bambook, abams, k_diffline_samelib=2,
+                                              k_sameline_samelib=0)
+                n_tensors += 1
+            except (NoReadsError, ValueError):
+                pass
+        return n_tensors
+
+    timing, n_tensors = timed_repeats(run, repeats)
+    return {**timing, "n_loci": len(ploci), "n_tensors": n_tensors, "loci_per_s": len(ploci) / timing["min_s"]}
+
+
+def bench_annovarlist(fixture, repeats):
+    if not fixture["has_snplists"]:
+        return {"skipped": "The spreadsheets of confirmed calls were not generated, no Excel engine installed."}
+
+    timing, (ploci, labels) = timed_repeats(
+        lambda: get_ploci_from_annovarlist(fixture["annovarlist_path"], kick_indels=True), repeats)
+    return {**timing, "n_loci": len(ploci), "n_positive": int(sum(labels))}
+
+
+def bench_build(ploci, bambook, abams, n_workers):
+    nocontext_bamstruct = bamStruct(window_n=50, max_reads=200, n_comparison_bams=0)
+    k2_bamstruct = bamStruct(window_n=50, max_reads=200, n_comparison_bams=2)
+    labels = [0] * len(ploci)
+
+    out_folder = tempfile.mkdtemp(prefix="benchmark_build_")
+    try:
+        clear_caches()
+        stage_timer.enable()
+        build_checkpointed(
+            ploci, partial(nocontext_depth_tensorize_plocus,
+                           singleTensorizer(nocontext_bamstruct, dtype=np.uint8), abam_dict=abams), abams,
+            os.path.join(out_folder, "nocontext.npy"), row_shape=nocontext_bamstruct.tensor_shape(stack_axis=2),
+            dtype=np.uint8, labels=labels, n_workers=n_workers)
+        build_checkpointed(
+            ploci, partial(random_context_tensorize_once, singleTensorizer(k2_bamstruct, dtype=np.uint8),
+                           label=None, bambook=bambook, abam_dict=abams, k_diffline_samelib=2, k_sameline_samelib=0),
+            abams, os.path.join(out_folder, "x1k2.npy"), row_shape=k2_bamstruct.tensor_shape(stack_axis=2),
+            dtype=np.uint8, labels=labels, n_workers=n_workers)
+        timings = stage_timer.summary()
+        stage_timer.disable()
+    finally:
+        shutil.rmtree(out_folder)
+
+    return {"wall_s": timings["wall_s"], "n_loci": 2 * len(ploci), "n_workers": n_workers,
+            "loci_per_s": 2 * len(ploci) / timings["wall_s"], "timings": timings}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the tensorisation pipeline on synthetic data.")
+    parser.add_argument("--fixtures", default="./benchmark_fixtures")
+    parser.add_argument("--results", default="./benchmark_results.jsonl")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--max-loci", type=int, default=500)
+    parser.add_argument("--backends", nargs="+", default=["pysam" if pysam is not None else "bamnostic"])
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    fixture_json = os.path.join(args.fixtures, "fixture.json")
+    if not os.path.exists(fixture_json):
+        print(f"Generating fixtures in {args.fixtures}")
+        make_fixture_set(args.fixtures)
+    with open(fixture_json, "r") as f:
+        fixture = json.load(f)
+
+    bambook = build_bambook_from_csv(fixture["bamlist_path"])
+    abams = {ID: alignedBAM(ID, row["bam_path"], row["bai_path"]) for ID, row in bambook.bam_metadf.iterrows()}
+    abams[None] = None
+    ploci = load_candidates(fixture["annovarlist_path"])[:args.max_loci]
+
+    results = {}
+    for backend in args.backends:
+        print(f"Benchmarking transform with {backend}")
+        results[f"transform_{backend}"] = bench_transform(ploci, bambook, backend, args.repeats)
+    print("Benchmarking context tensorisation")
+    results["context"] = bench_context(ploci, bambook, abams, args.repeats)
+    print("Benchmarking ANNOVAR parsing")
+    results["annovarlist"] = bench_annovarlist(fixture, args.repeats)
+    print("Benchmarking a full build")
+    results["build"] = bench_build(ploci, bambook, abams, args.workers)
+
+    record = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "commit": git_commit(),
+              "python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+              "fixture": fixture["params"], "n_loci": len(ploci), "results": results}
+    with open(args.results, "a") as f:
+        f.write(json.dumps(record) + "\n")
+
+    for name, result in results.items():
+        summary = {key: value for key, value in result.items() if key != "timings"}
+        print(f"{name}: {summary}")
+    print(f"Results appended to {args.results}")
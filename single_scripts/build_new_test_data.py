@@ -11,6 +11,8 @@ from contextTensorizer import random_context_tensorize
 from processAnnovarFile import pairLocus_from_call
 from bamPhonebook import build_bambook_from_csv
 from process_tapsep_multianno import pl_list_from_multianno
+from locusTable import locusTable
+from exclusionRegions import exclusionRegions
 import pickle
 
 
@@ -79,8 +81,7 @@ for bam_ID in bams_mentioned:
     except KeyError:
         print(f"No bam found in bamlist for ID {bam_ID}")
 
-with open("/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/data_generation/data/testset1/exonic_ploci_noindels_testset1.pkl", "wb") as f:
-    pickle.dump(exonic_ploci, f)
+locusTable.from_ploci(exonic_ploci).save("/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/data_generation/data/testset1/exonic_ploci_noindels_testset1.npz")
 
 # with open("/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/data_generation/data/exonic_ploci_noindels_testset1.pkl", "rb") as f:
 #     exonic_ploci = pickle.load(f)
@@ -115,14 +116,11 @@ kick_regions = [("chr9", 44803354, 44881274),
                 ("chr4", 87769924, 87791965)
                 ]
 
-keep = [not any([pl.chromosome == chrom and pl.start >= start and pl.stop <= stop for chrom, start, stop in kick_regions])
-
-        for pl in exonic_ploci]
+keep = ~exclusionRegions(kick_regions).mask_ploci(exonic_ploci)
 
 print(f"Number of ploci kicked: {len(exonic_ploci) - sum(keep)}")
 subset_ploci = [pl for pl, flag in zip(exonic_ploci, keep) if flag]
-with open("/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/data_generation/data/testset1/subset_ploci.pkl", "wb") as f:
-    pickle.dump(subset_ploci, f)
+locusTable.from_ploci(subset_ploci).save("/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/data_generation/data/testset1/subset_ploci.npz")
 
 
 keep_nonsyn = [pl.kwdict["exonic_func"] != "synonymous SNV" for pl in subset_ploci]
@@ -156,8 +154,7 @@ with open(nonsyn_comparison_data_path, "wb") as f:
 with open(nonsyn_comparison_label_path, "wb") as f:
     np.save(f, nonsyn_labels)
 
-with open("/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/data_generation/data/testset1/nonsyn_ploci.pkl", "wb") as f:
-    pickle.dump(nonsyn_ploci, f)
+locusTable.from_ploci(nonsyn_ploci).save("/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/data_generation/data/testset1/nonsyn_ploci.npz")
 
 
 
@@ -0,0 +1,61 @@
+import os
+import sys
+import tempfile
+import numpy as np
+sys.path.append(os.path.abspath("../data_generation/"))
+from pairLocus import pairLocus
+from locusTable import locusTable
+
+
+"""
+Checks that lists of pairLocus objects survive a round trip through locusTable unchanged, both in memory and through
+save and load. The loci cover the cases which the dictionary encoding has to tell apart: kwdict entries which are None,
+entries which some loci do not have at all, values of mixed types in one column, NaN, and None genes.
+
+Usage: python check_locus_table.py
+"""
+
+
+def example_loci():
+    return [
+        pairLocus("GL1", "CL1", "A", "T", "chr1", 100, 101, "exonic", gene="Trp53", exonic_func="stopgain",
+                  mouse_ID=None),
+        pairLocus("GL1", "CL2", "C", "G", "chr1", 200, 201, "intronic", mouse_ID=7),
+        pairLocus("GL2", "CL3", "G", "A", 2, 300, 302, "exonic", gene=np.nan, mouse_ID="7", depth=1.5),
+        pairLocus("GL2", "CL4", "T", "C", "chrX", 400, 401, "intergenic", gene_detail=None, exonic_func=None,
+                  flagged=True),
+        pairLocus("GL3", "CL5", "A", "C", "chr2", 500, 501, "exonic"),
+    ]
+
+
+def mismatches(ploci, table):
+    """
+    :param ploci: List of pairLocus objects
+    :param table: locusTable built from them
+    :return: List of the indices of the loci which do not come back equal, including their kwdict
+    """
+    return [k for k, pl in enumerate(ploci)
+            if len(table) != len(ploci) or table[k] != pl or table[k].kwdict != pl.kwdict]
+
+
+if __name__ == "__main__":
+    ploci = example_loci()
+    table = locusTable.from_ploci(ploci)
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, "loci.npz")
+        table.save(path)
+        loaded = locusTable.load(path)
+
+    failures = {"in memory": mismatches(ploci, table), "after save and load": mismatches(ploci, loaded),
+                "after take": mismatches(ploci[1::2], table.take(np.array([1, 3]))),
+                "after to_ploci": mismatches(ploci, locusTable.from_ploci(table.to_ploci()))}
+    for case, ks in failures.items():
+        if ks:
+            print(f"Loci {ks} differ {case}")
+
+    if table.groups("mouse_ID").get(None, np.array([])).tolist() != [0, 3, 4]:
+        print(f"Groups of mouse_ID are wrong: {table.groups('mouse_ID')}")
+        failures["groups"] = [0, 3, 4]
+
+    print("locusTable round trips agree." if not any(failures.values()) else "locusTable round trips differ.")
@@ -0,0 +1,73 @@
+import os
+import random
+import sys
+import time
+import warnings
+import numpy as np
+sys.path.append(os.path.abspath("../data_generation/"))
+from alignedBAM import alignedBAM, pysam, block_cache
+from bamStruct import bamStruct
+from singleTensorizer import singleTensorizer, NoReadsError
+
+
+"""
+Checks that the pysam and bamnostic backends of alignedBAM give identical tensors, and compares their per-locus
+latency. Positions are drawn from the start positions of the reads in the file, so that most of them are covered.
+
+Usage: python compare_bam_backends.py <bam_path> <bai_path> [n_positions]
+"""
+
+if pysam is None:
+    raise ImportError("pySAM is needed to compare the backends.")
+
+bam_path, bai_path = sys.argv[1], sys.argv[2]
+n_positions = int(sys.argv[3]) if len(sys.argv) > 3 else 200
+
+random.seed(42)
+warnings.simplefilter("ignore")
+
+# Reservoir sample of read start positions
+positions = []
+with pysam.AlignmentFile(bam_path, mode="rb", index_filename=bai_path) as f:
+    for j, read in enumerate(f.fetch(until_eof=True)):
+        if read.is_unmapped:
+            continue
+        position = (read.reference_name, read.reference_start + 10, read.reference_start + 11)
+        if len(positions) < n_positions:
+            positions.append(position)
+        elif random.random() < n_positions / (j + 1):
+            positions[random.randrange(n_positions)] = position
+
+stensorizer = singleTensorizer(bstruct=bamStruct(window_n=50, max_reads=200))
+abams = {backend: alignedBAM(ID="benchmark", bam_path=bam_path, bai_path=bai_path, backend=backend)
+         for backend in ["bamnostic", "pysam"]}
+
+tensors = {}
+latencies = {}
+for backend, abam in abams.items():
+    abam.open_file()  # Exclude building the index from the timings
+    tensors[backend] = []
+    latencies[backend] = []
+    for position in positions:
+        start_time = time.perf_counter()
+        try:
+            tensors[backend].append(stensorizer.transform(abam, position))
+        except NoReadsError:
+            tensors[backend].append(None)
+        latencies[backend].append(time.perf_counter() - start_time)
+
+n_mismatches = 0
+for position, bamnostic_tensor, pysam_tensor in zip(positions, tensors["bamnostic"], tensors["pysam"]):
+    if bamnostic_tensor is None or pysam_tensor is None:
+        identical = bamnostic_tensor is None and pysam_tensor is None
+    else:
+        identical = np.array_equal(bamnostic_tensor, pysam_tensor)
+    if not identical:
+        n_mismatches += 1
+        print(f"Tensors differ at {position}")
+
+print(f"{len(positions) - n_mismatches} of {len(positions)} positions give identical tensors.")
+for backend in abams:
+    print(f"{backend}: mean {1000 * np.mean(latencies[backend]):.2f} ms, "
+          f"median {1000 * np.median(latencies[backend]):.2f} ms per locus")
+print(f"bamnostic block cache: {block_cache.stats()}")
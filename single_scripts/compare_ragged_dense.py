@@ -0,0 +1,141 @@
+import os
+import sys
+import json
+import shutil
+import argparse
+import tempfile
+import warnings
+import numpy as np
+from functools import partial
+sys.path.append(os.path.abspath("../data_generation/"))
+sys.path.append(os.path.abspath("../training/"))
+from alignedBAM import alignedBAM
+from bamPhonebook import build_bambook_from_csv
+from bamStruct import bamStruct
+from singleTensorizer import singleTensorizer
+from contextTensorizer import random_context_tensorize_once, nocontext_depth_tensorize_plocus
+from checkpointedBuild import build_checkpointed
+from benchmark_tensorization import load_candidates
+from synthetic_fixtures import make_fixture_set
+try:
+    from loading_utils import memmapSequence
+except ImportError:
+    memmapSequence = None
+
+
+"""
+Checks that ragged datasets give the same batches as dense ones. The nocontext and x1k2 datasets of a synthetic cohort
+from synthetic_fixtures.py are built once with dense and once with ragged storage, and then compared locus by locus,
+in batches padded to max_reads and in batches padded to their own maximal depth. If Keras is installed, the batches of
+memmapSequence are compared as well.
+
+Usage: python compare_ragged_dense.py [--fixtures ./benchmark_fixtures] [--workers 1] [--max-loci 500]
+                                      [--batch-size 64] [--shard-size 100]
+"""
+
+
+def folder_size(path):
+    if not os.path.isdir(path):
+        return os.path.getsize(path)
+    return sum(os.path.getsize(os.path.join(path, name)) for name in os.listdir(path))
+
+
+def compare_batches(dense, ragged, batch_size: int):
+    """
+    :param dense: Dense dataset, opened as np.memmap
+    :param ragged: Ragged dataset, opened as raggedTensor
+    :param batch_size: Number of loci per batch
+    :return: Number of batches which differ
+    """
+    n_mismatches = 0
+    rng = np.random.default_rng(42)
+    indices = rng.permutation(len(dense))
+    for i in range(0, len(indices), batch_size):
+        batch_indices = indices[i:i + batch_size]
+        expected = np.asarray(dense[np.sort(batch_indices)])[np.argsort(np.argsort(batch_indices))]
+
+        full = ragged.densify(batch_indices)
+        cut = ragged.densify(batch_indices, depth="batch")
+        depth = cut.shape[2]
+        n_tracks = ragged.n_tracks
+        tracks = expected.reshape(expected.shape[:3] + (n_tracks, 7))
+
+        if not (np.array_equal(full, expected) and np.array_equal(cut, expected[:, :, :depth])
+                and not tracks[:, :, depth:].any()):
+            n_mismatches += 1
+            print(f"Batch {i // batch_size} differs")
+
+    return n_mismatches
+
+
+def compare_sequences(dense_path, ragged_path, batch_size: int):
+    n_mismatches = 0
+    for shuffle in [False, True]:
+        dense_sequence = memmapSequence(dense_path, batch_size=batch_size, shuffle=shuffle, seed=0)
+        ragged_sequence = memmapSequence(ragged_path, batch_size=batch_size, shuffle=shuffle, seed=0)
+        for i in range(len(dense_sequence)):
+            if not np.array_equal(dense_sequence[i], ragged_sequence[i]):
+                n_mismatches += 1
+                print(f"memmapSequence batch {i} differs (shuffle={shuffle})")
+    return n_mismatches
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare ragged and dense storage of datasets.")
+    parser.add_argument("--fixtures", default="./benchmark_fixtures")
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--max-loci", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--shard-size", type=int, default=100)
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    fixture_json = os.path.join(args.fixtures, "fixture.json")
+    if not os.path.exists(fixture_json):
+        print(f"Generating fixtures in {args.fixtures}")
+        make_fixture_set(args.fixtures)
+    with open(fixture_json, "r") as f:
+        fixture = json.load(f)
+
+    bambook = build_bambook_from_csv(fixture["bamlist_path"])
+    abams = {ID: alignedBAM(ID, row["bam_path"], row["bai_path"]) for ID, row in bambook.bam_metadf.iterrows()}
+    abams[None] = None
+    ploci = load_candidates(fixture["annovarlist_path"])[:args.max_loci]
+    labels = [0] * len(ploci)
+
+    nocontext_bamstruct = bamStruct(window_n=50, max_reads=200, n_comparison_bams=0)
+    k2_bamstruct = bamStruct(window_n=50, max_reads=200, n_comparison_bams=2)
+    datasets = {
+        "nocontext": (partial(nocontext_depth_tensorize_plocus, singleTensorizer(nocontext_bamstruct, dtype=np.uint8),
+                              abam_dict=abams), nocontext_bamstruct),
+        "x1k2": (partial(random_context_tensorize_once, singleTensorizer(k2_bamstruct, dtype=np.uint8), label=None,
+                         bambook=bambook, abam_dict=abams, k_diffline_samelib=2, k_sameline_samelib=0), k2_bamstruct)}
+
+    out_folder = tempfile.mkdtemp(prefix="compare_ragged_")
+    n_mismatches = 0
+    try:
+        for name, (tensorize_fn, bstruct) in datasets.items():
+            paths = {"dense": os.path.join(out_folder, f"{name}_dense.npy"),
+                     "ragged": os.path.join(out_folder, f"{name}_ragged")}
+            built = {storage: build_checkpointed(ploci, tensorize_fn, abams, path,
+                                                 row_shape=bstruct.tensor_shape(stack_axis=2), dtype=np.uint8,
+                                                 labels=labels, shard_size=args.shard_size, n_workers=args.workers,
+                                                 storage=storage)
+                     for storage, path in paths.items()}
+            dense, ragged = built["dense"][0], built["ragged"][0]
+            assert built["dense"][2] == built["ragged"][2], "The builds failed at different loci"
+
+            dataset_mismatches = compare_batches(dense, ragged, args.batch_size) if len(dense) == len(ragged) else 1
+            if memmapSequence is not None:
+                dataset_mismatches += compare_sequences(paths["dense"], paths["ragged"], args.batch_size)
+            n_mismatches += dataset_mismatches
+
+            print(f"{name}: {len(dense)} loci, {ragged.n_reads} reads, mean depth {ragged.depths.mean():.1f}, "
+                  f"{folder_size(paths['ragged']) / folder_size(paths['dense']):.3f} of the dense size, "
+                  f"{'identical' if dataset_mismatches == 0 else 'DIFFERENT'} batches")
+    finally:
+        shutil.rmtree(out_folder)
+
+    if memmapSequence is None:
+        print("Keras is not installed, the batches of memmapSequence were not compared.")
+    print("Ragged and dense datasets agree." if n_mismatches == 0 else f"{n_mismatches} mismatches.")
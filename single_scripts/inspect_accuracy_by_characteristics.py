@@ -16,18 +16,17 @@ from mutcallClean.training.model_building import nol2_models
 from sklearn.model_selection import train_test_split
 
 sys.path.append(os.path.abspath("/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/data_generation"))
-import pairLocus
+from locusTable import locusTable
 
 x1k3_noindels_data_path = "/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/data_generation/data/x1k3_depth_noindels/x1k3_noindels_depth_tensor.npy"
 x1k3_noindels_labels_path = "/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/data_generation/data/x1k3_depth_noindels/x1k3_noindels_depth_labels.npy"
-noindels_ploci_path = "/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/data_generation/data/ploci.pkl"
+noindels_ploci_path = "/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/data_generation/data/ploci.npz"
 
 with open(x1k3_noindels_data_path, "rb") as f:
     x1k3_data = np.load(f)
 with open(x1k3_noindels_labels_path, "rb") as f:
     num_labels = np.load(f)
-with open(noindels_ploci_path, "rb") as f:
-    noindels_ploci = pickle.load(f)
+noindels_ploci = locusTable.load(noindels_ploci_path)
 
 cat_labels = to_categorical(num_labels)
 
@@ -116,25 +115,14 @@ with open("/limcr-ngs/Marc/git/PhD/limcr_mutcall/mutcallClean/misc/5foldcv_model
 
 print("Initialising idx dicts")
 base_strings = ["A", "C", "T", "G"]
-pl_alt_idc = {base_string: [] for base_string in base_strings}
-pl_ref_idc = {base_string: [] for base_string in base_strings}
-
-funcrefgene_entries = list(set([pl.funcrefgene for pl in noindels_ploci]))
-pl_funcrefgene_idc = {frg: [] for frg in funcrefgene_entries}
-
-print("Filling indices")
-
-for k, pl in enumerate(noindels_ploci):
-    pl_alt_idc[pl.alt].append(k)
-    pl_ref_idc[pl.ref].append(k)
-    pl_funcrefgene_idc[pl.funcrefgene].append(k)
-
-for base_string in base_strings:
-    pl_alt_idc[base_string] = np.array(pl_alt_idc[base_string])
-    pl_ref_idc[base_string] = np.array(pl_ref_idc[base_string])
-
-for frg in pl_funcrefgene_idc.keys():
-    pl_funcrefgene_idc[frg] = np.array(pl_funcrefgene_idc[frg])
+no_idc = np.array([], dtype=int)
+alt_groups = noindels_ploci.groups("alt")
+ref_groups = noindels_ploci.groups("ref")
+pl_alt_idc = {base_string: alt_groups.get(base_string, no_idc) for base_string in base_strings}
+pl_ref_idc = {base_string: ref_groups.get(base_string, no_idc) for base_string in base_strings}
+
+pl_funcrefgene_idc = noindels_ploci.groups("funcrefgene")
+funcrefgene_entries = list(pl_funcrefgene_idc)
 
 print("Building accuracy dicts..")
 print("Alt, ref")
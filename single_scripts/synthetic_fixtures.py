@@ -0,0 +1,205 @@
+import os
+import sys
+import json
+import random
+import argparse
+import pandas as pd
+import pysam
+sys.path.append(os.path.abspath("../data_generation/"))
+from generatePLoci import cats_used_global
+
+
+"""
+Generates a small synthetic cohort for offline benchmarking of the data pipeline, in the same formats as the real
+data: coordinate-sorted and indexed BAM files of germline (G...) and tumour (C...) samples on a random reference,
+an ANNOVAR csv of candidate variants and a spreadsheet of confirmed variants per pair of germline and tumour, and the
+bamlist and annovarlist csvs pointing to them.
+
+Reads are copied from the reference with sequencing errors. At the confirmed variants, a fraction of the reads of the
+tumour carries the alternative base, while the remaining candidates are pure sequencing noise. Depth, read length
+and locus density are controllable, see make_fixture_set.
+
+Writing the spreadsheets needs an Excel engine for pandas, e.g. openpyxl. Without one, they are left out, and
+everything else is still generated.
+
+Usage: python synthetic_fixtures.py <output_folder> [--depth 30] [--read-len 100] [--loci-per-kb 0.5] [...]
+"""
+
+bases = "ACGT"
+
+
+def random_reference(chromosomes: dict, rng: random.Random):
+    return {name: "".join(rng.choice(bases) for _ in range(length)) for name, length in chromosomes.items()}
+
+
+def make_synthetic_bam(path, reference: dict, depth: float, read_len: int, rng: random.Random,
+                       variants: dict = None, vaf: float = 0.4, error_rate: float = 0.005):
+    """
+    Writes a coordinate-sorted BAM file of single-end reads sampled uniformly from reference, and its BAI index.
+
+    :param path: Path of the BAM file, the index is written to path + ".bai"
+    :param reference: Dictionary linking chromosome names to their sequence
+    :param depth: Mean coverage
+    :param read_len: Length of every read
+    :param rng: random.Random instance
+    :param variants: Optional dictionary linking (chromosome, 0-based position) to an alternative base carried by a
+    fraction vaf of the reads covering the position
+    :param vaf: Variant allele frequency
+    :param error_rate: Probability of a sequencing error per base
+    :return: Number of reads written
+    """
+    variants = variants if variants is not None else {}
+    header = {"HD": {"VN": "1.0", "SO": "coordinate"},
+              "SQ": [{"SN": name, "LN": len(sequence)} for name, sequence in reference.items()]}
+
+    n_written = 0
+    with pysam.AlignmentFile(path, "wb", header=header) as out:
+        for reference_id, (chromosome, sequence) in enumerate(reference.items()):
+            n_reads = int(depth * len(sequence) / read_len)
+            starts = sorted(rng.randrange(0, len(sequence) - read_len) for _ in range(n_reads))
+            chromosome_variants = sorted(p for c, p in variants if c == chromosome)
+
+            for i, start in enumerate(starts):
+                read_seq = list(sequence[start:start + read_len])
+                for j in range(read_len):
+                    if rng.random() < error_rate:
+                        read_seq[j] = rng.choice(bases)
+                for p in chromosome_variants:
+                    if start <= p < start + read_len and rng.random() < vaf:
+                        read_seq[p - start] = variants[(chromosome, p)]
+
+                read = pysam.AlignedSegment()
+                read.query_name = f"{chromosome}_{i}"
+                read.query_sequence = "".join(read_seq)
+                read.flag = 16 if rng.random() < 0.5 else 0
+                read.reference_id = reference_id
+                read.reference_start = start
+                read.mapping_quality = rng.randint(20, 60)
+                read.cigar = ((0, read_len),)
+                read.query_qualities = pysam.qualitystring_to_array(
+                    "".join(chr(33 + rng.randint(10, 41)) for _ in range(read_len)))
+                out.write(read)
+                n_written += 1
+
+    pysam.index(path, path + ".bai")
+    return n_written
+
+
+def make_fixture_set(folder, n_lines: int = 2, tumours_per_line: int = 2, n_libraries: int = 2,
+                     chromosomes: dict = None, depth: float = 30, read_len: int = 100, loci_per_kb: float = 0.5,
+                     validated_fraction: float = 0.3, indel_fraction: float = 0.05, seed: int = 42):
+    """
+    Generates a synthetic cohort in folder, see the description of this file. Every line has one germline sample and
+    tumours_per_line tumour samples, whose libraries alternate, so that tumours have comparison tracks of the same
+    library in the other lines.
+
+    :param folder: Output folder
+    :param n_lines: Number of transplantation lines
+    :param tumours_per_line: Number of tumour samples per line
+    :param n_libraries: Number of library preparations
+    :param chromosomes: Dictionary linking chromosome names to their lengths
+    :param depth: Mean coverage of every sample
+    :param read_len: Length of the reads
+    :param loci_per_kb: Number of candidate variants per kilobase and tumour
+    :param validated_fraction: Fraction of the candidates which are genuine and confirmed
+    :param indel_fraction: Fraction of the candidates given as indels, which kick_indels removes
+    :param seed: Random seed
+    :return: Dictionary of the paths of the bamlist and annovarlist and the parameters used
+    """
+    if chromosomes is None:
+        chromosomes = {"chr1": 50000, "chr2": 30000}
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    folder = os.path.abspath(folder)
+
+    reference = random_reference(chromosomes, rng)
+    total_len = sum(chromosomes.values())
+
+    bam_rows = []
+    annovar_rows = []
+    has_excel_engine = True
+
+    for line in range(n_lines):
+        GL_ID = f"G{line}"
+        GL_path = os.path.join(folder, f"{GL_ID}.bam")
+        make_synthetic_bam(GL_path, reference, depth, read_len, rng)
+        bam_rows.append({"bam_ID": GL_ID, "bam_path": GL_path, "bai_path": GL_path + ".bai",
+                         "line_ID": str(line), "library_ID": "0"})
+
+        for t in range(tumours_per_line):
+            CL_ID = f"C{line}_{t}"
+            library_ID = str(t % n_libraries)
+
+            # Candidate variants, away from the chromosome ends so that their windows are complete
+            n_loci = int(loci_per_kb * total_len / 1000)
+            calls = []
+            variants = {}
+            for _ in range(n_loci):
+                chromosome = rng.choice(list(chromosomes))
+                p = rng.randrange(read_len, chromosomes[chromosome] - read_len)
+                ref = reference[chromosome][p]
+                alt = rng.choice([b for b in bases if b != ref])
+                if rng.random() < indel_fraction:
+                    alt = "-"
+                is_validated = alt != "-" and rng.random() < validated_fraction
+                if is_validated:
+                    variants[(chromosome, p)] = alt
+                calls.append({"Chr": chromosome, "Start": p + 1, "End": p + 1, "Ref": ref, "Alt": alt,
+                              "Func.RefGene": rng.choice(cats_used_global + ["intronic", "intergenic"]),
+                              "validated": is_validated})
+
+            CL_path = os.path.join(folder, f"{CL_ID}.bam")
+            make_synthetic_bam(CL_path, reference, depth, read_len, rng, variants=variants)
+            bam_rows.append({"bam_ID": CL_ID, "bam_path": CL_path, "bai_path": CL_path + ".bai",
+                             "line_ID": str(line), "library_ID": library_ID})
+
+            calls_df = pd.DataFrame(calls).sort_values(["Chr", "Start"])
+            annovar_path = os.path.join(folder, f"{GL_ID}_vs_{CL_ID}.annovar.csv")
+            calls_df.drop(columns="validated").to_csv(annovar_path, sep=",", index=False)
+
+            snplist_path = os.path.join(folder, f"{GL_ID}_vs_{CL_ID}_confirmed.xlsx")
+            try:
+                calls_df[calls_df["validated"]].drop(columns="validated").to_excel(snplist_path, index=False)
+            except ImportError:
+                has_excel_engine = False
+
+            annovar_rows.append({"GL_bam_ID": GL_ID, "CL_bam_ID": CL_ID, "annovar_path": annovar_path,
+                                 "snplist_path": snplist_path})
+
+    bamlist_path = os.path.join(folder, "bamlist.csv")
+    pd.DataFrame(bam_rows).to_csv(bamlist_path, sep=";", index=False)
+    annovarlist_path = os.path.join(folder, "annovarlist.csv")
+    pd.DataFrame(annovar_rows).to_csv(annovarlist_path, sep=";", index=False)
+
+    if not has_excel_engine:
+        print("No Excel engine for pandas installed, the spreadsheets of confirmed variants were not written.")
+
+    fixture = {"bamlist_path": bamlist_path, "annovarlist_path": annovarlist_path, "has_snplists": has_excel_engine,
+               "params": {"n_lines": n_lines, "tumours_per_line": tumours_per_line, "n_libraries": n_libraries,
+                          "chromosomes": chromosomes, "depth": depth, "read_len": read_len,
+                          "loci_per_kb": loci_per_kb, "validated_fraction": validated_fraction,
+                          "indel_fraction": indel_fraction, "seed": seed}}
+    with open(os.path.join(folder, "fixture.json"), "w") as f:
+        json.dump(fixture, f, indent=2)
+
+    return fixture
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate a synthetic cohort of BAM files and ANNOVAR outputs.")
+    parser.add_argument("folder")
+    parser.add_argument("--lines", type=int, default=2)
+    parser.add_argument("--tumours-per-line", type=int, default=2)
+    parser.add_argument("--chromosome-length", type=int, default=50000)
+    parser.add_argument("--n-chromosomes", type=int, default=2)
+    parser.add_argument("--depth", type=float, default=30)
+    parser.add_argument("--read-len", type=int, default=100)
+    parser.add_argument("--loci-per-kb", type=float, default=0.5)
+    parser.add_argument("--seed", type=int, default=42)
+    args = parser.parse_args()
+
+    fixture = make_fixture_set(args.folder, n_lines=args.lines, tumours_per_line=args.tumours_per_line,
+                               chromosomes={f"chr{c + 1}": args.chromosome_length for c in range(args.n_chromosomes)},
+                               depth=args.depth, read_len=args.read_len, loci_per_kb=args.loci_per_kb,
+                               seed=args.seed)
+    print(json.dumps(fixture, indent=2))
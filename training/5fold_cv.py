@@ -8,6 +8,7 @@ import datetime
 import inspect
 from make_keras_model import make_batchnorm_model
 from scoring_utils import score_from_cat
+from loading_utils import memmapSequence
 
 
 
@@ -47,10 +48,8 @@ def run_5fold_cv(data_path, label_path, get_model_callable, model_name="", tf_se
     os.makedirs(concrete_out_folder, exist_ok=True)
 
 
-    print("Loading data.")
-    with open(data_path, "rb") as f:
-        in_data = np.load(f)
-
+    # The tensors stay on disk and are read batch by batch, only the labels are loaded
+    print("Loading labels.")
     with open(label_path, "rb") as f:
         labels = np.array(np.load(f))
 
@@ -68,32 +67,33 @@ def run_5fold_cv(data_path, label_path, get_model_callable, model_name="", tf_se
     f1s = []
 
     i = 0
-    for train_idc, test_idc in skf.split(in_data, labels):
+    batch_size = 256
+    for train_idc, test_idc in skf.split(np.zeros(len(labels)), labels):
         train_seed = i + tf_seed
         np.random.seed(train_seed)
         tensorflow.random.set_seed(train_seed)
         train_seeds.append(train_seed)
 
-        # Train-test-split
-        train_data, test_data = keras.utils.normalize(in_data[train_idc, ...]), keras.utils.normalize(
-            in_data[test_idc, ...])
+        # Train-test-split, normalized batch by batch
+        train_data = memmapSequence(data_path, train_idc, labels=cat_labels, batch_size=batch_size, shuffle=True,
+                                    seed=train_seed)
+        test_data = memmapSequence(data_path, test_idc, batch_size=batch_size)
 
-        train_labels, test_labels = cat_labels[train_idc], cat_labels[test_idc]
+        test_labels = cat_labels[test_idc]
 
         train_metrics = ["accuracy"]
 
-        model = get_model_callable(input_shape=train_data.shape[1:], metrics=train_metrics)
+        model = get_model_callable(input_shape=train_data.sample_shape, metrics=train_metrics)
 
         fit_args = {"x": train_data,
-                    "y": train_labels,
-                    "batch_size": 256,
                     "epochs": 50,
                     "verbose": 0,
+                    **train_data.loader_kwargs,
                     }
 
         history = model.fit(**fit_args)
 
-        model_prediction_test = model.predict(test_data)
+        model_prediction_test = model.predict(test_data, **test_data.loader_kwargs)
 
         valacc, precision, recall, f1 = score_from_cat(y_true_cat=test_labels, y_pred_cat=model_prediction_test)
 
@@ -119,8 +119,8 @@ def run_5fold_cv(data_path, label_path, get_model_callable, model_name="", tf_se
         f.write(f"Train seeds: {train_seed_string}")
 
     with open(os.path.join(info_save_folder, "args.txt"), "w") as f:
-        for key in ["batch_size", "epochs"]:
-            f.write(f"{key}: {fit_args[key]}\n")
+        f.write(f"batch_size: {batch_size}\n")
+        f.write(f"epochs: {fit_args['epochs']}\n")
 
     with open(os.path.join(info_save_folder, "metrics.txt"), "w") as f:
         f.write("metric;scores;avg\n")
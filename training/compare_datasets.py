@@ -7,6 +7,7 @@ import random
 from keras.utils import to_categorical
 from scoring_utils import score_from_cat
 from make_keras_model import make_batchnorm_model
+from loading_utils import memmapSequence
 
 """
 I/O
@@ -15,23 +16,20 @@ print("Loading data.")
 contexted_data_folder = os.path.abspath("../data/in_facility/contexted")
 contexted_tensor_path = os.path.join(contexted_data_folder, "scrambled_x1k2_tensor.npy")
 contexted_labels_path = os.path.join(contexted_data_folder, "x1k2_labels.npy")
-with open(contexted_tensor_path, "rb") as f:
-    train_data = np.load(f)
 with open(contexted_labels_path, "rb") as f:
     train_labels_num = np.load(f)
 
-train_data = keras.utils.normalize(train_data)
 train_labels = to_categorical(train_labels_num)
+# The tensors stay on disk, and are read and normalized batch by batch
+train_data = memmapSequence(contexted_tensor_path, labels=train_labels, batch_size=256, shuffle=True, seed=0)
 
 validation_data_path = os.path.abspath("../data/kotani/scrambled_kotani_x1k2_tensor.npy")
 validation_label_path = os.path.abspath("../data/kotani/kotani_labels.npy")
-with open(validation_data_path, "rb") as f:
-    valid_data = np.load(f)
 with open(validation_label_path, "rb") as f:
     valid_labels_num = np.load(f)
 
 valid_labels = to_categorical(valid_labels_num)
-valid_data = keras.utils.normalize(valid_data)
+valid_data = memmapSequence(validation_data_path, batch_size=256)
 
 
 """
@@ -39,10 +37,9 @@ First: Train model on all in-facility data.
 """
 print("Training model:")
 fit_args = {"x": train_data,
-            "y": train_labels,
-            "batch_size": 256,
             "epochs": 50,
             "verbose": 1,
+            **train_data.loader_kwargs,
             }
 
 np.random.seed(0)
@@ -50,7 +47,7 @@ tensorflow.random.set_seed(0)
 random.seed(0)
 
 
-model = make_batchnorm_model(input_shape=train_data.shape[1:], metrics=["accuracy"])
+model = make_batchnorm_model(input_shape=train_data.sample_shape, metrics=["accuracy"])
 history = model.fit(**fit_args)
 
 model_out_folder = os.path.abspath("../misc/keras_model_for_kotani")
@@ -60,7 +57,7 @@ model.save(model_out_folder)
 """
 Next: Evaluate predictions on external data.
 """
-y_pred_cat = model.predict(valid_data)
+y_pred_cat = model.predict(valid_data, **valid_data.loader_kwargs)
 print("Final validation metrics:")
 acc, precision, recall, f1 = score_from_cat(y_true_cat=valid_labels, y_pred_cat=y_pred_cat, verbose=True)
 
@@ -0,0 +1,134 @@
+import os
+import sys
+import numpy as np
+import keras
+sys.path.append(os.path.abspath("../data_generation/"))
+from raggedTensor import raggedTensor
+
+# Keras 3 takes the settings of background loading in the constructor of keras.utils.Sequence, older versions in
+# model.fit and model.predict
+keras_3 = int(keras.__version__.split(".")[0]) >= 3
+
+
+def decode_tensor(data, dtype=np.float32):
+    """
+    Utility function that decodes tensors stored in the compact uint8 format into floats. Every sequencing track
+    occupies 7 channels along the last axis, the last of which is the strand flag, stored as 255 for -1.
+    Tensors stored as floats are returned as they are.
+
+    :param data: np.array of tensors, as written by generateData.py
+    :param dtype: Float dtype to decode into
+    :return: Decoded np.array
+    """
+
+    if data.dtype != np.uint8:
+        return data
+
+    out = data.astype(dtype)
+    out[..., 6::7] = data[..., 6::7].view(np.int8)
+    return out
+
+
+class memmapSequence(keras.utils.Sequence):
+    """
+    Out-of-core loader of a dataset written by generateData.py, to be passed to model.fit and model.predict in place
+    of the full array. The .npy file is memory-mapped, and each batch gathers its samples from the file, decodes and
+    normalizes them, so that memory use is bounded by a few batches rather than by the size of the dataset.
+
+    Ragged datasets (see data_generation/raggedTensor.py) are read in the same way, given the path of their folder,
+    and each batch is padded when it is loaded. By default, it is padded to max_reads, which gives exactly the batches
+    of the dense file; with depth="batch", it is only padded to the deepest locus of the batch.
+
+    Since keras.utils.normalize scales each sample on its own, normalizing batch by batch gives the same data as
+    normalizing the whole array at once. Within a batch, samples are read in file order and then put back into the
+    order of indices.
+
+    Batches are prepared ahead by background workers, by default 4 threads keeping up to 8 batches queued, so that
+    reading from disk overlaps with training. With Keras 3, the constructor hands these settings on to
+    keras.utils.Sequence; with older versions of Keras, they have to be passed to model.fit and model.predict, which is
+    what loader_kwargs is for. The memory map is not pickled, but opened again in every worker process.
+    """
+
+    def __init__(self, data_path, indices=None, labels=None, batch_size: int = 256, shuffle: bool = False,
+                 normalize: bool = True, dtype=np.float32, seed: int = None, workers: int = 4,
+                 use_multiprocessing: bool = False, max_queue_size: int = 8, depth=None, **kwargs):
+        """
+        Constructor
+
+        :param data_path: Path to binary dump of numpy tensor, or to the folder of a ragged dataset
+        :param indices: Indices of the samples to be served, e.g. the training part of a fold. Defaults to all samples
+        :param labels: Optional array of (categorical) labels of all samples in the file, served with the batches
+        :param batch_size: Number of samples per batch
+        :param shuffle: Whether to shuffle the samples after every epoch, as model.fit does for arrays
+        :param normalize: Whether to apply keras.utils.normalize to every batch
+        :param dtype: Float dtype to decode into
+        :param seed: Seed of the shuffling
+        :param workers: Number of workers preparing batches ahead
+        :param use_multiprocessing: Whether the workers are processes instead of threads
+        :param max_queue_size: Maximal number of batches prepared ahead
+        :param depth: Number of read rows per track the batches of a ragged dataset are padded to, see
+        raggedTensor.densify. None pads to max_reads, as in the dense file; "batch" pads to the deepest locus of the
+        batch, for models which take any number of rows
+        :param kwargs: Passed to keras.utils.Sequence
+        """
+        loader_kwargs = {"workers": workers, "use_multiprocessing": use_multiprocessing,
+                         "max_queue_size": max_queue_size}
+        if keras_3:
+            super().__init__(**loader_kwargs, **kwargs)
+            self.loader_kwargs = {}
+        else:
+            super().__init__(**kwargs)
+            self.loader_kwargs = loader_kwargs  # To be passed to model.fit and model.predict
+        self.data_path = data_path
+        self.ragged = os.path.isdir(data_path)
+        self.depth = depth
+        self._data = None
+
+        self.n_total = len(self.data)
+        self.sample_shape = self.data.shape[1:]
+        self.indices = np.arange(self.n_total) if indices is None else np.asarray(indices)
+        self.labels = labels
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.normalize = normalize
+        self.dtype = dtype
+        self.rng = np.random.default_rng(seed)
+
+        if self.shuffle:
+            self.indices = self.rng.permutation(self.indices)
+
+    @property
+    def data(self):
+        if self._data is None:
+            self._data = raggedTensor(self.data_path) if self.ragged else np.load(self.data_path, mmap_mode="r")
+        return self._data
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_data"] = None
+        return state
+
+    def __len__(self):
+        return int(np.ceil(len(self.indices) / self.batch_size))
+
+    def __getitem__(self, i):
+        batch_indices = self.indices[i * self.batch_size:(i + 1) * self.batch_size]
+
+        if self.ragged:
+            batch = self.data.densify(batch_indices, depth=self.depth)
+        else:
+            order = np.argsort(batch_indices, kind="stable")
+            batch = np.empty((len(batch_indices),) + self.sample_shape, dtype=self.data.dtype)
+            batch[order] = self.data[batch_indices[order]]
+
+        batch = decode_tensor(batch, dtype=self.dtype)
+        if self.normalize:
+            batch = keras.utils.normalize(batch)
+
+        if self.labels is None:
+            return batch
+        return batch, self.labels[batch_indices]
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            self.indices = self.rng.permutation(self.indices)
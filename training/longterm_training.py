@@ -9,6 +9,7 @@ import inspect
 from sklearn.model_selection import train_test_split
 from make_keras_model import make_batchnorm_model
 from scoring_utils import score_from_cat
+from loading_utils import memmapSequence
 
 
 contexted_data_folder = os.path.abspath("../data/in_facility/contexted")
@@ -49,10 +50,8 @@ def run_longterm_evaluation(data_path, label_path, get_model_callable, model_nam
     os.makedirs(concrete_out_folder, exist_ok=True)
     os.makedirs(info_save_folder, exist_ok=True)
 
-    print("Loading data.")
-    with open(data_path, "rb") as f:
-        in_data = np.load(f)
-
+    # The tensors stay on disk and are read batch by batch, only the labels are loaded
+    print("Loading labels.")
     with open(label_path, "rb") as f:
         labels = np.array(np.load(f))
 
@@ -71,36 +70,37 @@ def run_longterm_evaluation(data_path, label_path, get_model_callable, model_nam
     np.random.seed(np_tf_seed)
     tensorflow.random.set_seed(np_tf_seed)
 
+    batch_size = 256
     for i in range(n_splits):
         split_seed = i
         split_seeds.append(split_seed)
 
-        train_idc, test_idc = train_test_split(np.arange(len(in_data)), train_size=0.8, shuffle=True,
+        train_idc, test_idc = train_test_split(np.arange(len(labels)), train_size=0.8, shuffle=True,
                                                random_state=i, stratify=labels)
 
-        train_data = keras.utils.normalize(in_data[train_idc, ...])
-        test_data = keras.utils.normalize(in_data[test_idc, ...])
+        train_data = memmapSequence(data_path, train_idc, labels=cat_labels, batch_size=batch_size, shuffle=True,
+                                    seed=split_seed)
+        test_data = memmapSequence(data_path, test_idc, batch_size=batch_size)
 
-        train_labels, test_labels = cat_labels[train_idc], cat_labels[test_idc]
+        test_labels = cat_labels[test_idc]
 
         test_classes = np.argmax(test_labels, axis=1)
         assert len(test_classes) == len(test_labels)
 
         train_metrics = ["accuracy"]
 
-        model = get_model_callable(input_shape=train_data.shape[1:], metrics=train_metrics)
+        model = get_model_callable(input_shape=train_data.sample_shape, metrics=train_metrics)
 
         fit_args = {"x": train_data,
-                    "y": train_labels,
-                    "batch_size": 256,
                     "epochs": 50,
                     "verbose": 0,
+                    **train_data.loader_kwargs,
                     }
         np.random.seed(split_seed)
         tensorflow.random.set_seed(split_seed)
         history = model.fit(**fit_args)
 
-        model_prediction_test = model.predict(test_data)
+        model_prediction_test = model.predict(test_data, **test_data.loader_kwargs)
 
         valacc, precision, recall, f1 = score_from_cat(y_true_cat=test_labels, y_pred_cat=model_prediction_test)
 
@@ -126,8 +126,8 @@ def run_longterm_evaluation(data_path, label_path, get_model_callable, model_nam
         f.write(f"Train seeds: {split_seed_string}")
 
     with open(os.path.join(info_save_folder,  "args.txt"), "w") as f:
-        for key in ["batch_size", "epochs"]:
-            f.write(f"{key}: {fit_args[key]}\n")
+        f.write(f"batch_size: {batch_size}\n")
+        f.write(f"epochs: {fit_args['epochs']}\n")
 
     with open(os.path.join(info_save_folder,  "metrics.txt"), "w") as f:
         f.write("metric;avg;std;scores\n")